@@ -1,9 +1,12 @@
 from StateTypes import GraphState, DefenceAnalysis
-from context_utils import build_context
-from langchain_core.output_parsers import PydanticOutputParser
+from context_utils import ContextBuilder
+from call_policy import CallPolicy
+from structured_output import structured_chain
+from guidance_index import NodeGuidance, default_index
+from speculation import Speculator
+import nodes
 from langchain_core.prompts import PromptTemplate
-
-defence_analysis_parser = PydanticOutputParser(pydantic_object=DefenceAnalysis)
+from langchain_core.runnables import RunnableConfig
 
 defence_analysis_prompt = PromptTemplate(
     template="""
@@ -26,16 +29,7 @@ human safety above property protection in accordance with Australian bushfire sa
 principles.
 
 Knowledge
-Australian bushfire defense capability depends on multiple factors: physical ability, 
-equipment, water supply, property preparation, knowledge of fire behavior, and 
-emotional readiness.
-Stay and defend decisions require significant preparation and capability.
-Early evacuation is the safest option for those with limited capability.
-The "prepare, act, survive" doctrine emphasizes preparation regardless of the chosen 
-plan.
-Different Australian states may have varying specific recommendations.
-Capability assessment must consider vulnerable household members (children, 
-elderly, disabled, pets).
+{guidance}
 
 Next Steps:
 
@@ -53,32 +47,48 @@ depends on your assessment.
 
     Context: {full_context}
     
-    {format_instructions}
     """,
-    input_variables=["full_context"],
-    partial_variables={"format_instructions": defence_analysis_parser.get_format_instructions()},
+    input_variables=["full_context", "guidance"],
 )
 
+DEFENCE_GUIDANCE_QUERY = "defend capability physical ability equipment water supply pump property preparation vulnerable household leave early"
+
 class AssessDefence:
-  def __init__(self, llm):
+  def __init__(self, llm, policy=None, guidance=None):
     self.llm = llm
-    self.llm_chain = defence_analysis_prompt | llm | defence_analysis_parser
+    self.llm_chain = structured_chain(defence_analysis_prompt, llm, DefenceAnalysis)
+    self.policy = policy or CallPolicy()
+    self.guidance = NodeGuidance(guidance or default_index(), ["general", "defence"], DEFENCE_GUIDANCE_QUERY, ["risk_assessment", "defence_assessment"])
+    self.speculator = Speculator(self.llm_chain, self.guidance, nodes.ASSESS_DEFENCE_NODE)
     self.intro_given = False
+    self.context_builder = ContextBuilder()
 
-  def __call__(self, state: GraphState):
+  def __call__(self, state: GraphState, config: RunnableConfig = None):
     """
     Assesses the ability for users to defend their property against bushfire risk using an LLM and structured parsing.
     """
+    inputs = self.prepare(state, config)
+    parsed_response = self.speculator.invoke(self.policy, config, inputs)
+    return self.finish(parsed_response)
+
+  async def acall(self, state: GraphState, config: RunnableConfig = None):
+    """
+    Async version of __call__.
+    """
+    inputs = self.prepare(state, config)
+    parsed_response = await self.speculator.ainvoke(self.policy, config, inputs)
+    return self.finish(parsed_response)
 
+  def prepare(self, state: GraphState, config: RunnableConfig = None):
     if not self.intro_given:
       print("\nLet's assess your capability of defending your property against bushfire\n")
       self.intro_given = True
 
     print("\nAssessing stay and defend capability...")
 
-    full_context = build_context(state)
-    parsed_response = self.llm_chain.invoke({"full_context": full_context})
+    return {"full_context": self.context_builder.build(state, config), "guidance": self.guidance(state)}
 
+  def finish(self, parsed_response):
     if parsed_response.capability_level != 'unclear':
       print("\n--------")
       print(f"Summary: {parsed_response.message}\n")
@@ -1,9 +1,11 @@
 from StateTypes import GraphState, RiskAnalysis
-from context_utils import build_context
-from langchain_core.output_parsers import PydanticOutputParser
+from context_utils import ContextBuilder
+from call_policy import CallPolicy
+from structured_output import structured_chain
+from guidance_index import NodeGuidance, default_index
+from region_index import describe
 from langchain_core.prompts import PromptTemplate
-
-risk_analysis_parser = PydanticOutputParser(pydantic_object=RiskAnalysis)
+from langchain_core.runnables import RunnableConfig
 
 risk_analysis_prompt = PromptTemplate(
     template="""
@@ -40,12 +42,8 @@ the I understand my specific risk factors and vulnerabilities.
 **Knowledge**
 - Use Australian bushfire terminology exclusively: 'bushfire' not 'wildfire', 'bush' not 'forest', 'CFA' for Country Fire Authority, 'RFS' for Rural Fire Service
 - All status values must be in lowercase format (high, low, unsure, etc.)
-- Australian bushfire risk factors include: Fire Danger Rating system, Bushfire Attack Level (BAL) ratings, ember attack zones, radiant heat exposure, flame contact risk
-- Key assessment categories: vegetation type and proximity, topographical features, property access and egress routes, building materials and design, water supply availability, local weather patterns, historical fire activity
-- Australian fire seasons typically run October to March with peak risk December to February
-- Consider state-specific fire authorities and local fire management zones
-- Factor in Australian building standards AS 3959 for bushfire-prone areas
 - The user's motivation for creating the plan
+{guidance}
 
 **Examples**
 Risk assessment questions should follow this structured approach:
@@ -77,31 +75,60 @@ your risk assessment.
 
 Context: {full_context}
 
-{format_instructions}
     """,
-    input_variables=["full_context"],
-    partial_variables={"format_instructions": risk_analysis_parser.get_format_instructions()},
+    input_variables=["full_context", "guidance"],
 )
 
+RISK_GUIDANCE_QUERY = "risk factors vegetation topography slope access fire danger rating bushfire attack level AS 3959 fire season fire authority"
+
 class AssessRisk:
-  def __init__(self, llm):
+  def __init__(self, llm, policy=None, guidance=None, regions=None):
     self.llm = llm
-    self.llm_chain = risk_analysis_prompt | llm | risk_analysis_parser
+    self.llm_chain = structured_chain(risk_analysis_prompt, llm, RiskAnalysis)
+    self.policy = policy or CallPolicy()
+    self.guidance = NodeGuidance(guidance or default_index(), ["general", "risk"], RISK_GUIDANCE_QUERY, ["risk_assessment"])
+    # RegionIndex for the facts of the property's postcode or locality, once it is known
+    self.regions = regions
     self.intro_given = False
+    self.context_builder = ContextBuilder()
 
-  def __call__(self, state: GraphState):
+  def __call__(self, state: GraphState, config: RunnableConfig = None):
     """
     Assesses bushfire risk using an LLM and structured parsing.
     """
+    inputs = self.prepare(state, config)
+    parsed_response = self.policy.invoke(self.llm_chain, inputs, config)
+    return self.finish(parsed_response)
+
+  async def acall(self, state: GraphState, config: RunnableConfig = None):
+    """
+    Async version of __call__.
+    """
+    inputs = self.prepare(state, config)
+    parsed_response = await self.policy.ainvoke(self.llm_chain, inputs, config)
+    return self.finish(parsed_response)
+
+  def prepare(self, state: GraphState, config: RunnableConfig = None):
     if not self.intro_given:
       print("\nLet's assess the risk first\n")
       self.intro_given = True
 
     print("\nAssessing Risk...")
 
-    full_context = build_context(state)
-    parsed_response = self.llm_chain.invoke({"full_context": full_context})
+    full_context = self.context_builder.build(state, config)
+    region = self.region_facts(state)
+    if region:
+      full_context += f"\n\nRegion facts for the property (already known, do not ask for them):\n{region}"
+    return {"full_context": full_context, "guidance": self.guidance(state)}
+
+  def region_facts(self, state: GraphState):
+    if not self.regions:
+      return None
+    answers = state.risk_assessment.questions.answers if state.risk_assessment else {}
+    facts = self.regions.resolve(state.user_motivation, answers)
+    return describe(facts) if facts else None
 
+  def finish(self, parsed_response):
     if parsed_response.risk_level != 'unclear':
       print("\n--------")
       print(f"Summary: {parsed_response.message}\n")
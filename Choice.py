@@ -1,35 +1,50 @@
 from StateTypes import GraphState
-from context_utils import check_quit
+from langchain_core.runnables import RunnableConfig
+from responders import get_responder
+from speculation import get_thread_id
 
 class AskChoice:
-  def __init__(self, section, choice, options):
+  def __init__(self, section, choice, options, speculate=None):
       self.section = section
       self.choice = choice
       self.options = options
+      # option -> LLM node to run speculatively while the user decides
+      self.speculate = speculate or {}
 
-  def __call__(self, state: GraphState):
+  def __call__(self, state: GraphState, config: RunnableConfig = None):
 
     print("\nI need you to make a decision.")
 
-    section_obj = getattr(state, self.section, None)
-    choice_section = getattr(section_obj, 'choice', None) if section_obj else []
-    choices_made = getattr(choice_section, 'choices_made', {}) if choice_section else {}
+    responder = get_responder(config)
 
     if len(self.options) == 0:
         print("I have no options for you to select from. I must go now!")
         exit(0)
 
-    valid = False
-    while not valid:
-        user_input = input(f"\n{self.choice}\nYour choice: {'/'.join(self.options)}: ")
-        check_quit(user_input)
-        valid = user_input.lower() in [opt.lower() for opt in self.options]
-        if not valid:
-            print(f"\nInvalid choice. Please select from: {'/'.join(self.options)}")
+    thread_id = get_thread_id(config)
+    for option, node in self.speculate.items():
+        # run the next node on the state as it will be if this option is chosen
+        predicted_state = state.model_copy(deep=True)
+        self.record_choice(predicted_state, option)
+        node.speculator.start(node.policy, config, predicted_state)
+
+    user_input = responder.choose(self.choice, self.options)
+
+    for option, node in self.speculate.items():
+        if option.lower() != user_input.lower():
+            node.speculator.discard(thread_id)
+
+    self.record_choice(state, user_input)
+
+    # recorded in place, and returned so the choice is saved when the graph is interrupted and resumed
+    return {self.section: getattr(state, self.section)}
+
+  def record_choice(self, state: GraphState, user_input):
+    section_obj = getattr(state, self.section, None)
+    choice_section = getattr(section_obj, 'choice', None) if section_obj else []
+    choices_made = getattr(choice_section, 'choices_made', {}) if choice_section else {}
 
     choices_made[self.choice] = user_input
     
     if hasattr(choice_section, 'last_choice'):
-        choice_section.last_choice = user_input
-    
-    return {}
\ No newline at end of file
+        choice_section.last_choice = user_input
\ No newline at end of file
@@ -1,9 +1,12 @@
 from StateTypes import GraphState, LeavePlan
-from context_utils import build_context
-from langchain_core.output_parsers import PydanticOutputParser
+from context_utils import ContextBuilder
+from call_policy import CallPolicy
+from structured_output import structured_chain
+from guidance_index import NodeGuidance, default_index
+from speculation import Speculator
+import nodes
 from langchain_core.prompts import PromptTemplate
-
-risk_analysis_parser = PydanticOutputParser(pydantic_object=LeavePlan)
+from langchain_core.runnables import RunnableConfig
 
 risk_analysis_prompt = PromptTemplate(
     template="""
@@ -30,37 +33,15 @@ contributing to my survival and the protection of my family and property.
 **Knowledge**
 You must cover these six mandatory areas through systematic questioning:
 
-1. **When to Leave**: (record in when_to_leave)
-Identify specific trigger conditions including fire danger ratings (Catastrophic,
-Extreme, Severe), observable warning signs (smoke colour/direction, ember showers, 
-temperature spikes), official alerts (Emergency Alert, Watch and Act, Advice), 
-media reports, and personal comfort thresholds.
-
-2. **Where to Go**: (record in where_to_go)
-Establish multiple safe destination options with specific addresses, contact details, 
-and confirmation of availability. Consider distance from fire-prone areas, accommodation 
-capacity, pet-friendly options, and accessibility requirements.
-
-3. **How to Get There**: (record in Map how_to_get_there
-Primary and alternative evacuation routes with specific road names, identify potential 
-hazards or bottlenecks, determine appropriate vehicles, account for traffic conditions, 
-and plan for mobility-impaired individuals or large families.
-
-4. **What to Take**: (record in what_to_take)
-Create prioritised packing lists including critical documents (identification, 
-insurance, medical records), irreplaceable items (photos, heirlooms), essential 
-supplies (medications, baby/pet needs), financial resources (cash, cards), and 
-appropriate clothing/equipment.
-
-5. **Who to Tell**: (record in who_to_tell)
-Establish communication protocols including emergency contacts, family notification 
-procedures, workplace requirements, neighbour arrangements, and check-in schedules 
-with designated safety contacts.
-
-6. **Backup Plan**: (record in backup_plan)
-Develop contingency options for failed evacuation including shelter-in-place procedures, 
-neighbour arrangements, community safe spaces, emergency supply requirements, and 
-communication methods when trapped.
+1. **When to Leave** (record in when_to_leave)
+2. **Where to Go** (record in where_to_go)
+3. **How to Get There** (record in how_to_get_there)
+4. **What to Take** (record in what_to_take)
+5. **Who to Tell** (record in who_to_tell)
+6. **Backup Plan** (record in backup_plan)
+
+Guidance for these areas:
+{guidance}
 
 You must analyze conversation history and existing context before each interaction to 
 avoid redundant questions and identify specific information gaps. Ask no more than 3 
@@ -73,32 +54,48 @@ Your response format must be:
 
     Context: {full_context}
     
-    {format_instructions}
     """,
-    input_variables=["full_context"],
-    partial_variables={"format_instructions": risk_analysis_parser.get_format_instructions()},
+    input_variables=["full_context", "guidance"],
 )
 
+LEAVE_GUIDANCE_QUERY = "when to leave where to go how to get there what to take who to tell backup plan"
+
 class CreateLeavePlan:
-  def __init__(self, llm):
+  def __init__(self, llm, policy=None, guidance=None):
     self.llm = llm
-    self.llm_chain = risk_analysis_prompt | llm | risk_analysis_parser
+    self.llm_chain = structured_chain(risk_analysis_prompt, llm, LeavePlan)
+    self.policy = policy or CallPolicy()
+    self.guidance = NodeGuidance(guidance or default_index(), ["general", "leave"], LEAVE_GUIDANCE_QUERY, ["leave_plan"])
+    self.speculator = Speculator(self.llm_chain, self.guidance, nodes.CREATE_LEAVE_PLAN_NODE)
     self.intro_given = False
+    self.context_builder = ContextBuilder()
 
-  def __call__(self, state: GraphState):
+  def __call__(self, state: GraphState, config: RunnableConfig = None):
     """
     Creates a leave plan using an LLM and structured parsing.
     """
+    inputs = self.prepare(state, config)
+    parsed_response = self.speculator.invoke(self.policy, config, inputs)
+    return self.finish(parsed_response)
+
+  async def acall(self, state: GraphState, config: RunnableConfig = None):
+    """
+    Async version of __call__.
+    """
+    inputs = self.prepare(state, config)
+    parsed_response = await self.speculator.ainvoke(self.policy, config, inputs)
+    return self.finish(parsed_response)
 
+  def prepare(self, state: GraphState, config: RunnableConfig = None):
     if not self.intro_given:
       print("\nLet's create you a leave plan")
       self.intro_given = True
 
     print("Creating leave plan...")
 
-    full_context = build_context(state)
-    parsed_response = self.llm_chain.invoke({"full_context": full_context})
+    return {"full_context": self.context_builder.build(state, config), "guidance": self.guidance(state)}
 
+  def finish(self, parsed_response):
     return {
       "leave_plan": parsed_response,
       "questions": parsed_response.questions
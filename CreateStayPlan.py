@@ -1,9 +1,12 @@
 from StateTypes import GraphState, StayPlan
-from context_utils import build_context
-from langchain_core.output_parsers import PydanticOutputParser
+from context_utils import ContextBuilder
+from call_policy import CallPolicy
+from structured_output import structured_chain
+from guidance_index import NodeGuidance, default_index
+from speculation import Speculator
+import nodes
 from langchain_core.prompts import PromptTemplate
-
-risk_analysis_parser = PydanticOutputParser(pydantic_object=StayPlan)
+from langchain_core.runnables import RunnableConfig
 
 risk_analysis_prompt = PromptTemplate(
     template="""
@@ -34,44 +37,16 @@ Your questioning must cover these eight mandatory areas, and you must record
 responses in the specified data structure:
 
 1. **Equipment** (record in: equipment)
-   - Current equipment inventory
-   - Required equipment not yet owned
-   - Equipment acquisition timeline and sources
-
 2. **When to Start** (record in: when_to_start)
-   - Visual fire and smoke indicators
-   - Official fire danger level thresholds
-   - Environmental cues that trigger plan activation
-
 3. **Before the Fire** (record in: before_the_fire)
-   - Preparation activities and timeline
-   - Property preparation tasks
-   - Communication protocols
-
 4. **During the Fire** (record in: during_the_fire)
-   - Active defence procedures
-   - Safety protocols while fire is present
-   - Decision-making criteria during the event
-
 5. **After the Fire** (record in: after_the_fire)
-   - Post-fire safety checks
-   - Damage assessment procedures
-   - Recovery actions
-
 6. **Who Can Help** (record in: who_can_help)
-   - Available personnel and their capabilities
-   - People requiring separate evacuation plans
-   - External support resources
-
 7. **People's Roles** (record in: peoples_roles)
-   - Specific role assignments
-   - Backup role assignments
-   - Role-specific training requirements
-
 8. **Backup Plan** (record in: backup_plan)
-   - Alternative shelter options (neighbours, fire-safe rooms)
-   - Required supplies for backup scenarios
-   - Triggers for activating backup plan
+
+Guidance for these areas:
+{guidance}
 
 You must analyse conversation history and existing context before each response to 
 identify what information you already have and what gaps remain. Never ask for 
@@ -87,32 +62,48 @@ result in a plan that fails to protect lives and property during a bushfire emer
 
       Context: {full_context}
       
-      {format_instructions}
     """,
-    input_variables=["full_context"],
-    partial_variables={"format_instructions": risk_analysis_parser.get_format_instructions()},
+    input_variables=["full_context", "guidance"],
 )
 
+STAY_GUIDANCE_QUERY = "equipment when to start before during after the fire who can help people roles backup plan"
+
 class CreateStayPlan:
-  def __init__(self, llm):
+  def __init__(self, llm, policy=None, guidance=None):
     self.llm = llm
-    self.llm_chain = risk_analysis_prompt | llm | risk_analysis_parser
+    self.llm_chain = structured_chain(risk_analysis_prompt, llm, StayPlan)
+    self.policy = policy or CallPolicy()
+    self.guidance = NodeGuidance(guidance or default_index(), ["general", "stay"], STAY_GUIDANCE_QUERY, ["stay_plan"])
+    self.speculator = Speculator(self.llm_chain, self.guidance, nodes.CREATE_STAY_PLAN_NODE)
     self.intro_given = False
+    self.context_builder = ContextBuilder()
 
-  def __call__(self, state: GraphState):
+  def __call__(self, state: GraphState, config: RunnableConfig = None):
     """
     Creates a stay and defend plan using an LLM and structured parsing.
     """
+    inputs = self.prepare(state, config)
+    parsed_response = self.speculator.invoke(self.policy, config, inputs)
+    return self.finish(parsed_response)
+
+  async def acall(self, state: GraphState, config: RunnableConfig = None):
+    """
+    Async version of __call__.
+    """
+    inputs = self.prepare(state, config)
+    parsed_response = await self.speculator.ainvoke(self.policy, config, inputs)
+    return self.finish(parsed_response)
 
+  def prepare(self, state: GraphState, config: RunnableConfig = None):
     if not self.intro_given:
       print("\nLet's create you a stay and defend plan")
       self.intro_given = True
 
     print("Creating stay and defend plan...")
 
-    full_context = build_context(state)
-    parsed_response = self.llm_chain.invoke({"full_context": full_context})
+    return {"full_context": self.context_builder.build(state, config), "guidance": self.guidance(state)}
 
+  def finish(self, parsed_response):
     return {
       "stay_plan": parsed_response,
       "questions": parsed_response.questions
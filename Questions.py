@@ -1,14 +1,17 @@
 from StateTypes import GraphState
-from context_utils import check_quit
+from langchain_core.runnables import RunnableConfig
+from responders import get_responder, ask_all
 
 class AskQuestions:
   def __init__(self, section):
       self.section = section
 
-  def __call__(self, state: GraphState):
+  def __call__(self, state: GraphState, config: RunnableConfig = None):
 
     print("\nI need a bit more information")
 
+    responder = get_responder(config)
+
     section_obj = getattr(state, self.section, None)
     
     questions_section = getattr(section_obj, 'questions', None) if section_obj else None
@@ -19,12 +22,52 @@ class AskQuestions:
         print("I have no questions to ask.")
         return
 
-    for question in questions:
-        user_input = input(f"\n{question}\nYour answer: ")
-        check_quit(user_input)
-            
-        answers[question] = user_input
+    given = ask_all(responder, questions)
+    answers.update(given)
+
+    # The answers are updated in the existing questions_section object, which is returned so
+    # they are also saved when the graph is interrupted and resumed from a checkpoint, and
+    # they are kept in the state's answers, which the model does not rewrite
+    return {self.section: section_obj, "answers": {self.section: given}}
+
+class AskCombinedQuestions:
+  """
+  Asks the questions of several assessments as one questionnaire. Only the
+  assessments that are still unclear are asked about, and a question asked by
+  more than one of them is asked once and its answer recorded for each.
+  """
+  def __init__(self, levels):
+      # section -> the field holding its level, e.g. {"risk_assessment": "risk_level"}
+      self.levels = levels
+
+  def __call__(self, state: GraphState, config: RunnableConfig = None):
+
+    print("\nI need a bit more information")
+
+    responder = get_responder(config)
+
+    combined = {}
+    asked = {}
+    for section, level in self.levels.items():
+        section_obj = getattr(state, section, None)
+        if not section_obj or str(getattr(section_obj, level)).lower() in ['low', 'high']:
+            continue
+
+        asked[section] = section_obj
+        for question in section_obj.questions.questions:
+            key = " ".join(question.lower().split())
+            combined.setdefault(key, (question, []))[1].append((section, section_obj.questions.answers))
+
+    if len(combined) == 0:
+        print("I have no questions to ask.")
+        return
+
+    answers = ask_all(responder, [question for question, answer_sets in combined.values()])
+    given = {}
+    for question, answer_sets in combined.values():
+        for section, answer_set in answer_sets:
+            answer_set[question] = answers[question]
+            given.setdefault(section, {})[question] = answers[question]
 
-    # Return empty dict to avoid overwriting - LangGraph will handle the state update
-    # The answers are already updated in the existing questions_section object
-    return {}
\ No newline at end of file
+    # As with AskQuestions, the answers are updated in place and the sections returned
+    return {**asked, "answers": given}
\ No newline at end of file
@@ -1,6 +1,14 @@
+import asyncio
+import threading
 from StateTypes import GraphState
-from context_utils import build_context
+from context_utils import ContextBuilder
+from call_policy import CallPolicy
+from plan_renderer import render_sections, plan_summary, decision
+from guidance_index import NodeGuidance, default_index
+from langchain_core.callbacks import BaseCallbackHandler, BaseCallbackManager
 from langchain_core.prompts import PromptTemplate
+from langchain_core.runnables import RunnableConfig
+from langchain_core.runnables.config import ContextThreadPoolExecutor
 
 plan_prompt = PromptTemplate(
     template="""
@@ -27,6 +35,7 @@ Risk Summary, Risk Level, Capability to Defend, Decision, and detailed action pl
 based on whether the decision is to stay and defend or to leave. The document should
 incorporate all previously gathered information from the risk assessment, defense
 capability assessment, and stay/leave decision phases.
+{guidance}
 
 It is crucial that you ensure this document is comprehensive, clearly formatted, and 
 contains all critical safety information without omission. The document must be 
@@ -49,28 +58,434 @@ Double-check that no placeholder text remains in the final document.
 
     Context: {full_context}
     """,
-    input_variables=["full_context"]
+    input_variables=["full_context", "guidance"]
 )
 
+PLAN_GUIDANCE_QUERY = "fire danger rating warnings leave early triggers backup plan"
+
+polish_prompt = PromptTemplate(
+    template="""
+You are an expert bushfire safety consultant editing one section of a bushfire survival plan.
+Rewrite the section below in clear, concise and actionable Markdown: use bullet points for lists,
+specific triggers for action rather than vague guidelines, and bold critical information.
+Keep the heading line exactly as it is. Do not add facts that are not in the section and do not
+remove any. Reply with the section only.
+
+    Section:
+    {section}
+    """,
+    input_variables=["section"]
+)
+
+section_prompt = PromptTemplate(
+    template="""
+You are an expert bushfire safety consultant writing one section of a bushfire survival plan. The
+other sections are being written at the same time, so only write this one. Turn the draft below into
+a clear, actionable section in Markdown: bullet points for lists, specific triggers for action rather
+than vague guidelines, and bold for critical information. Keep the heading line exactly as it is and
+keep every fact in the draft. Where the draft says the section is not yet decided, say what needs to
+be decided. Reply with the section only.
+
+    Plan: {summary}
+
+    Guidance:
+    {guidance}
+
+    Draft:
+    {section}
+    """,
+    input_variables=["section", "summary", "guidance"]
+)
+
+# sections of the rendered plan that are only headings, and never written by the LLM
+HEADING_SECTIONS = ("title", "plan")
+
+# guidance passages given to each section written with renderer="sections"
+SECTION_GUIDANCE_K = 2
+
+def stream_config(config, handler):
+  """
+  The node's callbacks with the stream handler added, so the streamed call is
+  still reported to the graph's own callbacks (e.g. telemetry), and the node's
+  metadata, so the call is still known to come from this node and session.
+  """
+  callbacks = (config or {}).get("callbacks")
+  if isinstance(callbacks, BaseCallbackManager):
+    callbacks = callbacks.copy()
+    callbacks.add_handler(handler)
+  else:
+    callbacks = [*(callbacks or []), handler]
+  return {"callbacks": callbacks, "metadata": (config or {}).get("metadata", {})}
+
+def get_plan_sink(config):
+  """
+  The callback that receives the plan text as it is generated, set in config["configurable"]["plan_sink"].
+  """
+  return (config or {}).get("configurable", {}).get("plan_sink")
+
+def get_plan_reset(config):
+  """
+  The callback, set in config["configurable"]["plan_reset"], that is given the plan text to show instead
+  of everything passed to the plan sink so far, when text already streamed has to be taken back.
+  """
+  return (config or {}).get("configurable", {}).get("plan_reset")
+
+class PlanStreamHandler(BaseCallbackHandler):
+  """
+  Passes plan tokens to the sink as they arrive. Only one LLM run is followed
+  at a time, so a hedged duplicate request does not interleave its output.
+
+  Text is never sent twice: when a run fails partway and is retried, the
+  retry is only passed on once it goes past what was already sent, and as
+  long as it agrees with it. finish() then sends whatever of the final text
+  is still missing, or, when it does not follow on from what was sent (the
+  retry said something else, a hedged request won, or the LLM's text is
+  given up for the rendered one), calls `reset` to take the sent text back
+  before sending the final text whole.
+  """
+  run_inline = True
+
+  def __init__(self, sink, reset=None):
+    self.sink = sink
+    self.reset = reset
+    self.run_id = None
+    self.sent = ""
+    self.received = ""
+    self.caught_up = True
+    self.diverged = False
+    self.lock = threading.Lock()
+
+  def on_llm_new_token(self, token, *, run_id, **kwargs):
+    if not isinstance(token, str) or not token:
+      return
+    with self.lock:
+      if self.run_id is None:
+        self.run_id = run_id
+      if run_id != self.run_id or self.diverged:
+        return
+      if not self.caught_up:
+        # a retry, passed on only once it is past the text already sent
+        self.received += token
+        if not (self.received.startswith(self.sent) or self.sent.startswith(self.received)):
+          self.diverged = True
+          return
+        if len(self.received) <= len(self.sent):
+          return
+        token = self.received[len(self.sent):]
+        self.caught_up = True
+      self.sent += token
+    self.sink(token)
+
+  def on_llm_error(self, error, *, run_id, **kwargs):
+    # the retry is followed from the start, against the text already sent
+    with self.lock:
+      if run_id == self.run_id:
+        self.run_id = None
+        self.received = ""
+        self.caught_up = not self.sent
+
+  def finish(self, text):
+    """
+    Sends the rest of the final text, taking back what was sent first if it does not lead up to it.
+    """
+    with self.lock:
+      sent, self.sent, self.diverged = self.sent, text, True
+    if text.startswith(sent):
+      if len(text) > len(sent):
+        self.sink(text[len(sent):])
+      return
+    if self.reset:
+      self.reset()
+    else:
+      self.sink("\n\n")
+    self.sink(text)
+
+class SectionSink:
+  """
+  Passes the sections of a plan written at the same time to the plan sink in
+  document order. The first unfinished section is passed on as it arrives and
+  the sections after it are held back until it is finished.
+  """
+  def __init__(self, sink, count, plan_reset=None):
+    self.sink = sink
+    self.plan_reset = plan_reset
+    self.buffers = [self.separator(index) for index in range(count)]
+    self.finished = [False] * count
+    self.head = 0
+    # the text passed to the sink, and where each section's text starts in it
+    self.shown = []
+    self.starts = [None] * count
+    self.lock = threading.Lock()
+
+  @staticmethod
+  def separator(index):
+    return [] if index == 0 else ["\n\n"]
+
+  def writer(self, index):
+    return lambda text: self.write(index, text)
+
+  def write(self, index, text):
+    if not self.sink:
+      return
+    with self.lock:
+      if index == self.head:
+        self.flush(index)
+        self.show(index, text)
+      else:
+        self.buffers[index].append(text)
+
+  def show(self, index, text):
+    if self.starts[index] is None:
+      self.starts[index] = len(self.shown)
+    self.shown.append(text)
+    self.sink(text)
+
+  def reset(self, index):
+    """
+    Takes back the text of an unfinished section, so it can be sent again from the start.
+    """
+    if not self.sink:
+      return
+    with self.lock:
+      start = self.starts[index]
+      self.buffers[index] = self.separator(index)
+      self.starts[index] = None
+      if start is None:
+        return
+      del self.shown[start:]
+      if self.plan_reset:
+        self.plan_reset("".join(self.shown))
+      else:
+        self.show(index, "\n\n")
+        self.starts[index] = None
+
+  def finish(self, index):
+    with self.lock:
+      self.finished[index] = True
+      while self.head < len(self.finished):
+        self.flush(self.head)
+        if not self.finished[self.head]:
+          break
+        self.head += 1
+
+  def flush(self, index):
+    if self.sink:
+      for text in self.buffers[index]:
+        self.show(index, text)
+    self.buffers[index] = []
+
 class ShowPlan:
-  def __init__(self, llm):
+  """
+  Writes the final plan document. By default it is rendered from the state's
+  assessments and plan fields without an LLM call (see plan_renderer.py), with
+  the sections in `polish` (or "all") rewritten by the LLM. With
+  renderer="sections" the LLM writes every section of the rendered plan from
+  its draft, and with renderer="llm" it writes the whole document from the
+  context in one call instead.
+
+  The sections the LLM writes are independent, so they are written at the same
+  time (up to `concurrency` at once) and put back in order, and the plan takes
+  about as long as its longest section.
+  """
+  def __init__(self, llm, policy=None, renderer="template", polish=(), guidance=None, concurrency=8):
     self.llm = llm
     self.llm_chain = plan_prompt | llm
+    self.streaming_chain = plan_prompt | llm.bind(stream=True)
+    self.polish_chain = polish_prompt | llm
+    self.polish_streaming_chain = polish_prompt | llm.bind(stream=True)
+    self.section_chain = section_prompt | llm
+    self.section_streaming_chain = section_prompt | llm.bind(stream=True)
+    self.policy = policy or CallPolicy()
+    self.renderer = renderer
+    self.polish = set(polish)
+    self.concurrency = max(1, concurrency)
+    self.guidance = NodeGuidance(guidance or default_index(), ["general", "leave", "stay"], PLAN_GUIDANCE_QUERY, ["leave_plan", "stay_plan"])
     self.intro_given = False
+    self.context_builder = ContextBuilder()
 
-  def __call__(self, state: GraphState):
+  def __call__(self, state: GraphState, config: RunnableConfig = None):
+    """
+    Create a bushfire plan based on the information gathered, streaming it to the plan sink when there is one.
     """
-    Create a bushfire plan based on the information gathered
+    if self.renderer != "llm":
+      return self.render(state, config)
+
+    inputs = self.prepare(state, config)
+    sink = get_plan_sink(config)
+    if not sink:
+      response = self.policy.invoke(self.llm_chain, inputs, config)
+      return self.finish(response)
+
+    handler = self.stream_handler(sink, config)
+    response = self.policy.invoke(self.streaming_chain, inputs, stream_config(config, handler))
+    return self.finish_stream(response, handler)
+
+  async def acall(self, state: GraphState, config: RunnableConfig = None):
     """
+    Async version of __call__.
+    """
+    if self.renderer != "llm":
+      return await self.arender(state, config)
+
+    inputs = self.prepare(state, config)
+    sink = get_plan_sink(config)
+    if not sink:
+      response = await self.policy.ainvoke(self.llm_chain, inputs, config)
+      return self.finish(response)
+
+    handler = self.stream_handler(sink, config)
+    response = await self.policy.ainvoke(self.streaming_chain, inputs, stream_config(config, handler))
+    return self.finish_stream(response, handler)
+
+  def stream_handler(self, sink, config):
+    plan_reset = get_plan_reset(config)
+    return PlanStreamHandler(sink, (lambda: plan_reset("")) if plan_reset else None)
+
+  def prepare(self, state: GraphState, config: RunnableConfig = None):
+    self.introduce()
+    return {"full_context": self.context_builder.build(state, config), "guidance": self.guidance(state)}
+
+  def introduce(self):
     print("Entering ShowPlan")
 
     if not self.intro_given:
       print("\nDrafting your plan")
       self.intro_given = True
 
-    full_context = build_context(state)
-    response = self.llm_chain.invoke({"full_context": full_context})
-    
+  def rewrites(self, key):
+    if self.renderer == "sections":
+      return key not in HEADING_SECTIONS
+    return "all" in self.polish or key in self.polish
+
+  def chains(self):
+    if self.renderer == "sections":
+      return self.section_chain, self.section_streaming_chain
+    return self.polish_chain, self.polish_streaming_chain
+
+  def section_inputs(self, state, text):
+    if self.renderer != "sections":
+      return {"section": text}
+    strategy = decision(state)
+    topics = ["general", strategy] if strategy else ["general"]
+    passages = self.guidance.index.search(text, topics, SECTION_GUIDANCE_K)
+    return {"section": text, "summary": plan_summary(state), "guidance": "\n".join(f"- {passage}" for passage in passages)}
+
+  def start_render(self, state: GraphState, config: RunnableConfig = None):
+    """
+    The rendered sections, with those already written (unchanged since the last
+    time, e.g. when another section was revised) put in, and the indexes of the
+    sections the LLM is still to write.
+    """
+    self.introduce()
+    sections = render_sections(state)
+    output = SectionSink(get_plan_sink(config), len(sections), get_plan_reset(config))
+    previous = state.final_plan.polished_sections if state.final_plan else {}
+    texts, polished, pending = [text for _, text in sections], {}, []
+    for index, (key, text) in enumerate(sections):
+      reused = previous.get(key)
+      if not self.rewrites(key) or (reused and reused[0] == text):
+        if reused and self.rewrites(key):
+          polished[key] = reused
+          texts[index] = reused[1]
+        output.write(index, texts[index])
+        output.finish(index)
+      else:
+        pending.append(index)
+    return sections, texts, polished, pending, output
+
+  def render(self, state: GraphState, config: RunnableConfig = None):
+    """
+    The plan rendered from the state, with the sections the LLM rewrites written at the same time.
+    """
+    sections, texts, polished, pending, output = self.start_render(state, config)
+    if pending:
+      # the node's run context is copied into each thread, so the calls are still traced as this node's
+      with ContextThreadPoolExecutor(max_workers=min(self.concurrency, len(pending))) as pool:
+        futures = {
+          index: pool.submit(self.write_section, index, *sections[index], self.section_inputs(state, sections[index][1]), output, config)
+          for index in pending
+        }
+      for index, future in futures.items():
+        self.put_section(sections[index], future.result(), index, texts, polished)
+    return self.finish_render(texts, polished, output.sink)
+
+  async def arender(self, state: GraphState, config: RunnableConfig = None):
+    """
+    Async version of render.
+    """
+    sections, texts, polished, pending, output = self.start_render(state, config)
+    semaphore = asyncio.Semaphore(self.concurrency)
+
+    async def write(index):
+      async with semaphore:
+        return await self.awrite_section(index, *sections[index], self.section_inputs(state, sections[index][1]), output, config)
+
+    written = await asyncio.gather(*(write(index) for index in pending))
+    for index, text in zip(pending, written):
+      self.put_section(sections[index], text, index, texts, polished)
+    return self.finish_render(texts, polished, output.sink)
+
+  def put_section(self, section, written, index, texts, polished):
+    key, text = section
+    if written is not None:
+      polished[key] = [text, written]
+      texts[index] = written
+
+  def write_section(self, index, key, text, inputs, output, config):
+    """
+    The section as written by the LLM, passed to the output as it arrives, or None when the call failed.
+    """
+    chain, streaming_chain = self.chains()
+    handler = PlanStreamHandler(output.writer(index), lambda: output.reset(index))
+    try:
+      if not output.sink:
+        return self.policy.invoke(chain, inputs, config).content.strip() or text
+      response = self.policy.invoke(streaming_chain, inputs, stream_config(config, handler))
+      return self.finish_section(response, handler, text)
+    except Exception as error:
+      return self.polish_failed(key, error, handler, text)
+    finally:
+      output.finish(index)
+
+  async def awrite_section(self, index, key, text, inputs, output, config):
+    chain, streaming_chain = self.chains()
+    handler = PlanStreamHandler(output.writer(index), lambda: output.reset(index))
+    try:
+      if not output.sink:
+        return (await self.policy.ainvoke(chain, inputs, config)).content.strip() or text
+      response = await self.policy.ainvoke(streaming_chain, inputs, stream_config(config, handler))
+      return self.finish_section(response, handler, text)
+    except Exception as error:
+      return self.polish_failed(key, error, handler, text)
+    finally:
+      output.finish(index)
+
+  def finish_section(self, response, handler, text):
+    # the streamed text may carry whitespace the stripped section does not
+    written = response.content.strip()
+    handler.finish(handler.sent if written and handler.sent.strip() == written else written or text)
+    return written or text
+
+  def polish_failed(self, key, error, handler, text):
+    # the rendered section is complete without the LLM's version, so the plan is still shown
+    print(f"\nCould not write the {key} section ({error!r}), using it as rendered")
+    handler.finish(text)
+    return None
+
+  def finish_render(self, texts, polished, sink):
+    if sink:
+      sink("\n")
+    return {
+      "final_plan": {"content": "\n\n".join(texts).split('\n'), "polished_sections": polished}
+    }
+
+  def finish_stream(self, response, handler):
+    # cached responses and models that cannot stream arrive all at once
+    handler.finish(response.content)
+    handler.sink("\n")
+    return self.finish(response)
+
+  def finish(self, response):
     # Split the markdown into lines for display
     plan_lines = response.content.split('\n')
     
@@ -1,10 +1,16 @@
 from typing import Annotated
-from langgraph.graph.message import add_messages
 from pydantic import BaseModel, Field
 from typing import Literal, Optional, List
 import json
 import operator
 
+def add_messages(left, right):
+    """
+    LangGraph's add_messages reducer, imported when first used as langgraph.graph is slow to import.
+    """
+    from langgraph.graph.message import add_messages as reduce_messages
+    return reduce_messages(left, right)
+
 RiskLevel = Literal['high', 'low', 'unclear']
 
 DefenceCapabilityLevel = Literal['high', 'low', 'unclear']
@@ -70,6 +76,26 @@ class StayPlan(BaseModel):
 
 class PlanOutput(BaseModel):
     content: List[str] = Field(description="The complete bushfire leave plan as a list of strings", default_factory=list)
+    polished_sections: dict[str, List[str]] = Field(description="Each polished section as [rendered text, polished text], so unchanged sections are not polished again", default_factory=dict)
+
+def latest(left, right):
+    return right
+
+def merge_usage(left, right):
+    return {**(left or {}), **(right or {})}
+
+def merge_answers(left, right):
+    """
+    Merges section -> {question: answer}, so every answer given stays in the state
+    even after the model leaves it out of its next version of the section.
+    """
+    merged = {section: dict(answers) for section, answers in (left or {}).items()}
+    for section, answers in (right or {}).items():
+        merged[section] = {**merged.get(section, {}), **answers}
+    return merged
+
+def add_items(left, right):
+    return [*(left or []), *(right or [])]
 
 class GraphState(BaseModel):
     # the next node to go to
@@ -77,7 +103,21 @@ class GraphState(BaseModel):
     user_motivation: Optional[str] = None
 
     # track messages generated by the LLM
-    messages: Optional[Annotated[list, add_messages]] = Field(description="A list of messages generated by the LLM.", default_factory=list)
+    messages: Annotated[Optional[list], add_messages] = Field(description="A list of messages generated by the LLM.", default_factory=list)
+
+    # running summary of the answers left out of the prompts to keep them within their token budget, see summarizer.py
+    conversation_summary: Annotated[Optional[str], latest] = None
+    # the answers in the summary, as section -> [question]; they stay in answers and the sections
+    summarized_answers: Annotated[Optional[dict], latest] = Field(description="The answers folded into the conversation summary.", default_factory=dict)
+
+    # LLM calls, tokens and seconds used by each stage (LLM node), see budget.py
+    budget_usage: Annotated[Optional[dict], merge_usage] = Field(description="LLM usage per stage.", default_factory=dict)
+
+    # every answer given, as section -> {question: answer}, see revisions.py
+    answers: Annotated[Optional[dict], merge_answers] = Field(description="The answers given to each section's questions.", default_factory=dict)
+
+    # the answers revised after the plan was finished, oldest first
+    revisions: Annotated[Optional[list], add_items] = Field(description="The revisions made to the answers.", default_factory=list)
 
     # track the overall risk assessment status
     risk_assessment: Optional[RiskAnalysis] = None
@@ -0,0 +1,190 @@
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from contextlib import redirect_stdout
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from responders import ProfileResponder
+
+class InvalidProfile(ValueError):
+    """
+    A line of the profiles file that is not a JSON object, reported as a failed profile.
+    """
+    def __init__(self, line_number, message):
+        super().__init__(f"line {line_number}: {message}")
+        self.id = str(line_number)
+
+def read_profiles(path):
+    """
+    The profiles in a JSONL file, with an InvalidProfile in place of each line that cannot be used.
+    """
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                profile = json.loads(line)
+            except ValueError as error:
+                yield InvalidProfile(line_number, f"not valid JSON ({error})")
+                continue
+            if not isinstance(profile, dict):
+                yield InvalidProfile(line_number, "not a JSON object")
+                continue
+            profile.setdefault("id", str(line_number))
+            yield profile
+
+def plan_text(state):
+    plan = state.values.get("final_plan")
+    content = plan.get("content") if isinstance(plan, dict) else getattr(plan, "content", None)
+    return "\n".join(content) if content else None
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+class BatchRunner:
+    """
+    Generates plans for many property profiles without prompting, running up
+    to `concurrency` graph threads at once and writing each result to the
+    output JSONL file as soon as it finishes.
+
+    Each profile is a JSON object. "id", "motivation" and "strategy" are taken
+    from the profile when present (otherwise the batch defaults are used) and
+    every other field is used to answer the questions asked along the way.
+    """
+    def __init__(self, graph_module, output, motivation, strategy, concurrency=4, recursion_limit=100, use_async=False):
+        self.graph_module = graph_module
+        self.output = output
+        self.motivation = motivation
+        self.strategy = strategy
+        self.concurrency = concurrency
+        self.recursion_limit = recursion_limit
+        self.use_async = use_async
+        self.write_lock = threading.Lock()
+        self.latencies = []
+        self.failures = 0
+        self.unanswered = 0
+        self.without_plan = 0
+
+    def run_profile(self, profile):
+        profile_id = str(profile.get("id"))
+        fields = {key: value for key, value in profile.items() if key not in ("id", "motivation", "strategy")}
+        responder = ProfileResponder(fields, profile.get("strategy", self.strategy))
+        config = {
+            "configurable": {
+                "thread_id": f"batch_{profile_id}_{int(time.time() * 1000)}",
+                "responder": responder,
+            },
+            # served after interactive sessions by the LLM gateway
+            "metadata": {"priority": "batch"},
+            "recursion_limit": self.recursion_limit,
+        }
+
+        motivation = profile.get("motivation", self.motivation)
+        started = time.perf_counter()
+        state = self.graph_module.run_graph(self.graph_module.initial_state(motivation), config, self.use_async)
+
+        return {
+            "id": profile_id,
+            "thread_id": config["configurable"]["thread_id"],
+            "strategy": responder.strategy,
+            "plan": plan_text(state),
+            "unanswered_questions": responder.unanswered,
+            "seconds": round(time.perf_counter() - started, 3),
+        }
+
+    def write(self, f, record):
+        with self.write_lock:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+
+    def run(self, profiles):
+        started = time.perf_counter()
+
+        with open(self.output, "a") as f, ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            futures = {}
+            for profile in profiles:
+                if isinstance(profile, InvalidProfile):
+                    self.write(f, self.failed(profile.id, profile))
+                else:
+                    futures[pool.submit(self.run_profile, profile)] = profile
+            for future in as_completed(futures):
+                profile = futures[future]
+                try:
+                    record = future.result()
+                except Exception as error:
+                    record = self.failed(str(profile.get("id")), error)
+                else:
+                    self.latencies.append(record["seconds"])
+                    self.unanswered += record["unanswered_questions"]
+                    if record["plan"] is None:
+                        self.without_plan += 1
+                self.write(f, record)
+
+        return self.summary(time.perf_counter() - started)
+
+    def failed(self, profile_id, error):
+        self.failures += 1
+        print(f"Profile {profile_id} failed: {error!r}", file=sys.stderr)
+        return {"id": profile_id, "error": repr(error)}
+
+    def summary(self, elapsed):
+        completed = len(self.latencies)
+        return {
+            "profiles": completed + self.failures,
+            "completed": completed,
+            "failed": self.failures,
+            "without_plan": self.without_plan,
+            "unanswered_questions": self.unanswered,
+            "elapsed_seconds": round(elapsed, 3),
+            "plans_per_minute": round(60 * completed / elapsed, 2) if elapsed else None,
+            "mean_seconds": round(sum(self.latencies) / completed, 3) if completed else None,
+            "p50_seconds": percentile(self.latencies, 0.5),
+            "p95_seconds": percentile(self.latencies, 0.95),
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate bushfire plans for a JSONL file of property profiles")
+    parser.add_argument("profiles", help="JSONL file with one property profile per line")
+    parser.add_argument("--output", default="plans.jsonl", help="JSONL file the plans are appended to")
+    parser.add_argument("--motivation", default="I want a bushfire plan for my registered property.", help="reason for creating the plan, unless the profile has its own")
+    parser.add_argument("--strategy", choices=["leave", "stay"], default="leave", help="plan to create, unless the profile has its own")
+    parser.add_argument("--concurrency", type=int, default=int(os.getenv("BATCH_CONCURRENCY", "4")), help="maximum number of profiles processed at once")
+    parser.add_argument("--recursion-limit", type=int, default=100, help="maximum graph steps per profile")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="run the graph with async nodes")
+    parser.add_argument("--verbose", action="store_true", help="show the output of each node")
+    args = parser.parse_args()
+
+    import main as graph_module
+
+    runner = BatchRunner(
+        graph_module,
+        args.output,
+        args.motivation,
+        args.strategy,
+        concurrency=args.concurrency,
+        recursion_limit=args.recursion_limit,
+        use_async=args.use_async,
+    )
+
+    profiles = read_profiles(args.profiles)
+    if args.verbose:
+        summary = runner.run(profiles)
+    else:
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            summary = runner.run(profiles)
+
+    checkpointer = graph_module.checkpointer
+    if hasattr(checkpointer, "stats"):
+        summary["checkpoints"] = checkpointer.stats()
+
+    graph_module.telemetry.export(graph_module.metrics_json, graph_module.metrics_prom)
+    print(json.dumps(summary, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,389 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tracemalloc
+from contextlib import redirect_stdout
+from typing import Any, Dict, Optional
+from pydantic import PrivateAttr
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from responders import ProfileResponder
+from batch import plan_text, percentile
+from telemetry import Telemetry
+from context_utils import CONTEXT_SECTIONS
+from prompt_encoding import encoding_savings
+import nodes
+
+# field that identifies each node's output schema
+SCHEMA_NODES = [
+    ("risk_level", nodes.CLASSIFY_RISK_NODE),
+    ("capability_level", nodes.ASSESS_DEFENCE_NODE),
+    ("when_to_leave", nodes.CREATE_LEAVE_PLAN_NODE),
+    ("when_to_start", nodes.CREATE_STAY_PLAN_NODE),
+]
+
+SCHEMA_MARKER = "Here is the output schema:\n```\n"
+
+QUESTIONS = {
+    nodes.CLASSIFY_RISK_NODE: ["What is your property postcode?", "Describe the vegetation near your home.", "Is your property on a slope?"],
+    nodes.ASSESS_DEFENCE_NODE: ["What water supply do you have?", "Do you have a fire pump and hoses?", "Who lives in your household?"],
+    nodes.CREATE_LEAVE_PLAN_NODE: ["Where will you go when you leave?", "How will you travel there?", "Do you have pets to take?"],
+    nodes.CREATE_STAY_PLAN_NODE: ["What water supply do you have?", "Who can help you defend the property?", "Do you have protective clothing?"],
+}
+
+PLAN_FIELDS = {
+    nodes.CREATE_LEAVE_PLAN_NODE: ["when_to_leave", "where_to_go", "how_to_get_there", "what_to_take", "who_to_tell", "backup_plan"],
+    nodes.CREATE_STAY_PLAN_NODE: ["when_to_start", "before_the_fire", "during_the_fire", "after_the_fire", "who_can_help", "peoples_roles", "backup_plan"],
+}
+
+PERSONAS = [
+    {
+        "name": "leave_quick",
+        "strategy": "leave",
+        "levels": {"risk_level": "high", "capability_level": "low"},
+        "rounds": {nodes.CLASSIFY_RISK_NODE: 1, nodes.ASSESS_DEFENCE_NODE: 0, nodes.CREATE_LEAVE_PLAN_NODE: 1},
+        "profile": {
+            "postcode": "2780",
+            "vegetation": "dense bush on two sides",
+            "slope": "steep slope to the north",
+            "household": "two adults and a child",
+            "pets": "one dog",
+            "travel": "family car via the highway",
+        },
+    },
+    {
+        "name": "leave_thorough",
+        "strategy": "leave",
+        "levels": {"risk_level": "high", "capability_level": "low"},
+        "rounds": {nodes.CLASSIFY_RISK_NODE: 3, nodes.ASSESS_DEFENCE_NODE: 2, nodes.CREATE_LEAVE_PLAN_NODE: 3},
+        "profile": {
+            "postcode": "3777",
+            "vegetation": "tall forest within 50 metres",
+            "household": "elderly couple, one uses a wheelchair",
+            "water_supply": "town water only",
+            "where_to_go": "daughter's house in the city",
+        },
+    },
+    {
+        "name": "stay_prepared",
+        "strategy": "stay",
+        "levels": {"risk_level": "low", "capability_level": "high"},
+        "rounds": {nodes.CLASSIFY_RISK_NODE: 1, nodes.ASSESS_DEFENCE_NODE: 1, nodes.CREATE_STAY_PLAN_NODE: 2},
+        "profile": {
+            "postcode": "5157",
+            "water_supply": "22,000 litre tank",
+            "fire_pump": "petrol pump with two hoses",
+            "protective_clothing": "full set for two adults",
+            "help": "neighbours on both sides",
+        },
+    },
+]
+
+def parse_latency(spec):
+    """
+    Parses a latency distribution in seconds: "0.5" (fixed), "uniform:0.2:1.0",
+    "normal:0.8:0.2" (mean, sd) or "lognormal:0.8:0.5" (median, sigma).
+    """
+    kind, _, params = str(spec).partition(":")
+    if not params:
+        value = float(kind)
+        return lambda rng: value
+
+    values = [float(value) for value in params.split(":")]
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "normal":
+        return lambda rng: max(0.0, rng.gauss(values[0], values[1]))
+    if kind == "lognormal":
+        return lambda rng: values[0] * rng.lognormvariate(0.0, values[1])
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+def schema_node(schema):
+    properties = (schema or {}).get("properties", {})
+    for field, node in SCHEMA_NODES:
+        if field in properties:
+            return node
+    return nodes.SHOW_PLAN_NODE
+
+def prompt_schema(text):
+    """
+    The output schema in a prompt's format instructions, if it has one.
+    """
+    start = text.find(SCHEMA_MARKER)
+    if start < 0:
+        return None
+    start += len(SCHEMA_MARKER)
+    return json.loads(text[start:text.index("\n```", start)])
+
+class FakeChatModel(BaseChatModel):
+    """
+    A deterministic stand-in for the Azure model. It recognises which node is
+    calling from the output schema it is asked for, answers according to the
+    current persona's script (e.g. "unclear" for the first N rounds, then the
+    persona's level) and waits for a latency drawn from a seeded distribution.
+    """
+    latency: Dict[str, str] = {}
+    seed: int = 0
+
+    _run: Any = PrivateAttr(default=None)
+    _persona: Optional[dict] = PrivateAttr(default=None)
+    _calls: dict = PrivateAttr(default_factory=dict)
+    _context_tokens: dict = PrivateAttr(default_factory=dict)
+    _model_seconds: float = PrivateAttr(default=0.0)
+
+    @property
+    def _llm_type(self):
+        return "benchmark-fake"
+
+    def reset(self, persona, run_index):
+        self._run = f"{self.seed}:{persona['name']}:{run_index}"
+        self._persona = persona
+        self._calls = {}
+        self._context_tokens = {}
+        self._model_seconds = 0.0
+
+    def respond(self, messages, tools):
+        text = "\n".join(str(message.content) for message in messages)
+        schema = tools[0]["function"]["parameters"] if tools else prompt_schema(text)
+        node = schema_node(schema)
+        round_index = self._calls.get(node, 0)
+        self._calls[node] = round_index + 1
+        prompt_tokens = len(text) // 4
+        self._context_tokens.setdefault(node, []).append(prompt_tokens)
+
+        # seeded per call so the draws do not depend on the order of concurrent calls
+        rng = random.Random(f"{self._run}:{node}:{round_index}")
+        latency = parse_latency(self.latency.get(node, self.latency.get("default", "0")))(rng)
+        self._model_seconds += latency
+
+        if node == nodes.SHOW_PLAN_NODE:
+            message = AIMessage(content=self.plan_markdown())
+        else:
+            arguments = self.structured_response(node, round_index)
+            if tools:
+                message = AIMessage(content="", tool_calls=[{"name": tools[0]["function"]["name"], "args": arguments, "id": f"call_{node}_{round_index}"}])
+            else:
+                message = AIMessage(content=json.dumps(arguments))
+
+        completion_tokens = len(str(message.content) or json.dumps(message.tool_calls)) // 4
+        message.usage_metadata = {
+            "input_tokens": prompt_tokens,
+            "output_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+        return latency, ChatResult(generations=[ChatGeneration(message=message)])
+
+    def structured_response(self, node, round_index):
+        persona = self._persona
+        more = round_index < persona["rounds"].get(node, 0)
+        questions = {"questions": [f"{question} (round {round_index + 1})" for question in QUESTIONS[node]] if more else [], "answers": {}}
+
+        if node in PLAN_FIELDS:
+            response = {field: f"The {field.replace('_', ' ')} for this household, revision {round_index + 1}." for field in PLAN_FIELDS[node]}
+            response.update(plan_status="more" if more else "done", questions=questions)
+            return response
+
+        level_field = "risk_level" if node == nodes.CLASSIFY_RISK_NODE else "capability_level"
+        return {
+            "message": f"Assessment round {round_index + 1} for {persona['name']}.",
+            "assessment": "Based on the property details provided so far.",
+            level_field: "unclear" if more else persona["levels"][level_field],
+            "questions": questions,
+        }
+
+    def plan_markdown(self):
+        sections = ["Risk Summary", "Your Decision", "Before the Fire Season", "On High Risk Days", "If Fire Threatens", "After the Fire"]
+        return "\n\n".join([f"# Bushfire Survival Plan for {self._persona['name']}"] + [f"## {section}\n- Action for {section.lower()}." for section in sections])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        latency, result = self.respond(messages, kwargs.get("tools"))
+        time.sleep(latency)
+        return result
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        latency, result = self.respond(messages, kwargs.get("tools"))
+        await asyncio.sleep(latency)
+        return result
+
+    def bind_tools(self, tools, **kwargs):
+        from langchain_core.utils.function_calling import convert_to_openai_tool
+        return self.bind(tools=[convert_to_openai_tool(tool) for tool in tools], **kwargs)
+
+def timing_sums(telemetry, name):
+    sums = {}
+    for series in telemetry.summary()["timings"].get(name, []):
+        node = series["labels"]["node"]
+        count, total = sums.get(node, (0, 0.0))
+        sums[node] = (count + series["count"], total + series["sum"])
+    return sums
+
+class Benchmark:
+    """
+    Runs each persona through the compiled graph with the fake model and
+    collects end-to-end latency, per-node overhead (node time less model time),
+    the prompt size of each round and peak memory.
+    """
+    def __init__(self, graph_module, model, iterations=5, recursion_limit=100, use_async=False, measure_memory=True):
+        self.graph_module = graph_module
+        self.model = model
+        self.iterations = iterations
+        self.recursion_limit = recursion_limit
+        self.use_async = use_async
+        self.measure_memory = measure_memory
+
+    def run_once(self, persona, run_index, telemetry=None):
+        self.model.reset(persona, run_index)
+        responder = ProfileResponder(persona["profile"], persona["strategy"])
+        config = {
+            "configurable": {"thread_id": f"benchmark_{persona['name']}_{run_index}_{time.time_ns()}", "responder": responder},
+            "recursion_limit": self.recursion_limit,
+            "callbacks": [telemetry.handler] if telemetry else [],
+        }
+        motivation = f"I am benchmarking the {persona['strategy']} plan for {persona['name']}."
+        started = time.perf_counter()
+        state = self.graph_module.run_graph(self.graph_module.initial_state(motivation), config, self.use_async)
+        elapsed = time.perf_counter() - started
+        if not plan_text(state):
+            raise RuntimeError(f"Persona {persona['name']} finished without a plan")
+        self.last_state = state
+        return elapsed
+
+    def run_persona(self, persona):
+        telemetry = Telemetry()
+        latencies = []
+        model_seconds = []
+        for run_index in range(self.iterations):
+            latencies.append(self.run_once(persona, run_index, telemetry))
+            model_seconds.append(self.model._model_seconds)
+
+        node_sums = timing_sums(telemetry, "node_seconds")
+        llm_sums = timing_sums(telemetry, "llm_seconds")
+        overhead = {
+            node: round((total - llm_sums.get(node, (0, 0.0))[1]) / count, 6)
+            for node, (count, total) in node_sums.items()
+        }
+
+        result = {
+            "end_to_end_seconds": {
+                "mean": round(sum(latencies) / len(latencies), 6),
+                "p50": round(percentile(latencies, 0.5), 6),
+                "p95": round(percentile(latencies, 0.95), 6),
+            },
+            "model_seconds_mean": round(sum(model_seconds) / len(model_seconds), 6),
+            "llm_calls": dict(self.model._calls),
+            "node_overhead_seconds": overhead,
+            "context_tokens_per_round": dict(self.model._context_tokens),
+            "section_tokens": {
+                section: savings["compact_tokens"]
+                for section, savings in encoding_savings(self.last_state.values, CONTEXT_SECTIONS).items()
+            },
+        }
+
+        if self.measure_memory:
+            # measured on a separate run as tracing allocations slows everything down
+            tracemalloc.start()
+            try:
+                self.run_once(persona, self.iterations)
+                current, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            result["peak_memory_kb"] = round(peak / 1024, 1)
+            result["retained_memory_kb"] = round(current / 1024, 1)
+
+        return result
+
+    def run(self, personas):
+        return {persona["name"]: self.run_persona(persona) for persona in personas}
+
+def flatten(values, prefix=""):
+    flat = {}
+    for key, value in values.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{name}."))
+        elif isinstance(value, list):
+            flat.update(flatten(dict(enumerate(value)), f"{name}."))
+        elif isinstance(value, (int, float)):
+            flat[name] = value
+    return flat
+
+def compare(baseline, results, tolerance=0.1, min_delta=0.001):
+    """
+    Metrics that grew by more than `tolerance` (and by at least `min_delta`) since the baseline.
+    """
+    old = flatten(baseline["personas"])
+    new = flatten(results["personas"])
+    regressions = []
+    for name in sorted(old.keys() & new.keys()):
+        delta = new[name] - old[name]
+        if delta > min_delta and delta > abs(old[name]) * tolerance:
+            change = f"+{100 * delta / old[name]:.0f}%" if old[name] else "new"
+            regressions.append({"metric": name, "baseline": old[name], "current": new[name], "change": change})
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the bushfire planning graph offline with a fake model and scripted personas")
+    parser.add_argument("--output", default="benchmark.json", help="JSON file the results are written to")
+    parser.add_argument("--compare", metavar="BASELINE", help="compare the results with an earlier results file and exit with status 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="relative increase that counts as a regression (default: 0.1)")
+    parser.add_argument("--min-delta", type=float, default=0.005, help="smallest absolute increase that counts as a regression, so millisecond jitter is ignored (default: 0.005)")
+    parser.add_argument("--iterations", type=int, default=5, help="runs per persona")
+    parser.add_argument("--latency", default="0", help="model latency in seconds, e.g. 0.5, uniform:0.2:1.0, normal:0.8:0.2 or lognormal:0.8:0.5")
+    parser.add_argument("--node-latency", default="", help="per-node latency, e.g. show_plan_node=lognormal:4:0.3,classify_risk_node=1.5")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the latency distributions")
+    parser.add_argument("--persona", action="append", choices=[persona["name"] for persona in PERSONAS], help="persona to run (default: all)")
+    parser.add_argument("--layout", choices=["sequential", "parallel"], help="graph layout (default: GRAPH_LAYOUT)")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="run the graph with async nodes")
+    parser.add_argument("--no-memory", dest="measure_memory", action="store_false", help="skip the memory measurement run")
+    args = parser.parse_args()
+
+    # the Azure model is only built when first used, so it is never created here
+    import main as graph_module
+
+    latency = graph_module.parse_node_settings(args.node_latency)
+    latency["default"] = args.latency
+    model = FakeChatModel(latency=latency, seed=args.seed)
+    graph_module.use_llm(model)
+    if args.layout and args.layout != graph_module.graph_layout:
+        graph_module.use_layout(args.layout)
+
+    personas = [persona for persona in PERSONAS if not args.persona or persona["name"] in args.persona]
+    benchmark = Benchmark(graph_module, model, args.iterations, use_async=args.use_async, measure_memory=args.measure_memory)
+
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        personas_results = benchmark.run(personas)
+
+    results = {
+        "settings": {
+            "iterations": args.iterations,
+            "latency": latency,
+            "seed": args.seed,
+            "layout": graph_module.graph_layout,
+            "async": args.use_async,
+            "python": sys.version.split()[0],
+        },
+        "personas": personas_results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("settings") != results["settings"]:
+            print(f"Note: the baseline was run with different settings: {baseline.get('settings')}", file=sys.stderr)
+        regressions = compare(baseline, results, args.tolerance, args.min_delta)
+        for regression in regressions:
+            print(f"Regression: {regression['metric']} {regression['baseline']} -> {regression['current']} ({regression['change']})", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print("No regressions against the baseline", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
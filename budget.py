@@ -0,0 +1,101 @@
+import threading
+from langchain_core.callbacks import BaseCallbackHandler
+from speculation import get_thread_id
+
+class BudgetTracker(BaseCallbackHandler):
+    """
+    Callback handler, attached when the graph is invoked, that adds up the
+    tokens used by each graph thread's LLM calls per node.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.runs = {}
+        self.tokens = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, **kwargs):
+        metadata = metadata or {}
+        node = metadata.get("langgraph_node")
+        if node:
+            with self.lock:
+                self.runs[run_id] = (metadata.get("thread_id"), node)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        with self.lock:
+            key = self.runs.pop(run_id, None)
+        if not key:
+            return
+        total = 0
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                if usage:
+                    total += usage.get("total_tokens", 0)
+        with self.lock:
+            self.tokens[key] = self.tokens.get(key, 0) + total
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        with self.lock:
+            self.runs.pop(run_id, None)
+
+    def take(self, thread_id, node):
+        with self.lock:
+            return self.tokens.pop((thread_id, node), 0)
+
+class SessionBudget:
+    """
+    Bounds what a session can spend on LLM calls. Usage is kept per stage (LLM
+    node) in state.budget_usage, so it survives checkpoints and resumes:
+    calls, tokens and the seconds spent in the node.
+
+    A stage may be called up to `stage_calls` times (per node overrides in
+    `node_calls`), and the session as a whole up to `max_calls` calls,
+    `max_tokens` tokens and `max_seconds` seconds of LLM node time. Once a limit
+    is reached, the stage's result is forced to converge using `convergence`,
+    node -> (section, field, forced value, settled values), e.g. an "unclear"
+    risk level becomes "high", so no loop can keep calling the model.
+    """
+    def __init__(self, convergence, stage_calls=None, node_calls=None, max_calls=None, max_tokens=None, max_seconds=None):
+        self.convergence = convergence
+        self.stage_calls = stage_calls
+        self.node_calls = node_calls or {}
+        self.max_calls = max_calls
+        self.max_tokens = max_tokens
+        self.max_seconds = max_seconds
+        self.tracker = BudgetTracker()
+
+    def exhausted(self, usage, node):
+        """
+        Why the budget for the node is used up, or None if it is not.
+        """
+        stage = usage.get(node, {})
+        stage_limit = self.node_calls.get(node, self.stage_calls)
+        if stage_limit and stage.get("calls", 0) >= stage_limit:
+            return f"{stage['calls']} calls for this stage"
+
+        for key, limit, unit in [("calls", self.max_calls, "calls"), ("tokens", self.max_tokens, "tokens"), ("seconds", self.max_seconds, "seconds")]:
+            total = sum(stage_usage.get(key, 0) for stage_usage in usage.values())
+            if limit and total >= limit:
+                return f"{round(total, 1)} {unit} this session"
+        return None
+
+    def settle(self, node, state, config, result, seconds):
+        """
+        Records a call of the node and forces its result to converge when the budget is used up.
+        """
+        usage = dict(state.budget_usage or {})
+        stage = dict(usage.get(node, {"calls": 0, "tokens": 0, "seconds": 0.0}))
+        stage["calls"] += 1
+        stage["tokens"] += self.tracker.take(get_thread_id(config), node)
+        stage["seconds"] = round(stage["seconds"] + seconds, 3)
+        usage[node] = stage
+
+        reason = self.exhausted(usage, node)
+        if reason and node in self.convergence:
+            section, field, forced_value, settled = self.convergence[node]
+            value = getattr(result.get(section), field, None)
+            if value is None or value.lower() not in settled:
+                print(f"\nThe budget for this step is used up ({reason}), continuing with {field} '{forced_value}'")
+                setattr(result[section], field, forced_value)
+                stage["forced"] = f"{field} {value} -> {forced_value} ({reason})"
+
+        return {**result, "budget_usage": {node: stage}}
@@ -0,0 +1,160 @@
+import asyncio
+import contextvars
+import random
+import threading
+import time
+from concurrent.futures import Future, FIRST_COMPLETED, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+# errors worth another attempt: timeouts, dropped connections, rate limits and server errors, named
+# so the OpenAI and httpx clients need not be imported (openai.APITimeoutError, httpx.TransportError, ...)
+RETRYABLE_ERRORS = {"APIConnectionError", "APITimeoutError", "RateLimitError", "InternalServerError", "TransportError", "TimeoutException"}
+RETRYABLE_STATUS = {408, 409, 429}
+
+def is_retryable(error):
+    """
+    Whether a failed call may succeed if made again. Errors in the request or
+    the answer (e.g. validation errors, an exhausted budget) fail straight away.
+    """
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    if any(cls.__name__ in RETRYABLE_ERRORS for cls in type(error).__mro__):
+        return True
+    status = getattr(error, "status_code", None)
+    return isinstance(status, int) and (status in RETRYABLE_STATUS or status >= 500)
+
+class CallPolicy:
+    """
+    How a node calls its LLM chain: a timeout per attempt, an overall deadline
+    for all of the node's attempts, bounded retries of transient errors with
+    exponential backoff and, optionally, a hedged duplicate request when the
+    first has not answered within hedge_after seconds.
+
+    The default policy makes a single call with no deadline.
+    """
+    def __init__(self, timeout=None, retries=0, backoff=1.0, max_backoff=30.0, hedge_after=None, deadline=None):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge_after = hedge_after
+        self.deadline = deadline
+
+    def delay(self, attempt):
+        # full jitter, so retries from many sessions do not arrive together
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def attempt_timeout(self, deadline):
+        """
+        The time the next attempt may take, within both its own timeout and what is left of the deadline.
+        """
+        left = remaining(deadline)
+        if left is not None and left <= 0:
+            raise FutureTimeoutError(f"LLM call did not complete within its deadline of {self.deadline} seconds")
+        if self.timeout is None or left is None:
+            return left if self.timeout is None else self.timeout
+        return min(self.timeout, left)
+
+    def gives_up(self, error, attempt, deadline):
+        return attempt == self.retries or not is_retryable(error) or expired(deadline)
+
+    def invoke(self, chain, inputs, config=None):
+        deadline = None if self.deadline is None else time.monotonic() + self.deadline
+        for attempt in range(self.retries + 1):
+            try:
+                return self._invoke_attempt(chain, inputs, config, self.attempt_timeout(deadline))
+            except Exception as error:
+                if self.gives_up(error, attempt, deadline):
+                    raise
+                print(f"LLM call failed ({error!r}), retrying...")
+                time.sleep(remaining(deadline, self.delay(attempt)))
+
+    async def ainvoke(self, chain, inputs, config=None):
+        deadline = None if self.deadline is None else time.monotonic() + self.deadline
+        for attempt in range(self.retries + 1):
+            try:
+                return await asyncio.wait_for(self._ainvoke_attempt(chain, inputs, config), self.attempt_timeout(deadline))
+            except Exception as error:
+                if self.gives_up(error, attempt, deadline):
+                    raise
+                print(f"LLM call failed ({error!r}), retrying...")
+                await asyncio.sleep(remaining(deadline, self.delay(attempt)))
+
+    def _invoke_attempt(self, chain, inputs, config, timeout):
+        if timeout is None and not self.hedge_after:
+            return chain.invoke(inputs, config)
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        futures = {submit(chain.invoke, inputs, config)}
+
+        if self.hedge_after:
+            done, _ = wait(futures, timeout=remaining(deadline, self.hedge_after))
+            if not done and not expired(deadline):
+                futures.add(submit(chain.invoke, inputs, config))
+
+        error = None
+        while futures:
+            done, futures = wait(futures, timeout=remaining(deadline), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+
+        if error is not None and not futures:
+            raise error
+        raise FutureTimeoutError(f"LLM call did not complete within {timeout} seconds")
+
+    async def _ainvoke_attempt(self, chain, inputs, config):
+        if not self.hedge_after:
+            return await chain.ainvoke(inputs, config)
+
+        tasks = {asyncio.ensure_future(chain.ainvoke(inputs, config))}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_after)
+            if not done:
+                tasks.add(asyncio.ensure_future(chain.ainvoke(inputs, config)))
+
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+def submit(fn, *args):
+    """
+    Runs the call on a thread of its own, with the caller's context so LangChain
+    callbacks and config still apply. A call given up on (timed out, or beaten
+    by its hedge) cannot be stopped once it is running, but it only holds its
+    own thread, which ends with the HTTP client's request timeout, rather than
+    a worker of a shared pool that new calls wait for.
+    """
+    future = Future()
+    context = contextvars.copy_context()
+
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(context.run(fn, *args))
+        except BaseException as error:
+            future.set_exception(error)
+
+    threading.Thread(target=run, name="llm-call", daemon=True).start()
+    return future
+
+def remaining(deadline, limit=None):
+    if deadline is None:
+        return limit
+    left = max(0.0, deadline - time.monotonic())
+    return left if limit is None else min(left, limit)
+
+def expired(deadline):
+    return deadline is not None and time.monotonic() >= deadline
@@ -0,0 +1,375 @@
+import os
+import re
+import json
+import gzip
+import time
+import asyncio
+import threading
+from typing import Any
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessageChunk, message_chunk_to_message, message_to_dict, messages_from_dict
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.runnables import Runnable
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from llm_cache import hash_text, normalize_prompt
+
+CASSETTE_EXTENSION = ".jsonl.gz"
+
+# characters of a replayed plan per streamed chunk
+REPLAY_CHUNK_SIZE = 40
+
+class CassetteMiss(LookupError):
+    pass
+
+def call_context(run_manager):
+    """
+    The session (thread id) and graph node an LLM call was made from, when it was made in a graph
+    run, and whether it was a speculative call for the node (see speculation.py).
+    """
+    metadata = getattr(run_manager, "metadata", None) or {}
+    return metadata.get("thread_id"), metadata.get("langgraph_node"), bool(metadata.get("speculative"))
+
+def tool_names(kwargs):
+    return sorted(tool.get("function", {}).get("name", "") for tool in kwargs.get("tools") or [])
+
+def prompt_key(messages, kwargs):
+    # the tools are keyed by name only, as each model formats their schemas its own way
+    prompt = json.dumps([[message.type, message.content] for message in messages] + [tool_names(kwargs)])
+    return hash_text(normalize_prompt(prompt))
+
+def cassette_name(thread_id):
+    return re.sub(r"[^\w.-]", "_", str(thread_id or "no_thread")) + CASSETTE_EXTENSION
+
+def read_cassette(path):
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+class CassetteRecorder:
+    """
+    Writes every LLM exchange to `<directory>/<thread id>.jsonl.gz`, one
+    gzipped JSON line per call: the node, the prompt and its key, the response,
+    the latency in seconds and the token usage, with speculative calls marked.
+    What the user said is written to the same cassette, as lines with a
+    "human" kind: the motivation the session started with, and each set of
+    answers and each choice. Each line is appended as a gzip member of its
+    own, so a cassette stays readable while it is written.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, thread_id):
+        return os.path.join(self.directory, cassette_name(thread_id))
+
+    def write(self, thread_id, entry):
+        line = json.dumps(entry, separators=(",", ":")) + "\n"
+        with self.lock:
+            with gzip.open(self.path(thread_id), "at", encoding="utf-8") as f:
+                f.write(line)
+
+    def record(self, run_manager, messages, kwargs, message, latency):
+        thread_id, node, speculative = call_context(run_manager)
+        entry = {
+            "node": node,
+            "key": prompt_key(messages, kwargs),
+            "prompt": [[sent.type, sent.content] for sent in messages],
+            "tools": tool_names(kwargs),
+            "response": message_to_dict(message),
+            "latency": round(latency, 3),
+            "usage": getattr(message, "usage_metadata", None),
+            "recorded_at": round(time.time(), 3),
+        }
+        if speculative:
+            entry["speculative"] = True
+        self.write(thread_id, entry)
+
+    def record_human(self, thread_id, kind, request, answer):
+        """
+        Records what the user gave: kind is "motivation", "questions" (request
+        {"questions": [...]}, answer question -> answer) or "choice" (request
+        {"choice": ..., "options": [...]}, answer the option chosen).
+        """
+        self.write(thread_id, {"human": kind, "request": request, "answer": answer, "recorded_at": round(time.time(), 3)})
+
+class RecordingResponder:
+    """
+    Records the answers and choices the wrapped responder gets for a thread.
+    An interrupt (see responders.InterruptResponder) is recorded once the
+    graph is resumed with its answer.
+    """
+    def __init__(self, responder, recorder, thread_id):
+        self.responder = responder
+        self.recorder = recorder
+        self.thread_id = thread_id
+
+    def ask_all(self, questions):
+        from responders import ask_all
+        answers = ask_all(self.responder, questions)
+        self.recorder.record_human(self.thread_id, "questions", {"questions": list(questions)}, answers)
+        return answers
+
+    def ask(self, question):
+        return self.ask_all([question])[question]
+
+    def choose(self, choice, options):
+        option = self.responder.choose(choice, options)
+        self.recorder.record_human(self.thread_id, "choice", {"choice": choice, "options": list(options)}, option)
+        return option
+
+class CassetteLibrary:
+    """
+    The recorded exchanges of one cassette, or of every cassette in a
+    directory, to be served in place of the model.
+
+    A call gets the response recorded for the same prompt, and repeats of a
+    prompt get its recorded responses in turn. A prompt that was never
+    recorded (e.g. after a prompt change) gets the next unserved response of
+    its node, from the session's own cassette when the library has it.
+    Speculative calls are served separately from the node's own calls, so
+    they never take responses recorded for the other.
+    """
+    def __init__(self, path):
+        paths = [path] if os.path.isfile(path) else [
+            os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith(CASSETTE_EXTENSION)
+        ]
+        self.cassettes = {}
+        self.humans = {}
+        for path in paths:
+            entries = read_cassette(path)
+            self.cassettes[os.path.basename(path)] = [entry for entry in entries if "human" not in entry]
+            self.humans[os.path.basename(path)] = [entry for entry in entries if "human" in entry]
+        self.by_key = {}
+        self.by_node = {}
+        for entries in self.cassettes.values():
+            for entry in entries:
+                self.by_key.setdefault(entry["key"], []).append(entry)
+                self.by_node.setdefault((entry["node"], bool(entry.get("speculative"))), []).append(entry)
+        self.served = {}
+        self.lock = threading.Lock()
+
+    def stats(self):
+        return {
+            "cassettes": len(self.cassettes),
+            "exchanges": sum(len(entries) for entries in self.cassettes.values()),
+            "human_inputs": sum(len(entries) for entries in self.humans.values()),
+        }
+
+    def serve(self, thread_id, counter, entries):
+        # the next entry for this session, staying on the last once all have been served
+        served = self.served.get((thread_id, counter), 0)
+        self.served[(thread_id, counter)] = served + 1
+        return entries[min(served, len(entries) - 1)]
+
+    def find(self, thread_id, node, key, speculative=False):
+        with self.lock:
+            if key in self.by_key:
+                return self.serve(thread_id, (speculative, key), self.by_key[key])
+            own = self.cassettes.get(cassette_name(thread_id))
+            if own:
+                entries = [entry for entry in own if entry["node"] == node and bool(entry.get("speculative")) == speculative]
+            else:
+                entries = self.by_node.get((node, speculative))
+            if node and entries:
+                return self.serve(thread_id, (speculative, "node", node), entries)
+        raise CassetteMiss(f"No recorded response for {node or 'a call outside the graph'} in the cassettes")
+
+def recorded_message(entry):
+    return messages_from_dict([entry["response"]])[0]
+
+class RecordingChatModel(BaseChatModel):
+    """
+    A chat model that records each call to the wrapped model with a CassetteRecorder.
+    Cache hits never reach the model, so they are not recorded.
+    """
+    model: BaseChatModel
+    recorder: Any
+
+    @property
+    def _llm_type(self):
+        return self.model._llm_type
+
+    @property
+    def _identifying_params(self):
+        return self.model._identifying_params
+
+    def _get_ls_params(self, stop=None, **kwargs):
+        return self.model._get_ls_params(stop=stop, **kwargs)
+
+    def bind_tools(self, tools, **kwargs) -> Runnable:
+        return self.bind(**self.model.bind_tools(tools, **kwargs).kwargs)
+
+    def _should_stream(self, *, async_api, run_manager=None, **kwargs):
+        # streams only when the wrapped model would
+        return self.model._should_stream(async_api=async_api, run_manager=run_manager, **kwargs)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        started = time.monotonic()
+        result = self.model._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        self.recorder.record(run_manager, messages, kwargs, result.generations[0].message, time.monotonic() - started)
+        return result
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        started = time.monotonic()
+        result = await self.model._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        self.recorder.record(run_manager, messages, kwargs, result.generations[0].message, time.monotonic() - started)
+        return result
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        started = time.monotonic()
+        message = None
+        for chunk in self.model._stream(messages, stop=stop, run_manager=run_manager, **kwargs):
+            message = chunk.message if message is None else message + chunk.message
+            yield chunk
+        if message is not None:
+            self.recorder.record(run_manager, messages, kwargs, message_chunk_to_message(message), time.monotonic() - started)
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        started = time.monotonic()
+        message = None
+        async for chunk in self.model._astream(messages, stop=stop, run_manager=run_manager, **kwargs):
+            message = chunk.message if message is None else message + chunk.message
+            yield chunk
+        if message is not None:
+            self.recorder.record(run_manager, messages, kwargs, message_chunk_to_message(message), time.monotonic() - started)
+
+class ReplayChatModel(BaseChatModel):
+    """
+    A chat model that answers from a CassetteLibrary instead of calling a
+    deployment. Each answer takes its recorded latency times `latency_scale`
+    (by default no time at all), and streamed answers are served in chunks
+    spread over that time.
+    """
+    library: Any
+    latency_scale: float = 0.0
+
+    @property
+    def _llm_type(self):
+        return "cassette"
+
+    @property
+    def _identifying_params(self):
+        return {"latency_scale": self.latency_scale}
+
+    def bind_tools(self, tools, **kwargs) -> Runnable:
+        return self.bind(tools=[convert_to_openai_tool(tool) for tool in tools], **kwargs)
+
+    def find(self, messages, run_manager, kwargs):
+        thread_id, node, speculative = call_context(run_manager)
+        return self.library.find(thread_id, node, prompt_key(messages, kwargs), speculative)
+
+    def delay(self, entry):
+        return (entry.get("latency") or 0.0) * self.latency_scale
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        entry = self.find(messages, run_manager, kwargs)
+        if self.delay(entry):
+            time.sleep(self.delay(entry))
+        return ChatResult(generations=[ChatGeneration(message=recorded_message(entry))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        entry = self.find(messages, run_manager, kwargs)
+        if self.delay(entry):
+            await asyncio.sleep(self.delay(entry))
+        return ChatResult(generations=[ChatGeneration(message=recorded_message(entry))])
+
+    def chunks(self, entry):
+        message = recorded_message(entry)
+        content = message.content if isinstance(message.content, str) and not message.tool_calls else None
+        if content is None:
+            # tool calls are served whole
+            yield ChatGenerationChunk(message=AIMessageChunk(**message.model_dump(exclude={"type"})))
+            return
+        pieces = [content[i:i + REPLAY_CHUNK_SIZE] for i in range(0, len(content), REPLAY_CHUNK_SIZE)] or [""]
+        for i, piece in enumerate(pieces):
+            last = i == len(pieces) - 1
+            yield ChatGenerationChunk(message=AIMessageChunk(
+                content=piece,
+                id=message.id,
+                usage_metadata=message.usage_metadata if last else None,
+                response_metadata=message.response_metadata if last else {},
+            ))
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        entry = self.find(messages, run_manager, kwargs)
+        chunks = list(self.chunks(entry))
+        for chunk in chunks:
+            if self.delay(entry):
+                time.sleep(self.delay(entry) / len(chunks))
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        entry = self.find(messages, run_manager, kwargs)
+        chunks = list(self.chunks(entry))
+        for chunk in chunks:
+            if self.delay(entry):
+                await asyncio.sleep(self.delay(entry) / len(chunks))
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+class HumanReplay:
+    """
+    The answers and choices recorded in a cassette, given back in their place:
+    each question gets the next answer recorded for the same question, and
+    each choice the next option recorded for the same choice. A question asked
+    that was never recorded gets "unknown", and a choice the first option.
+    """
+    def __init__(self, entries):
+        self.answers = {}
+        self.choices = {}
+        self.motivation = None
+        for entry in entries:
+            if entry["human"] == "motivation":
+                self.motivation = entry["answer"]
+            elif entry["human"] == "questions":
+                for question, answer in entry["answer"].items():
+                    self.answers.setdefault(question, []).append(answer)
+            elif entry["human"] == "choice":
+                self.choices.setdefault(entry["request"]["choice"], []).append(entry["answer"])
+
+    def resume(self, request):
+        """
+        The value to resume an interrupt (see responders.InterruptResponder) with.
+        """
+        if request["type"] == "choice":
+            recorded = self.choices.get(request["choice"])
+            return recorded.pop(0) if recorded else request["options"][0]
+        return {question: (self.answers.get(question) or ["unknown"]).pop(0) for question in request["questions"]}
+
+def replay_session(graph_module, path, use_async=False):
+    """
+    Replays the session recorded in a cassette: the graph starts from the
+    recorded motivation and each interrupt is resumed with the answer the user
+    gave, as the service does. The thread id is the cassette's, so with
+    LLM_REPLAY set the model is served from the same cassette. Returns the
+    final state.
+    """
+    from langgraph.types import Command
+    from responders import interrupt_responder
+
+    replay = HumanReplay([entry for entry in read_cassette(path) if "human" in entry])
+    thread_id = os.path.basename(path)[:-len(CASSETTE_EXTENSION)]
+    config = graph_module.with_callbacks({"configurable": {"thread_id": thread_id, "responder": interrupt_responder}})
+    graph = graph_module.get_graph()
+
+    inputs = graph_module.initial_state(replay.motivation or "")
+    try:
+        while True:
+            with graph_module.running(config):
+                if use_async:
+                    asyncio.run(graph.ainvoke(inputs, config))
+                else:
+                    graph.invoke(inputs, config)
+            snapshot = graph.get_state(config)
+            interrupts = [interrupt.value for task in snapshot.tasks for interrupt in task.interrupts]
+            if interrupts:
+                inputs = Command(resume=replay.resume(interrupts[0]))
+            elif snapshot.next:
+                inputs = None
+            else:
+                return snapshot
+    finally:
+        graph_module.end_speculation(thread_id)
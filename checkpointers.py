@@ -0,0 +1,271 @@
+import time
+import asyncio
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from langgraph.checkpoint.memory import MemorySaver
+from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+from langgraph.checkpoint.sqlite import SqliteSaver
+
+# the Pydantic models stored in GraphState, which checkpoints may deserialize
+STATE_TYPES = ["Questions", "Options", "RiskAnalysis", "DefenceAnalysis", "LeavePlan", "StayPlan", "PlanOutput", "GraphState"]
+
+def state_serializer():
+    return JsonPlusSerializer(allowed_msgpack_modules=[("StateTypes", name) for name in STATE_TYPES])
+
+class CompactingSqliteSaver(SqliteSaver):
+    """
+    A SQLite checkpointer that keeps only the latest `keep` checkpoints (and
+    their pending writes) for each thread, so the database stays the same
+    size however long a session runs.
+
+    The async methods (used by --async runs) do the same work on a worker
+    thread, so the one connection also serves the sync calls (e.g. get_state)
+    made from the event loop's thread.
+    """
+    def __init__(self, conn, keep=10, serde=None):
+        super().__init__(conn, serde=serde)
+        self.keep = keep
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        saved_config = super().put(config, checkpoint, metadata, new_versions)
+        if self.keep:
+            self.compact(saved_config["configurable"]["thread_id"], saved_config["configurable"]["checkpoint_ns"])
+        return saved_config
+
+    async def aget_tuple(self, config):
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(self, config, *, filter=None, before=None, limit=None):
+        checkpoints = await asyncio.to_thread(lambda: [*self.list(config, filter=filter, before=before, limit=limit)])
+        for checkpoint in checkpoints:
+            yield checkpoint
+
+    async def aput(self, config, checkpoint, metadata, new_versions):
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config, writes, task_id, task_path=""):
+        return await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id):
+        return await asyncio.to_thread(self.delete_thread, thread_id)
+
+    def compact(self, thread_id, checkpoint_ns=""):
+        # checkpoint ids are time ordered, so the largest ids are the latest super-steps
+        with self.cursor() as cur:
+            for table in ("checkpoints", "writes"):
+                cur.execute(
+                    f"""DELETE FROM {table} WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id NOT IN (
+                        SELECT checkpoint_id FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ?
+                        ORDER BY checkpoint_id DESC LIMIT ?
+                    )""",
+                    (str(thread_id), checkpoint_ns, str(thread_id), checkpoint_ns, self.keep),
+                )
+
+class BoundedMemorySaver(MemorySaver):
+    """
+    An in-memory checkpointer for many concurrent sessions. Only the latest
+    `keep` checkpoints of each thread are kept (0 keeps them all), threads idle
+    for longer than `ttl` seconds are evicted, and once the checkpoints take
+    more than `max_bytes` the least recently used threads are evicted. A thread
+    is never evicted while a graph run holds it (see running()), but one
+    waiting for its user's answer is idle, and expires like any other.
+
+    Channel values that serialize to the same bytes (e.g. an unchanged section
+    written again, or the same defaults in every session) are stored once and
+    shared between checkpoints and threads.
+    """
+    def __init__(self, keep=10, ttl=None, max_bytes=None, serde=None):
+        super().__init__(serde=serde)
+        self.keep = keep
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        # thread_id -> last used, least recently used first
+        self.used = OrderedDict()
+        # (thread_id, checkpoint_ns) -> {checkpoint_id: channel versions}, and the blob keys written
+        self.versions = {}
+        self.blob_keys = {}
+        # serialized value -> [shared value, references]
+        self.shared = {}
+        self.thread_bytes = {}
+        # thread_id -> graph runs holding the thread
+        self.active = {}
+        self.evicted = {"ttl": 0, "memory": 0}
+
+    @contextmanager
+    def running(self, thread_id):
+        """
+        Holds the thread while a graph run executes its steps, so it is not evicted between checkpoints.
+        """
+        with self.lock:
+            self.active[thread_id] = self.active.get(thread_id, 0) + 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.active[thread_id] -= 1
+                if not self.active[thread_id]:
+                    del self.active[thread_id]
+                # used until the run let go of it, so its idle time starts now
+                if thread_id in self.used:
+                    self.touch(thread_id)
+
+    def touch(self, thread_id):
+        self.used[thread_id] = time.monotonic()
+        self.used.move_to_end(thread_id)
+
+    def share(self, value):
+        entry = self.shared.setdefault(value, [value, 0])
+        entry[1] += 1
+        return entry[0]
+
+    def release(self, value):
+        entry = self.shared.get(value)
+        if entry:
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del self.shared[value]
+
+    def get_tuple(self, config):
+        thread_id = config["configurable"]["thread_id"]
+        with self.lock:
+            # the base class would add empty entries for an unknown thread
+            if thread_id not in self.storage:
+                return None
+            self.touch(thread_id)
+            return super().get_tuple(config)
+
+    def list(self, config, *, filter=None, before=None, limit=None):
+        with self.lock:
+            checkpoints = [*super().list(config, filter=filter, before=before, limit=limit)]
+        yield from checkpoints
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"]["checkpoint_ns"]
+        key = (thread_id, checkpoint_ns)
+        with self.lock:
+            blob_keys = self.blob_keys.setdefault(key, set())
+            for channel, version in new_versions.items():
+                if (channel, version) in blob_keys:
+                    self.release(self.blobs[(thread_id, checkpoint_ns, channel, version)])
+
+            saved_config = super().put(config, checkpoint, metadata, new_versions)
+
+            for channel, version in new_versions.items():
+                blob_key = (thread_id, checkpoint_ns, channel, version)
+                self.blobs[blob_key] = self.share(self.blobs[blob_key])
+                blob_keys.add((channel, version))
+            self.versions.setdefault(key, {})[checkpoint["id"]] = dict(checkpoint["channel_versions"])
+
+            if self.keep:
+                self.compact(thread_id, checkpoint_ns)
+            self.touch(thread_id)
+            self.thread_bytes[thread_id] = self.measure(thread_id)
+            self.evict(thread_id)
+            return saved_config
+
+    def put_writes(self, config, writes, task_id, task_path=""):
+        thread_id = config["configurable"]["thread_id"]
+        with self.lock:
+            super().put_writes(config, writes, task_id, task_path)
+            self.thread_bytes[thread_id] = self.measure(thread_id)
+
+    def compact(self, thread_id, checkpoint_ns=""):
+        """
+        Removes all but the latest `keep` checkpoints of the thread, with their
+        pending writes and the channel values only they refer to.
+        """
+        key = (thread_id, checkpoint_ns)
+        checkpoints = self.storage[thread_id][checkpoint_ns]
+        versions = self.versions.get(key, {})
+        # checkpoint ids are time ordered, so the largest ids are the latest super-steps
+        for checkpoint_id in sorted(checkpoints)[:-self.keep]:
+            del checkpoints[checkpoint_id]
+            versions.pop(checkpoint_id, None)
+            self.writes.pop((thread_id, checkpoint_ns, checkpoint_id), None)
+
+        referenced = {(channel, version) for channel_versions in versions.values() for channel, version in channel_versions.items()}
+        blob_keys = self.blob_keys.get(key, set())
+        for channel, version in blob_keys - referenced:
+            self.release(self.blobs.pop((thread_id, checkpoint_ns, channel, version), None))
+        blob_keys &= referenced
+
+    def measure(self, thread_id):
+        size = 0
+        for checkpoint_ns, checkpoints in self.storage.get(thread_id, {}).items():
+            for checkpoint, metadata, parent in checkpoints.values():
+                size += len(checkpoint[1]) + len(metadata[1])
+            for channel, version in self.blob_keys.get((thread_id, checkpoint_ns), ()):
+                size += len(self.blobs[(thread_id, checkpoint_ns, channel, version)][1])
+            for checkpoint_id in checkpoints:
+                for task_id, channel, value, task_path in self.writes.get((thread_id, checkpoint_ns, checkpoint_id), {}).values():
+                    size += len(value[1])
+        return size
+
+    def evict(self, current=None):
+        if self.ttl:
+            idle_since = time.monotonic() - self.ttl
+            for thread_id, used in list(self.used.items()):
+                if used >= idle_since:
+                    break
+                if thread_id not in self.active:
+                    self.delete_thread(thread_id)
+                    self.evicted["ttl"] += 1
+
+        if self.max_bytes:
+            total = sum(self.thread_bytes.values())
+            for thread_id in list(self.used):
+                if total <= self.max_bytes:
+                    break
+                if thread_id != current and thread_id not in self.active:
+                    total -= self.thread_bytes.get(thread_id, 0)
+                    self.delete_thread(thread_id)
+                    self.evicted["memory"] += 1
+
+    def delete_thread(self, thread_id):
+        with self.lock:
+            for checkpoint_ns in self.storage.get(thread_id, {}):
+                key = (thread_id, checkpoint_ns)
+                for channel, version in self.blob_keys.pop(key, ()):
+                    self.release(self.blobs.pop((thread_id, checkpoint_ns, channel, version), None))
+                for checkpoint_id in self.versions.pop(key, {}):
+                    self.writes.pop((thread_id, checkpoint_ns, checkpoint_id), None)
+            # the base class scans every thread's writes and values, the indexes above make that unnecessary
+            self.storage.pop(thread_id, None)
+            self.used.pop(thread_id, None)
+            self.thread_bytes.pop(thread_id, None)
+
+    def stats(self):
+        """
+        Threads held, their checkpoint bytes (in total and per session) and evictions.
+        Shared channel values count towards each thread using them, `shared_bytes` is their saving.
+        """
+        with self.lock:
+            sizes = list(self.thread_bytes.values())
+            stored = sum(len(value[1]) for value, refs in self.shared.values())
+            referenced = sum(len(value[1]) * refs for value, refs in self.shared.values())
+            return {
+                "threads": len(sizes),
+                "bytes": sum(sizes),
+                "mean_bytes_per_session": round(sum(sizes) / len(sizes)) if sizes else 0,
+                "max_bytes_per_session": max(sizes, default=0),
+                "shared_bytes": referenced - stored,
+                "active_threads": len(self.active),
+                "evicted_ttl": self.evicted["ttl"],
+                "evicted_memory": self.evicted["memory"],
+            }
+
+def make_checkpointer(kind="memory", path="checkpoints.db", keep=10, ttl=None, max_bytes=None):
+    """
+    Creates the checkpointer for the graph: "memory" keeps sessions in this
+    process only, "sqlite" keeps them in a file so they can be resumed.
+    """
+    if kind == "sqlite":
+        conn = sqlite3.connect(path, check_same_thread=False)
+        return CompactingSqliteSaver(conn, keep=keep, serde=state_serializer())
+    if kind == "memory":
+        return BoundedMemorySaver(keep=keep, ttl=ttl, max_bytes=max_bytes, serde=state_serializer())
+    raise ValueError(f"Unknown checkpointer: {kind}")
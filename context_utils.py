@@ -1,6 +1,8 @@
-from openai import BaseModel
 from StateTypes import GraphState
 import json
+import threading
+from collections import OrderedDict
+from prompt_encoding import encode_section
 from pprint import pprint
 
 def check_quit(user_input):
@@ -8,32 +10,220 @@ def check_quit(user_input):
         print("Goodbye! ...")
         exit(0)
 
+CONTEXT_SECTIONS = [
+    ("risk_assessment", "Risk Assessment"),
+    ("defence_assessment", "Defence Assessment"),
+    ("leave_plan", "Leave Plan"),
+    ("stay_plan", "Stay Plan"),
+]
+
+def prompt_section(section, value, summarized):
+    """
+    The section as given to the model: without the answers already in the
+    conversation summary, or the questions they answered.
+    """
+    folded = set((summarized or {}).get(section) or [])
+    data = value.model_dump()
+    questions = data.get("questions")
+    if folded and questions:
+        questions["answers"] = {question: answer for question, answer in questions["answers"].items() if question not in folded}
+        questions["questions"] = [question for question in questions["questions"] if question not in folded]
+    return data
+
 def build_context(state: GraphState):
     # Build context from all messages and answers
     context_parts = []
     
     if state.user_motivation:
         context_parts.append(f"User's reason for creating bushfire plan: {state.user_motivation}")
+
+    if state.conversation_summary:
+        context_parts.append(f"Summary of the earlier conversation: {state.conversation_summary}")
     
     for msg in state.messages:
         context_parts.append(msg.content)
 
-    if state.risk_assessment:
-        context_parts.append(f"Risk Assessment: {state.risk_assessment}")
-    
-    if state.defence_assessment:
-        context_parts.append(f"Defence Assessment: {state.defence_assessment}")
-    
-    if state.leave_plan:
-        context_parts.append(f"Leave Plan: {state.leave_plan}")
-    
-    if state.stay_plan:
-        context_parts.append(f"Stay Plan: {state.stay_plan}")
+    for section, title in CONTEXT_SECTIONS:
+        value = getattr(state, section)
+        if value:
+            context_parts.append(f"{title}:\n{encode_section(prompt_section(section, value, state.summarized_answers))}")
 
     full_context = "\n\n".join(context_parts)
 
     return full_context
 
+# threads whose fragments each ContextBuilder keeps, least recently used dropped first
+CONTEXT_CACHE_THREADS = 256
+
+def empty_stats():
+    return {
+        "reused_fragments": 0,
+        "rendered_fragments": 0,
+        "reused_bytes": 0,
+        "rendered_bytes": 0,
+    }
+
+class ThreadContext:
+    """
+    The fragments rendered for one graph thread, with the content each was
+    rendered from, and the stats of the thread's last build.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.motivation = (None, None, 0)
+        self.summary = (None, None, 0)
+        self.message_ids = []
+        self.messages_text = ""
+        self.messages_bytes = 0
+        self.sections = {}
+        self.last_stats = empty_stats()
+
+    def build(self, state: GraphState, stats):
+        context_parts = []
+
+        if state.user_motivation:
+            self.motivation = fragment(self.motivation, state.user_motivation, "User's reason for creating bushfire plan: {}", stats)
+            context_parts.append(self.motivation[1])
+
+        if state.conversation_summary:
+            self.summary = fragment(self.summary, state.conversation_summary, "Summary of the earlier conversation: {}", stats)
+            context_parts.append(self.summary[1])
+
+        if state.messages:
+            context_parts.append(self._messages(state.messages, stats))
+
+        for section, title in CONTEXT_SECTIONS:
+            value = getattr(state, section)
+            if value:
+                context_parts.append(self._section(section, title, value, state.summarized_answers, stats))
+            else:
+                self.sections.pop(section, None)
+
+        self.last_stats = stats
+        return "\n\n".join(context_parts)
+
+    def _messages(self, messages, stats):
+        ids = [msg.id or id(msg) for msg in messages]
+        cached_count = len(self.message_ids)
+
+        # messages are append-only, so anything else (e.g. removals) means starting over
+        if cached_count == 0 or cached_count > len(ids) or ids[:cached_count] != self.message_ids:
+            self.message_ids = []
+            self.messages_text = ""
+            self.messages_bytes = 0
+            cached_count = 0
+
+        stats["reused_fragments"] += cached_count
+        stats["reused_bytes"] += self.messages_bytes
+
+        new_parts = [msg.content for msg in messages[cached_count:]]
+        if new_parts:
+            for part in new_parts:
+                size = len(part.encode("utf-8"))
+                record(stats, "rendered", size)
+                self.messages_bytes += size
+            if self.message_ids:
+                new_parts.insert(0, self.messages_text)
+            self.messages_text = "\n\n".join(new_parts)
+            self.message_ids = ids
+
+        return self.messages_text
+
+    def _section(self, section, title, value, summarized, stats):
+        # sections are mutated in place (e.g. answers), so compare content not identity; the JSON
+        # is serialised by pydantic-core, far cheaper than rendering or comparing model_dump dicts
+        key = (value.model_dump_json(), tuple((summarized or {}).get(section) or []))
+        cached = self.sections.get(section)
+        if cached and cached[0] == key:
+            record(stats, "reused", cached[2])
+            return cached[1]
+
+        text = f"{title}:\n{encode_section(prompt_section(section, value, summarized))}"
+        self.sections[section] = (key, text, len(text.encode("utf-8")))
+        record(stats, "rendered", self.sections[section][2])
+        return text
+
+class ContextBuilder:
+    """
+    Builds the same context as build_context, but keeps the rendered fragments
+    of each graph thread's previous call so that only changed sections are
+    re-rendered and only new messages are appended. Calls without a thread id
+    share one set of fragments.
+
+    report() describes what the last call for a thread reused and rendered,
+    and `totals` adds up every call.
+    """
+    def __init__(self, max_threads=CONTEXT_CACHE_THREADS):
+        self.lock = threading.Lock()
+        self.max_threads = max_threads
+        self.threads = OrderedDict()
+        self.totals = empty_stats()
+
+    def thread(self, thread_id):
+        with self.lock:
+            context = self.threads.get(thread_id)
+            if context is None:
+                context = self.threads[thread_id] = ThreadContext()
+                while len(self.threads) > self.max_threads:
+                    self.threads.popitem(last=False)
+            else:
+                self.threads.move_to_end(thread_id)
+            return context
+
+    def build(self, state: GraphState, config=None):
+        context = self.thread(thread_id(config))
+        stats = empty_stats()
+        with context.lock:
+            full_context = context.build(state, stats)
+        with self.lock:
+            for key, count in stats.items():
+                self.totals[key] += count
+        return full_context
+
+    def last_stats(self, config=None):
+        with self.lock:
+            context = self.threads.get(thread_id(config))
+        return context.last_stats if context else empty_stats()
+
+    def report(self, config=None):
+        return describe_stats(self.last_stats(config))
+
+def thread_id(config):
+    return (config or {}).get("configurable", {}).get("thread_id")
+
+def context_report(llm_nodes):
+    """
+    The fragments reused and rendered by the context builders of all the nodes given.
+    """
+    totals = empty_stats()
+    for node in llm_nodes:
+        context_builder = getattr(node, "context_builder", None)
+        if context_builder:
+            with context_builder.lock:
+                for key, count in context_builder.totals.items():
+                    totals[key] += count
+    return totals
+
+def describe_stats(stats):
+    return (f"context: reused {stats['reused_fragments']} fragments ({stats['reused_bytes']} bytes), "
+            f"rendered {stats['rendered_fragments']} fragments ({stats['rendered_bytes']} bytes)")
+
+def fragment(cached, value, template, stats):
+    """
+    The (value, fragment, bytes) cached for a value, rendered again when the value has changed.
+    """
+    if cached[0] == value:
+        record(stats, "reused", cached[2])
+        return cached
+    text = template.format(value)
+    size = len(text.encode("utf-8"))
+    record(stats, "rendered", size)
+    return (value, text, size)
+
+def record(stats, kind, size):
+    stats[f"{kind}_fragments"] += 1
+    stats[f"{kind}_bytes"] += size
+
 def value_with_default(value, values, state = None):
    if not state is None:
        print("State:")
@@ -0,0 +1,239 @@
+import time
+import heapq
+import asyncio
+import itertools
+import threading
+from contextlib import contextmanager, asynccontextmanager
+from typing import Any
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.runnables import Runnable
+from prompt_encoding import estimate_tokens
+from telemetry import telemetry
+import nodes
+
+# lower goes first: question rounds ahead of the final plan, and both ahead of batch sessions
+PRIORITIES = {"interactive": 0, "plan": 1, "batch": 2}
+
+# how long an async caller waits before checking the queue again, when it is not at its head
+ASYNC_POLL_SECONDS = 0.02
+
+class TokenBucket:
+    """
+    Allows `per_minute` units a minute, with bursts of up to `burst_seconds` worth.
+    The level may go below zero when a call turns out to use more than was taken.
+    """
+    def __init__(self, per_minute, burst_seconds=10):
+        self.rate = per_minute / 60
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        self.refill()
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount):
+        self.level -= amount
+
+    def give(self, amount):
+        self.level = min(self.capacity, self.level + amount)
+
+class LLMGateway:
+    """
+    Paces the calls to one deployment to stay within its requests-per-minute
+    and tokens-per-minute quota, instead of sending them all and failing on
+    429s. Waiting calls are served by priority (see PRIORITIES), then in the
+    order they arrived. Queue depth and wait times are recorded in telemetry.
+
+    The tokens of a call are estimated from its prompt when it is queued and
+    corrected once the response reports what was actually used.
+    """
+    def __init__(self, name, rpm=None, tpm=None, expected_completion_tokens=500):
+        self.name = name
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.expected_completion_tokens = expected_completion_tokens
+        self.condition = threading.Condition()
+        self.queue = []
+        self.order = itertools.count()
+
+    def wait_time(self, tokens):
+        waits = [0.0]
+        if self.requests:
+            waits.append(self.requests.wait_time(1))
+        if self.tokens:
+            waits.append(self.tokens.wait_time(tokens))
+        return max(waits)
+
+    def take(self, tokens):
+        if self.requests:
+            self.requests.take(1)
+        if self.tokens:
+            self.tokens.take(tokens)
+
+    def enqueue(self, priority):
+        entry = (PRIORITIES.get(priority, len(PRIORITIES)), next(self.order))
+        heapq.heappush(self.queue, entry)
+        telemetry.observe("gateway_queue_depth", len(self.queue), deployment=self.name)
+        return entry
+
+    def try_acquire(self, entry, tokens):
+        """
+        Takes the call's requests and tokens if it is at the head of the queue and the
+        quota allows, returning 0, or else how long to wait before trying again.
+        """
+        if self.queue[0] != entry:
+            return None
+        wait = self.wait_time(tokens)
+        if wait <= 0:
+            heapq.heappop(self.queue)
+            self.take(tokens)
+            self.condition.notify_all()
+        return wait
+
+    def leave(self, entry):
+        # a call given up while waiting (e.g. timed out) must not hold up the queue
+        with self.condition:
+            if entry in self.queue:
+                self.queue.remove(entry)
+                heapq.heapify(self.queue)
+                self.condition.notify_all()
+
+    def acquire(self, priority, tokens):
+        started = time.monotonic()
+        with self.condition:
+            entry = self.enqueue(priority)
+            try:
+                while True:
+                    wait = self.try_acquire(entry, tokens)
+                    if wait is not None and wait <= 0:
+                        break
+                    self.condition.wait(wait)
+            except BaseException:
+                self.leave(entry)
+                raise
+        telemetry.observe("gateway_wait_seconds", time.monotonic() - started, deployment=self.name, priority=priority)
+
+    async def aacquire(self, priority, tokens):
+        started = time.monotonic()
+        with self.condition:
+            entry = self.enqueue(priority)
+        try:
+            while True:
+                with self.condition:
+                    wait = self.try_acquire(entry, tokens)
+                if wait is not None and wait <= 0:
+                    break
+                await asyncio.sleep(wait if wait is not None else ASYNC_POLL_SECONDS)
+        except BaseException:
+            self.leave(entry)
+            raise
+        telemetry.observe("gateway_wait_seconds", time.monotonic() - started, deployment=self.name, priority=priority)
+
+    def settle(self, estimated, used):
+        if self.tokens and used is not None:
+            with self.condition:
+                self.tokens.give(estimated - used)
+
+    def estimate(self, messages, kwargs):
+        prompt = sum(estimate_tokens(message.content) for message in messages)
+        prompt += estimate_tokens(kwargs.get("tools"))
+        return prompt + (kwargs.get("max_tokens") or self.expected_completion_tokens)
+
+    @contextmanager
+    def slot(self, priority, messages, kwargs):
+        estimated = self.estimate(messages, kwargs)
+        self.acquire(priority, estimated)
+        usage = {}
+        try:
+            yield usage
+        except BaseException:
+            # a failed call is taken to have used nothing, unless it reported its usage
+            usage.setdefault("total_tokens", 0)
+            raise
+        finally:
+            self.settle(estimated, usage.get("total_tokens"))
+
+    @asynccontextmanager
+    async def aslot(self, priority, messages, kwargs):
+        estimated = self.estimate(messages, kwargs)
+        await self.aacquire(priority, estimated)
+        usage = {}
+        try:
+            yield usage
+        except BaseException:
+            # a failed call is taken to have used nothing, unless it reported its usage
+            usage.setdefault("total_tokens", 0)
+            raise
+        finally:
+            self.settle(estimated, usage.get("total_tokens"))
+
+def call_priority(run_manager):
+    """
+    The priority of an LLM call, from the graph node it was made in, or the
+    "priority" in the session's run metadata, e.g. config["metadata"]["priority"] = "batch".
+    """
+    metadata = getattr(run_manager, "metadata", None) or {}
+    if metadata.get("priority") in PRIORITIES:
+        return metadata["priority"]
+    return "plan" if metadata.get("langgraph_node") == nodes.SHOW_PLAN_NODE else "interactive"
+
+def add_usage(usage, message):
+    total = (getattr(message, "usage_metadata", None) or {}).get("total_tokens")
+    if total:
+        usage["total_tokens"] = usage.get("total_tokens", 0) + total
+
+class GatewayChatModel(BaseChatModel):
+    """
+    A chat model whose calls go through an LLMGateway before reaching the
+    wrapped model. Cache hits never reach the gateway.
+    """
+    model: BaseChatModel
+    gateway: Any
+
+    @property
+    def _llm_type(self):
+        return self.model._llm_type
+
+    @property
+    def _identifying_params(self):
+        return self.model._identifying_params
+
+    def _get_ls_params(self, stop=None, **kwargs):
+        return self.model._get_ls_params(stop=stop, **kwargs)
+
+    def bind_tools(self, tools, **kwargs) -> Runnable:
+        # the wrapped model formats the tools for its API
+        return self.bind(**self.model.bind_tools(tools, **kwargs).kwargs)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        with self.gateway.slot(call_priority(run_manager), messages, kwargs) as usage:
+            result = self.model._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+            for generation in result.generations:
+                add_usage(usage, generation.message)
+        return result
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        async with self.gateway.aslot(call_priority(run_manager), messages, kwargs) as usage:
+            result = await self.model._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+            for generation in result.generations:
+                add_usage(usage, generation.message)
+        return result
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        with self.gateway.slot(call_priority(run_manager), messages, kwargs) as usage:
+            for chunk in self.model._stream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                add_usage(usage, chunk.message)
+                yield chunk
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        async with self.gateway.aslot(call_priority(run_manager), messages, kwargs) as usage:
+            async for chunk in self.model._astream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                add_usage(usage, chunk.message)
+                yield chunk
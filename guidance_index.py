@@ -0,0 +1,128 @@
+import os
+import re
+import functools
+import numpy as np
+from prompt_encoding import encode_section
+
+GUIDANCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "guidance")
+
+STOP_WORDS = frozenset("""
+a an and are as at be been by can do for from has have how i if in into is it its my no not of on or our
+should so than that the their them then there these they this to was we were what when where which who
+will with you your
+""".split())
+
+def stem(word):
+    # a light stemmer, enough for plurals and simple verb forms to match
+    for suffix in ("ing", "es", "ed", "s"):
+        if word.endswith(suffix) and len(word) > len(suffix) + 2 and not word.endswith("ss"):
+            return word[:-len(suffix)]
+    return word
+
+def tokenize(text):
+    return [stem(word) for word in re.findall(r"[a-z0-9]+", str(text or "").lower()) if word not in STOP_WORDS]
+
+def read_passages(directory):
+    """
+    (topic, passage) pairs from the .md and .txt files in the directory: the
+    topic is the file name without its extension, and passages are separated
+    by blank lines. Heading lines are left out.
+    """
+    passages = []
+    for name in sorted(os.listdir(directory)):
+        topic, extension = os.path.splitext(name)
+        if extension not in (".md", ".txt"):
+            continue
+        with open(os.path.join(directory, name), encoding="utf-8") as f:
+            for block in re.split(r"\n\s*\n", f.read()):
+                text = " ".join(line.strip() for line in block.splitlines() if line.strip() and not line.startswith("#"))
+                if text:
+                    passages.append((topic, text))
+    return passages
+
+class GuidanceIndex:
+    """
+    A BM25 index over passages of bushfire guidance, built once so each LLM
+    node can be given the `k` passages most relevant to its current state
+    instead of the whole of its prompt's knowledge.
+
+    The BM25 weight of every term in every passage is precomputed into one
+    (passages x terms) matrix, so a search is a column selection and a sum.
+    """
+    def __init__(self, passages, k=4, k1=1.5, b=0.75):
+        self.passages = passages
+        self.k = k
+        self.topics = np.array([topic for topic, _ in passages])
+        documents = [tokenize(text) for _, text in passages]
+
+        self.vocabulary = {}
+        for document in documents:
+            for word in document:
+                self.vocabulary.setdefault(word, len(self.vocabulary))
+
+        counts = np.zeros((len(documents), len(self.vocabulary)), dtype=np.float32)
+        for row, document in enumerate(documents):
+            for word in document:
+                counts[row, self.vocabulary[word]] += 1
+
+        lengths = counts.sum(axis=1)
+        frequency = (counts > 0).sum(axis=0)
+        idf = np.log(1 + (len(documents) - frequency + 0.5) / (frequency + 0.5))
+        saturation = k1 * (1 - b + b * lengths / max(lengths.mean(), 1.0))
+        self.weights = idf * counts * (k1 + 1) / (counts + saturation[:, None])
+
+    @classmethod
+    def load(cls, directory=GUIDANCE_DIR, k=4):
+        return cls(read_passages(directory), k=k)
+
+    def search(self, query, topics=None, k=None):
+        """
+        The passages that best match the query, best first, from the given topics only when there are some.
+        """
+        columns = sorted({self.vocabulary[word] for word in tokenize(query) if word in self.vocabulary})
+        if not columns or not self.passages:
+            return []
+
+        # each query term counts once, so a long context does not outweigh the node's own terms
+        scores = self.weights[:, columns].sum(axis=1)
+        if topics:
+            scores = np.where(np.isin(self.topics, list(topics)), scores, 0.0)
+
+        k = min(k or self.k, len(self.passages))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [self.passages[i][1] for i in top if scores[i] > 0]
+
+    def stats(self):
+        return {
+            "passages": len(self.passages),
+            "terms": len(self.vocabulary),
+            "bytes": int(self.weights.nbytes),
+        }
+
+@functools.lru_cache(maxsize=None)
+def default_index():
+    return GuidanceIndex.load()
+
+class NodeGuidance:
+    """
+    The guidance given to one node's prompt: the top passages from its
+    `topics`, for a query of the node's `seed` terms plus the user's motivation
+    and the state sections the node works on (with their questions and answers).
+    """
+    def __init__(self, index, topics, seed, sections):
+        self.index = index
+        self.topics = topics
+        self.seed = seed
+        self.sections = sections
+
+    def query(self, state):
+        parts = [self.seed, getattr(state, "user_motivation", None) or ""]
+        for section in self.sections:
+            value = getattr(state, section, None)
+            if value:
+                parts.append(encode_section(value))
+        return "\n".join(parts)
+
+    def __call__(self, state):
+        return "\n".join(f"- {passage}" for passage in self.index.search(self.query(state), self.topics))
@@ -0,0 +1,97 @@
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+def import_times(module):
+    """
+    Runs `python -X importtime -c "import <module>"` in a fresh interpreter and
+    returns (name, self seconds, cumulative seconds, depth) for each import.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        errors = [line for line in result.stderr.splitlines() if not line.startswith("import time:")]
+        raise RuntimeError(f"import {module} failed:\n" + "\n".join(errors))
+
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        imports.append((name.strip(), int(own) / 1e6, int(cumulative) / 1e6, depth))
+    return imports
+
+def profile_imports(module, top=15):
+    imports = import_times(module)
+    packages = {}
+    for name, own, cumulative, depth in imports:
+        package = name.split(".")[0]
+        packages[package] = packages.get(package, 0.0) + own
+
+    total = next((cumulative for name, own, cumulative, depth in imports if name == module), sum(packages.values()))
+    return {
+        "module": module,
+        "total_seconds": round(total, 4),
+        "packages": [
+            {"package": package, "self_seconds": round(seconds, 4)}
+            for package, seconds in sorted(packages.items(), key=lambda item: -item[1])[:top]
+        ],
+        "modules": [
+            {"module": name, "self_seconds": round(own, 4), "cumulative_seconds": round(cumulative, 4)}
+            for name, own, cumulative, depth in sorted(imports, key=lambda item: -item[1])[:top]
+        ],
+    }
+
+def time_command(command, runs):
+    """
+    Wall clock seconds of a cold start of the command, e.g. main.py --help, over a number of runs.
+    """
+    seconds = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run([sys.executable] + command, capture_output=True, check=True)
+        seconds.append(time.perf_counter() - started)
+    return {
+        "command": " ".join(["python"] + command),
+        "runs": runs,
+        "mean_seconds": round(statistics.mean(seconds), 4),
+        "min_seconds": round(min(seconds), 4),
+        "max_seconds": round(max(seconds), 4),
+    }
+
+def print_report(report):
+    imports = report["imports"]
+    print(f"import {imports['module']}: {imports['total_seconds']:.3f}s")
+    print("\nSelf time by package:")
+    for package in imports["packages"]:
+        print(f"  {package['self_seconds']:8.3f}s  {package['package']}")
+    print("\nSlowest modules (self / cumulative):")
+    for module in imports["modules"]:
+        print(f"  {module['self_seconds']:8.3f}s {module['cumulative_seconds']:8.3f}s  {module['module']}")
+    startup = report["startup"]
+    print(f"\n{startup['command']}: mean {startup['mean_seconds']:.3f}s, min {startup['min_seconds']:.3f}s, max {startup['max_seconds']:.3f}s over {startup['runs']} runs")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import time and cold start profile")
+    parser.add_argument("--module", default="main", help="module to import (default: main)")
+    parser.add_argument("--command", default="main.py --help", help="command timed from a cold start (default: main.py --help)")
+    parser.add_argument("--runs", type=int, default=5, help="cold starts to time")
+    parser.add_argument("--top", type=int, default=15, help="packages and modules to list")
+    parser.add_argument("--output", help="write the report as JSON")
+    args = parser.parse_args()
+
+    report = {
+        "imports": profile_imports(args.module, args.top),
+        "startup": time_command(args.command.split(), args.runs),
+    }
+    print_report(report)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
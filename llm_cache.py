@@ -0,0 +1,136 @@
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from langchain_core.caches import BaseCache
+from langchain_core.messages import message_to_dict, messages_from_dict
+from langchain_core.outputs import ChatGeneration
+
+WHITESPACE = re.compile(r"(?:\\[nrt]|\s)+")
+
+def normalize_prompt(prompt):
+    # the prompt is a JSON serialisation of the messages, so escaped newlines count as whitespace
+    return WHITESPACE.sub(" ", prompt).strip()
+
+def dump_generations(generations):
+    return json.dumps([message_to_dict(generation.message) for generation in generations])
+
+def load_generations(text):
+    return [ChatGeneration(message=message) for message in messages_from_dict(json.loads(text))]
+
+def hash_text(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """
+    On-disk (SQLite) cache of LLM responses shared by all nodes and sessions.
+
+    Entries are keyed on the node (which identifies the prompt template), the
+    model configuration and a hash of the whitespace-normalised prompt. Entries
+    older than max_age seconds are ignored and purged, and the least recently
+    used entries are evicted once there are more than max_entries.
+    """
+    def __init__(self, path, max_entries=10000, max_age=7 * 24 * 3600, nodes=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.nodes = set(nodes) if nodes else None
+        self.lock = threading.Lock()
+        self.hits = {}
+        self.misses = {}
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                node TEXT NOT NULL,
+                llm_hash TEXT NOT NULL,
+                prompt_hash TEXT NOT NULL,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                used_at REAL NOT NULL,
+                PRIMARY KEY (node, llm_hash, prompt_hash)
+            )""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_used_at ON responses (used_at)")
+        self.connection.commit()
+
+    def enabled_for(self, node):
+        return self.nodes is None or node in self.nodes
+
+    def for_node(self, node):
+        return NodeResponseCache(self, node)
+
+    def lookup(self, node, prompt, llm_string):
+        now = time.time()
+        key = (node, hash_text(llm_string), hash_text(normalize_prompt(prompt)))
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT response, created_at FROM responses WHERE node = ? AND llm_hash = ? AND prompt_hash = ?",
+                key,
+            ).fetchone()
+            if row and now - row[1] <= self.max_age:
+                self.connection.execute(
+                    "UPDATE responses SET used_at = ? WHERE node = ? AND llm_hash = ? AND prompt_hash = ?",
+                    (now, *key),
+                )
+                self.connection.commit()
+                self.hits[node] = self.hits.get(node, 0) + 1
+                return load_generations(row[0])
+
+            self.misses[node] = self.misses.get(node, 0) + 1
+            return None
+
+    def update(self, node, prompt, llm_string, return_val):
+        now = time.time()
+        key = (node, hash_text(llm_string), hash_text(normalize_prompt(prompt)))
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (*key, dump_generations(return_val), now, now),
+            )
+            self.evict(now)
+            self.connection.commit()
+
+    def evict(self, now):
+        self.connection.execute("DELETE FROM responses WHERE created_at < ?", (now - self.max_age,))
+        self.connection.execute("""
+            DELETE FROM responses WHERE rowid IN (
+                SELECT rowid FROM responses ORDER BY used_at DESC LIMIT -1 OFFSET ?
+            )""", (self.max_entries,))
+
+    def clear(self, node=None):
+        with self.lock:
+            if node is None:
+                self.connection.execute("DELETE FROM responses")
+            else:
+                self.connection.execute("DELETE FROM responses WHERE node = ?", (node,))
+            self.connection.commit()
+
+    def stats(self):
+        with self.lock:
+            entries = self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        nodes = sorted(set(self.hits) | set(self.misses))
+        return {
+            "entries": entries,
+            "hits": sum(self.hits.values()),
+            "misses": sum(self.misses.values()),
+            "nodes": {node: {"hits": self.hits.get(node, 0), "misses": self.misses.get(node, 0)} for node in nodes},
+        }
+
+class NodeResponseCache(BaseCache):
+    """
+    The LangChain cache interface for a single node, so each node's LLM can
+    have caching switched on or off independently.
+    """
+    def __init__(self, cache, node):
+        self.cache = cache
+        self.node = node
+
+    def lookup(self, prompt, llm_string):
+        return self.cache.lookup(self.node, prompt, llm_string)
+
+    def update(self, prompt, llm_string, return_val):
+        self.cache.update(self.node, prompt, llm_string, return_val)
+
+    def clear(self, **kwargs):
+        self.cache.clear(self.node)
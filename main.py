@@ -1,22 +1,20 @@
 import os
 import sys
+import asyncio
+import argparse
+import contextlib
+import threading
 from dotenv import load_dotenv
-from context_utils import check_quit, print_context, value_with_default
-from Choice import AskChoice
-from langgraph.graph import StateGraph, START, END
-from langgraph.checkpoint.memory import MemorySaver
-from langchain_openai import AzureChatOpenAI
-from langchain_core.messages import HumanMessage
-from StateTypes import GraphState
+from context_utils import check_quit, print_context, value_with_default, context_report, describe_stats, CONTEXT_SECTIONS
+from prompt_encoding import encoding_savings
 import time
 import nodes
 from datetime import datetime
-from AssessRisk import AssessRisk
-from AssessDefence import AssessDefence
-from Questions import AskQuestions
-from CreateLeavePlan import CreateLeavePlan
-from CreateStayPlan import CreateStayPlan
-from ShowPlan import ShowPlan
+from call_policy import CallPolicy
+
+# LangGraph, LangChain and the node modules are slow to import, so they are imported where
+# they are first needed, and the LLM, nodes and graph are built on first use (see lazy below).
+# This keeps --help, batch workers and anything that only needs the state types quick to start.
 
 load_dotenv()
 
@@ -25,118 +23,594 @@ azure_deployment = os.getenv("AZURE_OPENAI_DEPLOYMENT")
 azure_key = os.getenv("AZURE_OPENAI_KEY")
 azure_api_version = os.getenv("AZURE_OPENAI_API_VERSION", "2024-12-01-preview")
 
-llm = AzureChatOpenAI(
-    azure_endpoint=azure_endpoint,
-    deployment_name=azure_deployment,
-    openai_api_version=azure_api_version,
-    openai_api_key=azure_key,
-)
-
-# Build graph
-graph_builder = StateGraph(GraphState)
-graph_builder.add_node(nodes.CLASSIFY_RISK_NODE, AssessRisk(llm))
-graph_builder.add_node(nodes.ASK_RISK_QUESTIONS_NODE, AskQuestions("risk_assessment"))
-graph_builder.add_node(nodes.CONTINUE_WITH_PLAN_NODE, AskChoice("risk_assessment", "Continue with plan?", ["yes","no"]))
-graph_builder.add_node(nodes.ASSESS_DEFENCE_NODE, AssessDefence(llm))
-graph_builder.add_node(nodes.ASK_DEFENCE_QUESTIONS_NODE, AskQuestions("defence_assessment"))
-graph_builder.add_node(nodes.ASK_STRATEGY_NODE,  AskChoice("defence_assessment", "Do you want to create a leave early or stay and defend plan?", ["leave", "stay"]))
-graph_builder.add_node(nodes.CREATE_LEAVE_PLAN_NODE,  CreateLeavePlan(llm))
-graph_builder.add_node(nodes.ASK_LEAVE_PLAN_QUESTIONS_NODE, AskQuestions("leave_plan"))
-graph_builder.add_node(nodes.CREATE_STAY_PLAN_NODE,  CreateStayPlan(llm))
-graph_builder.add_node(nodes.ASK_STAY_PLAN_QUESTIONS_NODE, AskQuestions("stay_plan"))
-graph_builder.add_node(nodes.SHOW_PLAN_NODE,  ShowPlan(llm))
-
-# define edges to constrain what nodes are accessible from another
-# fixed edges
-
-graph_builder.add_edge(START, nodes.CLASSIFY_RISK_NODE)
-graph_builder.add_edge(nodes.ASK_RISK_QUESTIONS_NODE, nodes.CLASSIFY_RISK_NODE)
-graph_builder.add_edge(nodes.ASK_DEFENCE_QUESTIONS_NODE, nodes.ASSESS_DEFENCE_NODE) 
-graph_builder.add_edge(nodes.ASK_STAY_PLAN_QUESTIONS_NODE, nodes.CREATE_STAY_PLAN_NODE) 
-graph_builder.add_edge(nodes.ASK_LEAVE_PLAN_QUESTIONS_NODE, nodes.CREATE_LEAVE_PLAN_NODE) 
-graph_builder.add_edge(nodes.SHOW_PLAN_NODE, END)
-
-graph_builder.add_conditional_edges(
-    source=nodes.CLASSIFY_RISK_NODE,
-    path=lambda state: value_with_default(state.risk_assessment.risk_level, ['low', 'high', 'unclear']),
-    path_map={
-        "unclear": nodes.ASK_RISK_QUESTIONS_NODE,
-        "low": nodes.CONTINUE_WITH_PLAN_NODE,
-        "high": nodes.CONTINUE_WITH_PLAN_NODE,
-        "default": nodes.CLASSIFY_RISK_NODE
-    }
-)
-
-graph_builder.add_conditional_edges(
-    source=nodes.CONTINUE_WITH_PLAN_NODE,
-    path=lambda state: value_with_default(state.risk_assessment.choice.last_choice, ['no', 'yes']),
-    path_map={
-        "yes": nodes.ASSESS_DEFENCE_NODE,
-        "no": END,
-        "default": nodes.CONTINUE_WITH_PLAN_NODE
-    }
-)
-
-graph_builder.add_conditional_edges(
-    source=nodes.ASSESS_DEFENCE_NODE,
-    path=lambda state: value_with_default(state.defence_assessment.capability_level, ['low', 'high', 'unclear']),
-    path_map={
-        "unclear": nodes.ASK_DEFENCE_QUESTIONS_NODE,
-        "low": nodes.ASK_STRATEGY_NODE,
-        "high": nodes.ASK_STRATEGY_NODE,
-        "default": nodes.ASSESS_DEFENCE_NODE
-    }
-)
-
-graph_builder.add_conditional_edges(
-    source=nodes.ASK_STRATEGY_NODE,
-    path=lambda state: value_with_default(state.defence_assessment.choice.last_choice, ['stay', 'leave']),
-    path_map={
-        "stay": nodes.CREATE_STAY_PLAN_NODE,
-        "leave": nodes.CREATE_LEAVE_PLAN_NODE,
-        "default": nodes.ASK_STRATEGY_NODE
-    }
-)
-
-graph_builder.add_conditional_edges(
-    source=nodes.CREATE_LEAVE_PLAN_NODE,
-    path=lambda state: value_with_default(state.leave_plan.plan_status, ['more', 'done']),
-    path_map={
-        "more": nodes.ASK_LEAVE_PLAN_QUESTIONS_NODE,
-        "done": nodes.SHOW_PLAN_NODE,
-        "default": nodes.CREATE_LEAVE_PLAN_NODE
-    }
-)
-
-graph_builder.add_conditional_edges(
-    source=nodes.CREATE_STAY_PLAN_NODE,
-    path=lambda state: value_with_default(state.stay_plan.plan_status, ['more', 'done']),
-    path_map={
-        "more": nodes.ASK_STAY_PLAN_QUESTIONS_NODE,
-        "done": nodes.SHOW_PLAN_NODE,
-        "default": nodes.CREATE_STAY_PLAN_NODE
+# the LLM, nodes, graph etc., by name, built the first time they are needed
+built = {}
+build_lock = threading.RLock()
+
+def lazy(name, build):
+    with build_lock:
+        if name not in built:
+            built[name] = build()
+        return built[name]
+
+# Calls to each deployment are paced to stay within its quota, e.g. LLM_RPM=300 LLM_TPM=100000,
+# with question rounds served before the final plan and interactive sessions before batch ones
+llm_rpm = os.getenv("LLM_RPM")
+llm_tpm = os.getenv("LLM_TPM")
+llm_max_connections = int(os.getenv("LLM_MAX_CONNECTIONS", "100"))
+
+def get_http_client():
+    """
+    The HTTP connection pool shared by the clients of every deployment.
+    """
+    def make_http_client():
+        import httpx
+        return httpx.Client(limits=httpx.Limits(max_connections=llm_max_connections, max_keepalive_connections=llm_max_connections))
+    return lazy("http_client", make_http_client)
+
+# Record every LLM exchange to LLM_RECORD_DIR/<thread id>.jsonl.gz, or replay recorded exchanges from
+# LLM_REPLAY (a cassette or a folder of them) instead of calling Azure, e.g. LLM_REPLAY=cassettes LLM_REPLAY_LATENCY=1
+llm_record_dir = os.getenv("LLM_RECORD_DIR")
+llm_replay = os.getenv("LLM_REPLAY")
+llm_replay_latency = float(os.getenv("LLM_REPLAY_LATENCY", "0"))
+
+def get_cassette_recorder():
+    def make_cassette_recorder():
+        from cassettes import CassetteRecorder
+        return CassetteRecorder(llm_record_dir)
+    return lazy("cassette_recorder", make_cassette_recorder)
+
+def get_cassette_library():
+    def make_cassette_library():
+        from cassettes import CassetteLibrary
+        return CassetteLibrary(llm_replay)
+    return lazy("cassette_library", make_cassette_library)
+
+def make_llm(deployment=None):
+    if llm_replay:
+        # every deployment is served from the same cassettes, with nothing to pace
+        from cassettes import ReplayChatModel
+        return ReplayChatModel(library=get_cassette_library(), latency_scale=llm_replay_latency)
+
+    from langchain_openai import AzureChatOpenAI
+    deployment = deployment or azure_deployment
+    llm = AzureChatOpenAI(
+        azure_endpoint=azure_endpoint,
+        deployment_name=deployment,
+        openai_api_version=azure_api_version,
+        openai_api_key=azure_key,
+        http_client=get_http_client(),
+        timeout=request_timeout(),
+    )
+    if llm_record_dir:
+        # recorded inside the gateway, so the latency is the deployment's and not the time queued
+        from cassettes import RecordingChatModel
+        llm = RecordingChatModel(model=llm, recorder=get_cassette_recorder())
+    if not (llm_rpm or llm_tpm):
+        return llm
+
+    from gateway import LLMGateway, GatewayChatModel
+    gateway = LLMGateway(deployment, rpm=float(llm_rpm) if llm_rpm else None, tpm=float(llm_tpm) if llm_tpm else None)
+    return GatewayChatModel(model=llm, gateway=gateway)
+
+# set by use_llm, when one chat model replaces every deployment
+llm_replaced = False
+
+def get_llm(deployment=None):
+    """
+    The chat model for a deployment, by default AZURE_OPENAI_DEPLOYMENT.
+    """
+    if not deployment or deployment == azure_deployment or llm_replaced:
+        return lazy("llm", make_llm)
+    return lazy(f"llm:{deployment}", lambda: make_llm(deployment))
+
+# Optional on-disk response cache, e.g. LLM_CACHE_PATH=llm_cache.db
+# LLM_CACHE_NODES limits caching to a comma separated list of node names
+llm_cache_path = os.getenv("LLM_CACHE_PATH")
+llm_cache_nodes = [node.strip() for node in os.getenv("LLM_CACHE_NODES", "").split(",") if node.strip()]
+
+def make_response_cache():
+    if not llm_cache_path:
+        return None
+    from llm_cache import ResponseCache
+    return ResponseCache(
+        llm_cache_path,
+        max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", "10000")),
+        max_age=float(os.getenv("LLM_CACHE_MAX_AGE", str(7 * 24 * 3600))),
+        nodes=llm_cache_nodes,
+    )
+
+def get_response_cache():
+    return lazy("response_cache", make_response_cache)
+
+def cached_llm(llm, node):
+    response_cache = get_response_cache()
+    if response_cache and response_cache.enabled_for(node):
+        return llm.model_copy(update={"cache": response_cache.for_node(node)})
+    return llm
+
+def node_llm(node):
+    """
+    The LLM used by a node: the node's deployment from NODE_DEPLOYMENTS, falling back to the
+    default deployment when a call fails, with the response cache attached when enabled for the node.
+    """
+    deployment = node_deployments.get(node)
+    llm = cached_llm(get_llm(deployment), node)
+    # only a node on a deployment of its own falls back, never to the deployment that just failed
+    if deployment and deployment != azure_deployment and not llm_replaced and model_fallback:
+        return llm.with_fallbacks([cached_llm(get_llm(), node)])
+    return llm
+
+def parse_node_settings(text):
+    """
+    Parses per-node settings of the form "node_a=value,node_b=value".
+    """
+    settings = {}
+    for item in (text or "").split(","):
+        if "=" in item:
+            node, value = item.split("=", 1)
+            settings[node.strip()] = value.strip()
+    return settings
+
+# Deadlines, retries and hedging for LLM calls, e.g. LLM_TIMEOUT=60 NODE_TIMEOUTS=show_plan_node=180
+llm_timeout = os.getenv("LLM_TIMEOUT")
+llm_retries = int(os.getenv("LLM_RETRIES", "0"))
+llm_hedge_after = os.getenv("LLM_HEDGE_AFTER")
+node_timeouts = parse_node_settings(os.getenv("NODE_TIMEOUTS"))
+# the time all of a node's attempts may take together, e.g. LLM_DEADLINE=300 NODE_DEADLINES=classify_risk_node=60
+llm_deadline = os.getenv("LLM_DEADLINE")
+node_deadlines = parse_node_settings(os.getenv("NODE_DEADLINES"))
+
+def request_timeout():
+    """
+    The HTTP timeout of each request, the longest configured LLM_TIMEOUT or NODE_TIMEOUTS, so a request
+    the call policy has given up on ends rather than holding its connection and thread.
+    """
+    timeouts = [float(timeout) for timeout in [llm_timeout, *node_timeouts.values()] if timeout]
+    return max(timeouts) if timeouts else None
+
+# Per-node deployments, e.g. NODE_DEPLOYMENTS=classify_risk_node=gpt-4o-mini,assess_defence_node=gpt-4o-mini
+# for quick question rounds, with MODEL_FALLBACK=false to fail rather than retry on the default deployment
+node_deployments = parse_node_settings(os.getenv("NODE_DEPLOYMENTS"))
+model_fallback = os.getenv("MODEL_FALLBACK", "true").lower() in ("1", "true", "yes")
+
+def parse_prices(text):
+    """
+    Parses prices per 1K tokens of the form "model=input:output,...".
+    """
+    prices = {}
+    for model, price in parse_node_settings(text).items():
+        input_price, output_price = price.split(":")
+        prices[model] = (float(input_price), float(output_price))
+    return prices
+
+# Prices per 1K tokens, so the cost of each node's route is recorded, e.g. MODEL_PRICES=gpt-4o-mini=0.00015:0.0006
+model_prices = parse_prices(os.getenv("MODEL_PRICES"))
+
+def node_policy(node):
+    """
+    How a node calls its LLM: the node's timeout and deadline, retries and hedging.
+    """
+    timeout = node_timeouts.get(node, llm_timeout)
+    deadline = node_deadlines.get(node, llm_deadline)
+    return CallPolicy(
+        timeout=float(timeout) if timeout else None,
+        retries=llm_retries,
+        hedge_after=float(llm_hedge_after) if llm_hedge_after else None,
+        deadline=float(deadline) if deadline else None,
+    )
+
+# The final plan is rendered from the state without an LLM call (PLAN_RENDERER=llm to have the LLM write it,
+# or sections to have it write each section at the same time), with the sections in PLAN_POLISH, e.g.
+# risk_summary,decision or all, rewritten on show_plan_node's deployment, up to PLAN_SECTION_CONCURRENCY at once
+plan_renderer = os.getenv("PLAN_RENDERER", "template")
+plan_polish = [section.strip() for section in os.getenv("PLAN_POLISH", "").split(",") if section.strip()]
+plan_section_concurrency = int(os.getenv("PLAN_SECTION_CONCURRENCY", "8"))
+
+# Guidance passages retrieved for each node's prompt, from GUIDANCE_DIR (the guidance folder by default)
+guidance_dir = os.getenv("GUIDANCE_DIR")
+guidance_top_k = int(os.getenv("GUIDANCE_TOP_K", "4"))
+
+def make_guidance():
+    from guidance_index import GuidanceIndex, GUIDANCE_DIR
+    return GuidanceIndex.load(guidance_dir or GUIDANCE_DIR, guidance_top_k)
+
+def get_guidance():
+    return lazy("guidance", make_guidance)
+
+# Facts for the property's region, looked up by postcode or locality in REGION_DB (regions.db next to this
+# file by default, built from the regions folder), REGION_DB= turns this off
+region_db = os.getenv("REGION_DB")
+
+def make_region_index():
+    if region_db == "":
+        return None
+    from region_index import RegionIndex, REGION_DB
+    return RegionIndex.open(region_db or REGION_DB)
+
+def get_region_index():
+    return lazy("region_index", make_region_index)
+
+def make_llm_nodes():
+    from AssessRisk import AssessRisk
+    from AssessDefence import AssessDefence
+    from CreateLeavePlan import CreateLeavePlan
+    from CreateStayPlan import CreateStayPlan
+    from ShowPlan import ShowPlan
+
+    guidance = get_guidance()
+    llm_nodes = {
+        node: node_class(node_llm(node), node_policy(node), guidance=guidance)
+        for node, node_class in [
+            (nodes.ASSESS_DEFENCE_NODE, AssessDefence),
+            (nodes.CREATE_LEAVE_PLAN_NODE, CreateLeavePlan),
+            (nodes.CREATE_STAY_PLAN_NODE, CreateStayPlan),
+        ]
     }
-)
+    llm_nodes[nodes.CLASSIFY_RISK_NODE] = AssessRisk(
+        node_llm(nodes.CLASSIFY_RISK_NODE),
+        node_policy(nodes.CLASSIFY_RISK_NODE),
+        guidance=guidance,
+        regions=get_region_index(),
+    )
+    llm_nodes[nodes.SHOW_PLAN_NODE] = ShowPlan(
+        node_llm(nodes.SHOW_PLAN_NODE),
+        node_policy(nodes.SHOW_PLAN_NODE),
+        renderer=plan_renderer,
+        polish=plan_polish,
+        guidance=guidance,
+        concurrency=plan_section_concurrency,
+    )
+    return llm_nodes
+
+def get_llm_nodes():
+    return lazy("llm_nodes", make_llm_nodes)
+
+# Older answers are summarised in the prompts once they pass this many tokens (0 turns this off),
+# keeping the most recent KEEP_RECENT_ANSWERS verbatim
+history_token_budget = int(os.getenv("HISTORY_TOKEN_BUDGET", "2000"))
+keep_recent_answers = int(os.getenv("KEEP_RECENT_ANSWERS", "4"))
+
+def make_summarizer():
+    if not history_token_budget:
+        return None
+    from summarizer import HistorySummarizer
+    return HistorySummarizer(
+        node_llm("summarize_history"),
+        history_token_budget,
+        keep_recent_answers,
+        node_policy("summarize_history"),
+    )
+
+def get_history_summarizer():
+    return lazy("history_summarizer", make_summarizer)
+
+# How a stage is forced to converge once its budget is used up: node -> (section, field, forced value, settled values)
+BUDGET_CONVERGENCE = {
+    nodes.CLASSIFY_RISK_NODE: ("risk_assessment", "risk_level", "high", ["low", "high"]),
+    nodes.ASSESS_DEFENCE_NODE: ("defence_assessment", "capability_level", "low", ["low", "high"]),
+    nodes.CREATE_LEAVE_PLAN_NODE: ("leave_plan", "plan_status", "done", ["done"]),
+    nodes.CREATE_STAY_PLAN_NODE: ("stay_plan", "plan_status", "done", ["done"]),
+}
+
+def optional_number(name):
+    value = os.getenv(name)
+    return float(value) if value else None
+
+# LLM calls allowed per stage (STAGE_CALL_LIMITS=classify_risk_node=3 for one stage) and per session
+def make_session_budget():
+    from budget import SessionBudget
+    return SessionBudget(
+        BUDGET_CONVERGENCE,
+        stage_calls=int(os.getenv("STAGE_CALL_LIMIT", "5")),
+        node_calls={node: int(limit) for node, limit in parse_node_settings(os.getenv("STAGE_CALL_LIMITS")).items()},
+        max_calls=optional_number("SESSION_MAX_CALLS"),
+        max_tokens=optional_number("SESSION_MAX_TOKENS"),
+        max_seconds=optional_number("SESSION_MAX_SECONDS"),
+    )
+
+def get_session_budget():
+    return lazy("session_budget", make_session_budget)
+
+def make_telemetry():
+    from telemetry import telemetry
+    telemetry.prices.update(model_prices)
+    return telemetry
+
+def get_telemetry():
+    return lazy("telemetry", make_telemetry)
+
+def llm_node(node):
+    """
+    An LLM node that runs synchronously under graph.invoke and asynchronously under graph.ainvoke.
+    The answer history is compacted first when it is over budget, and the node's LLM usage is
+    recorded against the session budget afterwards, with the context fragments it reused and rendered.
+    """
+    from langchain_core.runnables import RunnableLambda
+
+    instance = get_llm_nodes()[node]
+    history_summarizer = get_history_summarizer()
+    session_budget = get_session_budget()
+    telemetry = get_telemetry()
+
+    def record_context(config):
+        context_builder = getattr(instance, "context_builder", None)
+        if not context_builder:
+            return
+        stats = context_builder.last_stats(config)
+        for kind in ["reused", "rendered"]:
+            telemetry.increment("context_fragments_total", stats[f"{kind}_fragments"], node=node, kind=kind)
+            telemetry.increment("context_bytes_total", stats[f"{kind}_bytes"], node=node, kind=kind)
+
+    def call(state, config=None):
+        started = time.perf_counter()
+        updates = history_summarizer.compact(state, config) if history_summarizer else {}
+        state = history_summarizer.apply(state, updates) if updates else state
+        result = instance(state, config)
+        record_context(config)
+        return {**updates, **session_budget.settle(node, state, config, result, time.perf_counter() - started)}
+
+    async def acall(state, config=None):
+        started = time.perf_counter()
+        updates = await history_summarizer.acompact(state, config) if history_summarizer else {}
+        state = history_summarizer.apply(state, updates) if updates else state
+        result = await instance.acall(state, config)
+        record_context(config)
+        return {**updates, **session_budget.settle(node, state, config, result, time.perf_counter() - started)}
+
+    return RunnableLambda(call, afunc=acall, name=node)
+
+# Run the likely next LLM node in the background while the user makes a choice
+speculate = os.getenv("SPECULATE", "").lower() in ("1", "true", "yes")
+
+# "sequential" assesses risk then defence, "parallel" assesses both at once with a combined questionnaire
+graph_layout = os.getenv("GRAPH_LAYOUT", "sequential")
+
+ASSESSMENT_LEVELS = {
+    nodes.CLASSIFY_RISK_NODE: ("risk_assessment", "risk_level"),
+    nodes.ASSESS_DEFENCE_NODE: ("defence_assessment", "capability_level"),
+}
+
+def pending_assessments(state):
+    """
+    The assessment nodes that have not yet reached a clear level, or the
+    continue choice once both have.
+    """
+    pending = []
+    for node, (section, level) in ASSESSMENT_LEVELS.items():
+        assessment = getattr(state, section)
+        value = getattr(assessment, level) if assessment else None
+        if value is None or value.lower() not in ['low', 'high']:
+            pending.append(node)
+    return pending or [nodes.CONTINUE_WITH_PLAN_NODE]
+
+def build_graph(layout="sequential"):
+    from langgraph.graph import StateGraph, END
+    from StateTypes import GraphState
+    from Choice import AskChoice
+    from Questions import AskQuestions
+
+    telemetry = get_telemetry()
+    llm_nodes = get_llm_nodes()
+    parallel = layout == "parallel"
+    continue_speculation = {"yes": llm_nodes[nodes.ASSESS_DEFENCE_NODE]} if speculate and not parallel else None
+    strategy_speculation = {
+        "leave": llm_nodes[nodes.CREATE_LEAVE_PLAN_NODE],
+        "stay": llm_nodes[nodes.CREATE_STAY_PLAN_NODE],
+    } if speculate else None
+
+    # Build graph
+    graph_builder = StateGraph(GraphState)
+    graph_builder.add_node(nodes.CLASSIFY_RISK_NODE, llm_node(nodes.CLASSIFY_RISK_NODE))
+    graph_builder.add_node(nodes.CONTINUE_WITH_PLAN_NODE, AskChoice("risk_assessment", "Continue with plan?", ["yes","no"], continue_speculation))
+    graph_builder.add_node(nodes.ASSESS_DEFENCE_NODE, llm_node(nodes.ASSESS_DEFENCE_NODE))
+    graph_builder.add_node(nodes.ASK_STRATEGY_NODE,  AskChoice("defence_assessment", "Do you want to create a leave early or stay and defend plan?", ["leave", "stay"], strategy_speculation))
+    graph_builder.add_node(nodes.CREATE_LEAVE_PLAN_NODE,  llm_node(nodes.CREATE_LEAVE_PLAN_NODE))
+    graph_builder.add_node(nodes.ASK_LEAVE_PLAN_QUESTIONS_NODE, AskQuestions("leave_plan"))
+    graph_builder.add_node(nodes.CREATE_STAY_PLAN_NODE,  llm_node(nodes.CREATE_STAY_PLAN_NODE))
+    graph_builder.add_node(nodes.ASK_STAY_PLAN_QUESTIONS_NODE, AskQuestions("stay_plan"))
+    graph_builder.add_node(nodes.SHOW_PLAN_NODE,  llm_node(nodes.SHOW_PLAN_NODE))
+
+    # define edges to constrain what nodes are accessible from another
+    # fixed edges
+
+    graph_builder.add_edge(nodes.ASK_STAY_PLAN_QUESTIONS_NODE, nodes.CREATE_STAY_PLAN_NODE) 
+    graph_builder.add_edge(nodes.ASK_LEAVE_PLAN_QUESTIONS_NODE, nodes.CREATE_LEAVE_PLAN_NODE) 
+    graph_builder.add_edge(nodes.SHOW_PLAN_NODE, END)
+
+    if parallel:
+        add_parallel_assessment(graph_builder)
+    else:
+        add_sequential_assessment(graph_builder)
 
-graph = graph_builder.compile(
-    checkpointer=MemorySaver(),
-    interrupt_before=[]
-)
+    graph_builder.add_conditional_edges(
+        source=nodes.ASK_STRATEGY_NODE,
+        path=telemetry.route(nodes.ASK_STRATEGY_NODE, lambda state: value_with_default(state.defence_assessment.choice.last_choice, ['stay', 'leave'])),
+        path_map={
+            "stay": nodes.CREATE_STAY_PLAN_NODE,
+            "leave": nodes.CREATE_LEAVE_PLAN_NODE,
+            "default": nodes.ASK_STRATEGY_NODE
+        }
+    )
+
+    graph_builder.add_conditional_edges(
+        source=nodes.CREATE_LEAVE_PLAN_NODE,
+        path=telemetry.route(nodes.CREATE_LEAVE_PLAN_NODE, lambda state: value_with_default(state.leave_plan.plan_status, ['more', 'done'])),
+        path_map={
+            "more": nodes.ASK_LEAVE_PLAN_QUESTIONS_NODE,
+            "done": nodes.SHOW_PLAN_NODE,
+            "default": nodes.CREATE_LEAVE_PLAN_NODE
+        }
+    )
+
+    graph_builder.add_conditional_edges(
+        source=nodes.CREATE_STAY_PLAN_NODE,
+        path=telemetry.route(nodes.CREATE_STAY_PLAN_NODE, lambda state: value_with_default(state.stay_plan.plan_status, ['more', 'done'])),
+        path_map={
+            "more": nodes.ASK_STAY_PLAN_QUESTIONS_NODE,
+            "done": nodes.SHOW_PLAN_NODE,
+            "default": nodes.CREATE_STAY_PLAN_NODE
+        }
+    )
+
+    return graph_builder
+
+def add_sequential_assessment(graph_builder):
+    """
+    Risk is assessed (with its own question loop) before defence capability.
+    """
+    from langgraph.graph import START, END
+    from Questions import AskQuestions
+
+    telemetry = get_telemetry()
+    graph_builder.add_node(nodes.ASK_RISK_QUESTIONS_NODE, AskQuestions("risk_assessment"))
+    graph_builder.add_node(nodes.ASK_DEFENCE_QUESTIONS_NODE, AskQuestions("defence_assessment"))
+
+    graph_builder.add_edge(START, nodes.CLASSIFY_RISK_NODE)
+    graph_builder.add_edge(nodes.ASK_RISK_QUESTIONS_NODE, nodes.CLASSIFY_RISK_NODE)
+    graph_builder.add_edge(nodes.ASK_DEFENCE_QUESTIONS_NODE, nodes.ASSESS_DEFENCE_NODE) 
+
+    graph_builder.add_conditional_edges(
+        source=nodes.CLASSIFY_RISK_NODE,
+        path=telemetry.route(nodes.CLASSIFY_RISK_NODE, lambda state: value_with_default(state.risk_assessment.risk_level, ['low', 'high', 'unclear'])),
+        path_map={
+            "unclear": nodes.ASK_RISK_QUESTIONS_NODE,
+            "low": nodes.CONTINUE_WITH_PLAN_NODE,
+            "high": nodes.CONTINUE_WITH_PLAN_NODE,
+            "default": nodes.CLASSIFY_RISK_NODE
+        }
+    )
+
+    graph_builder.add_conditional_edges(
+        source=nodes.CONTINUE_WITH_PLAN_NODE,
+        path=telemetry.route(nodes.CONTINUE_WITH_PLAN_NODE, lambda state: value_with_default(state.risk_assessment.choice.last_choice, ['no', 'yes'])),
+        path_map={
+            "yes": nodes.ASSESS_DEFENCE_NODE,
+            "no": END,
+            "default": nodes.CONTINUE_WITH_PLAN_NODE
+        }
+    )
+
+    graph_builder.add_conditional_edges(
+        source=nodes.ASSESS_DEFENCE_NODE,
+        path=telemetry.route(nodes.ASSESS_DEFENCE_NODE, lambda state: value_with_default(state.defence_assessment.capability_level, ['low', 'high', 'unclear'])),
+        path_map={
+            "unclear": nodes.ASK_DEFENCE_QUESTIONS_NODE,
+            "low": nodes.ASK_STRATEGY_NODE,
+            "high": nodes.ASK_STRATEGY_NODE,
+            "default": nodes.ASSESS_DEFENCE_NODE
+        }
+    )
+
+def add_parallel_assessment(graph_builder):
+    """
+    Risk and defence capability are assessed at the same time. Their questions
+    are asked together in one questionnaire, and only the assessments that are
+    still unclear are re-run, until both are clear.
+    """
+    from langgraph.graph import START, END
+    from Questions import AskCombinedQuestions
+
+    telemetry = get_telemetry()
+    graph_builder.add_node(nodes.ASK_ASSESSMENT_QUESTIONS_NODE, AskCombinedQuestions(dict(ASSESSMENT_LEVELS.values())))
+
+    assessment_routes = [nodes.CLASSIFY_RISK_NODE, nodes.ASSESS_DEFENCE_NODE, nodes.CONTINUE_WITH_PLAN_NODE]
+    graph_builder.add_conditional_edges(START, telemetry.route(START, pending_assessments), assessment_routes)
+
+    # both assessments join at the combined questionnaire
+    graph_builder.add_edge(nodes.CLASSIFY_RISK_NODE, nodes.ASK_ASSESSMENT_QUESTIONS_NODE)
+    graph_builder.add_edge(nodes.ASSESS_DEFENCE_NODE, nodes.ASK_ASSESSMENT_QUESTIONS_NODE)
+    graph_builder.add_conditional_edges(nodes.ASK_ASSESSMENT_QUESTIONS_NODE, telemetry.route(nodes.ASK_ASSESSMENT_QUESTIONS_NODE, pending_assessments), assessment_routes)
+
+    graph_builder.add_conditional_edges(
+        source=nodes.CONTINUE_WITH_PLAN_NODE,
+        path=telemetry.route(nodes.CONTINUE_WITH_PLAN_NODE, lambda state: value_with_default(state.risk_assessment.choice.last_choice, ['no', 'yes'])),
+        path_map={
+            "yes": nodes.ASK_STRATEGY_NODE,
+            "no": END,
+            "default": nodes.CONTINUE_WITH_PLAN_NODE
+        }
+    )
+
+def compile_graph(checkpointer, layout=None):
+    return build_graph(layout or graph_layout).compile(
+        checkpointer=checkpointer,
+        interrupt_before=[]
+    )
+
+# Sessions kept in memory: checkpoints kept per session, seconds a session may be idle before it
+# is evicted, and megabytes of checkpoints before the least recently used sessions are evicted
+def make_memory_checkpointer():
+    from checkpointers import make_checkpointer
+    memory_limit = optional_number("CHECKPOINT_MEMORY_MB")
+    return make_checkpointer(
+        "memory",
+        keep=int(os.getenv("MEMORY_CHECKPOINT_KEEP", "10")),
+        ttl=optional_number("SESSION_TTL"),
+        max_bytes=int(memory_limit * 1024 * 1024) if memory_limit else None,
+    )
+
+def get_checkpointer():
+    return lazy("checkpointer", make_memory_checkpointer)
+
+def get_graph():
+    return lazy("graph", lambda: compile_graph(get_checkpointer()))
+
+def use_checkpointer(kind, path=None, keep=None):
+    """
+    Recompiles the graph with a different checkpointer, e.g. "sqlite" so sessions can be resumed.
+    """
+    from checkpointers import make_checkpointer
+    with build_lock:
+        built["checkpointer"] = make_checkpointer(
+            kind,
+            path or os.getenv("CHECKPOINT_DB", "checkpoints.db"),
+            int(keep if keep is not None else os.getenv("CHECKPOINT_KEEP", "10")),
+        )
+        built.pop("graph", None)
+
+def use_llm(chat_model):
+    """
+    Rebuilds the LLM nodes and recompiles the graph with a different chat model for every node, e.g. a fake model for benchmarks.
+    """
+    global llm_replaced
+    with build_lock:
+        llm_replaced = True
+        built["llm"] = chat_model
+        for name in ["llm_nodes", "history_summarizer", "graph"]:
+            built.pop(name, None)
+
+def use_layout(layout):
+    """
+    Recompiles the graph with a different layout, "sequential" or "parallel".
+    """
+    global graph_layout
+    with build_lock:
+        graph_layout = layout
+        built.pop("graph", None)
+
+# module attributes that are built on first use, e.g. main.graph
+LAZY_ATTRIBUTES = {
+    "llm": get_llm,
+    "llm_nodes": get_llm_nodes,
+    "response_cache": get_response_cache,
+    "history_summarizer": get_history_summarizer,
+    "session_budget": get_session_budget,
+    "checkpointer": get_checkpointer,
+    "graph": get_graph,
+    "telemetry": get_telemetry,
+}
+
+def __getattr__(name):
+    if name in LAZY_ATTRIBUTES:
+        return LAZY_ATTRIBUTES[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # diagram = graph.get_graph().draw_mermaid_png()
 # with open("diagram.png", "wb") as f:
 #     f.write(diagram)
 
-def run_chatbot():
-    print("\nAt any time, enter 'quit', 'exit' or just 'q' to exit\n")
-
-    thread_id = f"conversation_{int(time.time() * 1000)}"
-    config = {"configurable": {"thread_id": thread_id}}
-    
-    user_input = input("\n\nTell me about why you want to create a bushfire plan:\n")
-    check_quit(user_input)
-
-    prompt = """
+INTRO_PROMPT = """
 **Situation**
 You are an expert emergency management consultant specializing in Australian bushfire preparedness. 
 You're assisting me in creating a comprehensive bushfire survival plan tailored to 
@@ -170,26 +644,222 @@ Accept that I might not be able to answer your questions. When this happens
 do not ask the question again.
    """
 
-    graph.invoke({
-        "messages": [HumanMessage(content=prompt)],
-        "user_motivation": user_input,
-    }, config)
-
-    while True:
-        current_state = graph.get_state(config)
-        if not current_state.next or current_state.next == END:
-            # print_context(current_state)
-            plan = current_state.values.get('final_plan')
-            if plan:
-                print("\nPlanning complete - here is your plan:")
-                print("-" * 50)
-                for line in current_state.values['final_plan']['content']:
-                    print(line)
-            else:
-                print("Planning complete - no plan created")
-            break
-
-        graph.invoke(None, config)
+def initial_state(user_motivation):
+    from langchain_core.messages import HumanMessage
+
+    return {
+        "messages": [HumanMessage(content=INTRO_PROMPT)],
+        "user_motivation": user_motivation,
+    }
+
+# Per-node timings, token counts and route counts, exported when a session ends,
+# e.g. METRICS_JSON=metrics.json METRICS_PROM=metrics.prom, or served with METRICS_PORT=9100
+metrics_json = os.getenv("METRICS_JSON")
+metrics_prom = os.getenv("METRICS_PROM")
+
+def with_callbacks(config):
+    """
+    The config of a graph run, with the telemetry and budget callbacks and, when recording
+    (LLM_RECORD_DIR), the thread's responder wrapped so the answers are written to its cassette.
+    """
+    callbacks = list(config.get("callbacks") or [])
+    for handler in [get_telemetry().handler, get_session_budget().tracker]:
+        if handler not in callbacks:
+            callbacks.append(handler)
+    config = {**config, "callbacks": callbacks}
+
+    if llm_record_dir:
+        from cassettes import RecordingResponder
+        from responders import get_responder
+        responder = get_responder(config)
+        if not isinstance(responder, RecordingResponder):
+            thread_id = config["configurable"]["thread_id"]
+            config["configurable"] = {**config["configurable"], "responder": RecordingResponder(responder, get_cassette_recorder(), thread_id)}
+    return config
+
+def record_inputs(inputs, config):
+    """
+    Records the motivation a session starts with in its cassette, when recording.
+    """
+    if llm_record_dir and isinstance(inputs, dict) and inputs.get("user_motivation"):
+        get_cassette_recorder().record_human(config["configurable"]["thread_id"], "motivation", None, inputs["user_motivation"])
+
+def running(config):
+    """
+    Holds the thread in the checkpointer while the graph runs, so it is not evicted between steps.
+    """
+    checkpointer = get_checkpointer()
+    if not hasattr(checkpointer, "running"):
+        return contextlib.nullcontext()
+    return checkpointer.running(config["configurable"]["thread_id"])
+
+def invoke_graph(inputs, config, use_async=False):
+    config = with_callbacks(config)
+    record_inputs(inputs, config)
+    graph = get_graph()
+    with running(config):
+        if use_async:
+            return asyncio.run(graph.ainvoke(inputs, config))
+        return graph.invoke(inputs, config)
+
+def run_graph(inputs, config, use_async=False):
+    """
+    Runs a graph thread from the given inputs until it ends, returning the final state.
+    """
+    from langgraph.graph import END
+
+    try:
+        invoke_graph(inputs, config, use_async)
+
+        while True:
+            current_state = get_graph().get_state(config)
+            if not current_state.next or current_state.next == END:
+                return current_state
+
+            invoke_graph(None, config, use_async)
+    finally:
+        end_speculation(config["configurable"]["thread_id"])
+
+def end_speculation(thread_id):
+    """
+    Discards the speculative calls still pending for a thread that has ended or been abandoned.
+    """
+    if speculate:
+        from speculation import discard_thread
+        discard_thread(thread_id)
+
+def revise_session(config, question, answer):
+    """
+    Corrects an answer of a finished session, returning False when it cannot be revised.
+    """
+    from revisions import PlanReviser, RevisionError
+    try:
+        revision = PlanReviser(sys.modules[__name__]).revise(config, question, answer)
+    except RevisionError as error:
+        print(f"Cannot revise the session: {error}")
+        return False
+    print(f"Revised {question!r} in {revision['section']} from {revision['previous']!r} to {answer!r}")
+    print(f"Updating {', '.join(revision['affected'])}, starting with {', '.join(revision['rerun'])}")
+    return True
+
+def run_chatbot(use_async=False, resume_thread_id=None, revision=None, replay=None):
+    print("\nAt any time, enter 'quit', 'exit' or just 'q' to exit\n")
+
+    streamed = []
+    def print_plan(text):
+        if not streamed:
+            print("\nHere is your plan:")
+            print("-" * 50)
+        streamed.append(text)
+        print(text, end="", flush=True)
+
+    def reset_plan(text):
+        # the text already printed stays on the console, the part taken back follows again in full
+        print("\n\n(Writing that part of the plan again)\n", flush=True)
+
+    thread_id = resume_thread_id or f"conversation_{int(time.time() * 1000)}"
+    config = {"configurable": {"thread_id": thread_id, "plan_sink": print_plan, "plan_reset": reset_plan}}
+
+    if replay:
+        from cassettes import replay_session
+        print(f"Replaying {replay}")
+        current_state = replay_session(sys.modules[__name__], replay, use_async)
+    elif resume_thread_id:
+        saved_state = get_graph().get_state(config)
+        if not saved_state.values:
+            print(f"No saved session found for {thread_id}")
+            return
+        print(f"Resuming session {thread_id}")
+        if revision and not revise_session(config, *revision):
+            return
+        current_state = saved_state if not (saved_state.next or revision) else run_graph(None, config, use_async)
+    else:
+        print(f"Your session id is {thread_id}")
+
+        user_input = input("\n\nTell me about why you want to create a bushfire plan:\n")
+        check_quit(user_input)
+
+        current_state = run_graph(initial_state(user_input), config, use_async)
+
+    # print_context(current_state)
+    plan = current_state.values.get('final_plan')
+    if plan and streamed:
+        print("-" * 50)
+        print("Planning complete")
+    elif plan:
+        print("\nPlanning complete - here is your plan:")
+        print("-" * 50)
+        for line in current_state.values['final_plan']['content']:
+            print(line)
+    else:
+        print("Planning complete - no plan created")
+
+    response_cache = get_response_cache()
+    if response_cache:
+        print(f"\nResponse cache: {response_cache.stats()}")
+
+    if speculate:
+        from speculation import speculation_report
+        speculators = [node.speculator for node in get_llm_nodes().values() if hasattr(node, "speculator")]
+        print(f"\nSpeculation: {speculation_report(speculators)}")
+
+    forced = {node: usage["forced"] for node, usage in (current_state.values.get("budget_usage") or {}).items() if "forced" in usage}
+    if forced:
+        print(f"\nBudget limits reached: {forced}")
+
+    context_totals = context_report(get_llm_nodes().values())
+    if context_totals["reused_fragments"]:
+        print(f"\nPrompt {describe_stats(context_totals)}")
+
+    savings = encoding_savings(current_state.values, CONTEXT_SECTIONS)
+    if savings:
+        saved = {section: f"{usage['saved_tokens']} tokens ({usage['saved_percent']}%)" for section, usage in savings.items()}
+        print(f"\nPrompt tokens saved by the compact section encoding: {saved}")
+
+    history_summarizer = get_history_summarizer()
+    if history_summarizer and history_summarizer.stats["compactions"]:
+        print(f"\nConversation summaries: {history_summarizer.stats}")
+
+    if node_deployments:
+        print("\nModel routes:")
+        for route in get_telemetry().model_routes():
+            print(f"  {route}")
+
+    get_telemetry().export(metrics_json, metrics_prom)
 
 if __name__ == "__main__":
-    run_chatbot()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Bushfire Plan Generator")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="run the graph with async nodes")
+    parser.add_argument("--checkpointer", choices=["memory", "sqlite"], default=os.getenv("CHECKPOINTER", "memory"), help="where sessions are saved")
+    parser.add_argument("--checkpoint-db", help="SQLite file for the sqlite checkpointer (default: checkpoints.db)")
+    parser.add_argument("--keep-checkpoints", type=int, help="checkpoints kept per session by the sqlite checkpointer (default: 10)")
+    parser.add_argument("--resume", metavar="SESSION_ID", help="resume a saved session")
+    parser.add_argument("--revise", metavar="QUESTION=ANSWER", help="with --resume, correct the answer to a question of a finished session and update only what depends on it")
+    parser.add_argument("--layout", choices=["sequential", "parallel"], default=graph_layout, help="assess risk then defence, or both at once")
+    parser.add_argument("--replay", metavar="CASSETTE", help="replay a recorded session with its answers, served from the cassette unless LLM_REPLAY is set")
+    args = parser.parse_args()
+
+    if args.replay:
+        if args.resume:
+            parser.error("--replay starts a session of its own, it cannot be used with --resume")
+        llm_replay = llm_replay or args.replay
+
+    if os.getenv("METRICS_PORT"):
+        get_telemetry().serve(int(os.getenv("METRICS_PORT")))
+
+    if args.layout != graph_layout:
+        use_layout(args.layout)
+
+    if args.checkpointer != "memory":
+        use_checkpointer(args.checkpointer, args.checkpoint_db, args.keep_checkpoints)
+    elif args.resume:
+        parser.error("--resume needs a saved session, e.g. --checkpointer sqlite")
+
+    revision = None
+    if args.revise:
+        question, _, answer = args.revise.rpartition("=")
+        if not args.resume or not question:
+            parser.error("--revise needs --resume and a QUESTION=ANSWER")
+        revision = (question.strip(), answer.strip())
+
+    run_chatbot(use_async=args.use_async, resume_thread_id=args.resume, revision=revision, replay=args.replay)
\ No newline at end of file
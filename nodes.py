@@ -5,6 +5,7 @@ ASK_CHOICE_NODE = "ask_choice_node"
 CLASSIFY_RISK_NODE = "classify_risk_node"
 ASSESS_DEFENCE_NODE = "assess_defence_node"
 ASK_DEFENCE_QUESTIONS_NODE = "ask_defence_questions_node"
+ASK_ASSESSMENT_QUESTIONS_NODE = "ask_assessment_questions_node"
 ASK_STRATEGY_NODE = "ask_strategy_node"
 CREATE_LEAVE_PLAN_NODE = "create_leave_plan_node"
 ASK_LEAVE_PLAN_QUESTIONS_NODE = "ask_leave_plan_questions_node"
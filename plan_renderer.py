@@ -0,0 +1,105 @@
+import datetime
+
+LEAVE_SECTIONS = [
+    ("when_to_leave", "When to Leave"),
+    ("where_to_go", "Where to Go"),
+    ("how_to_get_there", "How to Get There"),
+    ("what_to_take", "What to Take"),
+    ("who_to_tell", "Who to Tell"),
+    ("backup_plan", "Backup Plan"),
+]
+
+STAY_SECTIONS = [
+    ("when_to_start", "When to Start Defending"),
+    ("before_the_fire", "Before the Fire"),
+    ("during_the_fire", "During the Fire"),
+    ("after_the_fire", "After the Fire"),
+    ("who_can_help", "Who Can Help"),
+    ("peoples_roles", "People's Roles"),
+    ("backup_plan", "Backup Plan"),
+]
+
+LEVELS = {"high": "HIGH", "low": "LOW", "unclear": "UNCLEAR - treat as HIGH"}
+
+MISSING = "_Not yet decided - complete this section before the fire season._"
+
+def get_section(state, section):
+    return state.get(section) if isinstance(state, dict) else getattr(state, section, None)
+
+def get_field(value, field):
+    return value.get(field) if isinstance(value, dict) else getattr(value, field, None)
+
+def paragraph(text):
+    text = str(text or "").strip()
+    return text if text else MISSING
+
+def level(value):
+    value = str(value or "unclear").lower()
+    return f"**{LEVELS.get(value, value.upper())}**"
+
+def decision(state):
+    """
+    "leave" or "stay": the user's last choice of strategy, or else the plan that
+    was created, or None before either exists. The choice comes first, as the
+    other strategy's plan is still in the state when the user has changed their mind.
+    """
+    defence = get_section(state, "defence_assessment")
+    choice = str(get_field(get_field(defence, "choice"), "last_choice") or "").strip().lower() if defence else ""
+    if choice in ("leave", "stay"):
+        return choice
+    if get_section(state, "stay_plan"):
+        return "stay"
+    if get_section(state, "leave_plan"):
+        return "leave"
+    return None
+
+def plan_summary(state):
+    """
+    A one-line summary of the assessments and decision, for writing a section without the rest of the plan.
+    """
+    parts = []
+    risk = get_section(state, "risk_assessment")
+    defence = get_section(state, "defence_assessment")
+    if risk:
+        parts.append(f"Risk level: {LEVELS.get(str(get_field(risk, 'risk_level') or 'unclear').lower(), 'UNCLEAR')}.")
+    if defence:
+        parts.append(f"Capability to defend: {LEVELS.get(str(get_field(defence, 'capability_level') or 'unclear').lower(), 'UNCLEAR')}.")
+    strategy = decision(state)
+    if strategy:
+        parts.append("Decision: stay and defend." if strategy == "stay" else "Decision: leave early.")
+    return " ".join(parts)
+
+def render_sections(state, today=None):
+    """
+    The plan document as (key, markdown) sections, built directly from the
+    assessments and the leave or stay plan in the state. Each section starts
+    with its heading, so a section can be rewritten on its own (see ShowPlan).
+    """
+    today = today or datetime.date.today()
+    risk = get_section(state, "risk_assessment")
+    defence = get_section(state, "defence_assessment")
+    strategy = decision(state)
+
+    sections = [("title", f"# Bushfire Survival Plan - {today.day} {today:%B %Y}")]
+
+    if risk:
+        sections.append(("risk_summary", f"## Risk Summary\n\n{paragraph(get_field(risk, 'assessment'))}"))
+        sections.append(("risk_level", f"## Risk Level\n\n{level(get_field(risk, 'risk_level'))}\n\n{paragraph(get_field(risk, 'message'))}"))
+
+    if defence:
+        capability = f"{level(get_field(defence, 'capability_level'))}\n\n{paragraph(get_field(defence, 'assessment'))}"
+        sections.append(("capability", f"## Capability to Defend\n\n{capability}"))
+
+    if strategy == "stay":
+        sections.append(("decision", "## Decision\n\n**Stay and defend.** Only stay if you are well prepared and able to defend your home; leaving early is always the safest option."))
+        plan, fields, heading = get_section(state, "stay_plan"), STAY_SECTIONS, "Stay and Defend Plan"
+    elif strategy == "leave":
+        sections.append(("decision", "## Decision\n\n**Leave early.** Leave well before the fire arrives, do not wait and see."))
+        plan, fields, heading = get_section(state, "leave_plan"), LEAVE_SECTIONS, "Leave Early Plan"
+    else:
+        return sections
+
+    sections.append(("plan", f"## {heading}"))
+    for field, title in fields:
+        sections.append((field, f"### {title}\n\n{paragraph(get_field(plan, field))}"))
+    return sections
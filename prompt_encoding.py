@@ -0,0 +1,82 @@
+import json
+
+INDENT = "  "
+
+def estimate_tokens(text):
+    """
+    A rough token count (about four characters per token), as in summarizer.py.
+    """
+    return len(str(text or "")) // 4
+
+def is_empty(value):
+    return value is None or value == "" or value == [] or value == {}
+
+def compact(value):
+    """
+    The value without null or empty fields, and without questions that have
+    already been answered, as these appear again as keys of `answers`.
+    """
+    if isinstance(value, dict):
+        answers = value.get("answers") or {}
+        items = {}
+        for key, item in value.items():
+            if key == "questions" and isinstance(item, list):
+                item = [question for question in item if question not in answers]
+            item = compact(item)
+            if not is_empty(item):
+                items[key] = item
+        return items
+    if isinstance(value, list):
+        return [item for item in (compact(item) for item in value) if not is_empty(item)]
+    return value
+
+def encode_lines(value, depth=0):
+    indent = INDENT * depth
+    lines = []
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if isinstance(item, (dict, list)):
+                lines.append(f"{indent}{key}:")
+                lines.extend(encode_lines(item, depth + 1))
+            else:
+                lines.append(f"{indent}{key}: {item}")
+    elif isinstance(value, list):
+        for item in value:
+            if isinstance(item, (dict, list)):
+                lines.append(f"{indent}-")
+                lines.extend(encode_lines(item, depth + 1))
+            else:
+                lines.append(f"{indent}- {item}")
+    else:
+        lines.append(f"{indent}{value}")
+    return lines
+
+def encode_section(section):
+    """
+    A state section (e.g. RiskAnalysis) as it is given to the model: one
+    "key: value" line per field, nested fields indented, with null and empty
+    fields and already answered questions left out.
+    """
+    data = section.model_dump() if hasattr(section, "model_dump") else section
+    return "\n".join(encode_lines(compact(data)))
+
+def encoding_savings(state, sections):
+    """
+    The estimated prompt tokens of each section of the state, `sections` being
+    (field, title) pairs, in the previous indented JSON encoding and in the
+    compact encoding.
+    """
+    savings = {}
+    for section, title in sections:
+        value = state.get(section) if isinstance(state, dict) else getattr(state, section, None)
+        if not value:
+            continue
+        json_tokens = estimate_tokens(f"{title}: {json.dumps(value.model_dump(), indent=4)}")
+        compact_tokens = estimate_tokens(f"{title}:\n{encode_section(value)}")
+        savings[section] = {
+            "json_tokens": json_tokens,
+            "compact_tokens": compact_tokens,
+            "saved_tokens": json_tokens - compact_tokens,
+            "saved_percent": round(100 * (json_tokens - compact_tokens) / json_tokens, 1) if json_tokens else 0.0,
+        }
+    return savings
@@ -0,0 +1,192 @@
+import os
+import re
+import csv
+import sqlite3
+import argparse
+import functools
+import threading
+
+REGION_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "regions")
+REGION_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "regions.db")
+
+# Australian postcode ranges by state, for postcodes that are not in the locality list
+STATE_RANGES = [
+    (200, 299, "ACT"), (800, 999, "NT"), (1000, 2599, "NSW"), (2600, 2618, "ACT"), (2619, 2899, "NSW"),
+    (2900, 2920, "ACT"), (2921, 2999, "NSW"), (3000, 3999, "VIC"), (4000, 4999, "QLD"), (5000, 5999, "SA"),
+    (6000, 6999, "WA"), (7000, 7999, "TAS"), (8000, 8999, "VIC"), (9000, 9999, "QLD"),
+]
+
+# a postcode in free text needs a label, e.g. "postcode 2780" or "NSW 2780", so years are not taken for postcodes
+LABELLED_POSTCODE = re.compile(r"(?:post\s*code|\b(?:nsw|act|vic|qld|sa|wa|tas|nt))\W{0,3}(\d{4})\b", re.IGNORECASE)
+POSTCODE = re.compile(r"\b(\d{4})\b")
+PLACE = re.compile(r"\b(?:in|near|at|from|outside|live)\s+([A-Z][a-z]+(?:\s+[A-Z][a-z]+){0,2})")
+LOCATION_QUESTION = re.compile(r"town|suburb|locality|location|located|address|where", re.IGNORECASE)
+POSTCODE_QUESTION = re.compile(r"post\s*code", re.IGNORECASE)
+
+SCHEMA = """
+CREATE TABLE states (state TEXT PRIMARY KEY, name TEXT, fire_authority TEXT, fire_season TEXT, warnings TEXT) WITHOUT ROWID;
+CREATE TABLE localities (postcode INTEGER, locality TEXT COLLATE NOCASE, state TEXT, PRIMARY KEY (postcode, locality)) WITHOUT ROWID;
+CREATE INDEX localities_by_name ON localities (locality COLLATE NOCASE);
+"""
+
+def postcode_state(postcode):
+    for low, high, state in STATE_RANGES:
+        if low <= postcode <= high:
+            return state
+    return None
+
+def read_csv(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        return list(csv.DictReader(f))
+
+def build(path, data_dir=REGION_DATA_DIR, postcodes=None):
+    """
+    Builds the SQLite region index at `path` from states.csv and postcodes.csv
+    (postcode, locality and state columns) in `data_dir`, or from another
+    postcode file, e.g. a full list of Australian localities.
+    """
+    states = read_csv(os.path.join(data_dir, "states.csv"))
+    localities = read_csv(postcodes or os.path.join(data_dir, "postcodes.csv"))
+
+    # per process, so two processes building at once do not write to the same file
+    building = f"{path}.{os.getpid()}.building"
+    if os.path.exists(building):
+        os.remove(building)
+    connection = sqlite3.connect(building)
+    with connection:
+        connection.executescript(SCHEMA)
+        connection.executemany(
+            "INSERT INTO states VALUES (?, ?, ?, ?, ?)",
+            [(row["state"], row["name"], row["fire_authority"], row["fire_season"], row["warnings"]) for row in states],
+        )
+        connection.executemany(
+            "INSERT OR IGNORE INTO localities VALUES (?, ?, ?)",
+            [(int(row["postcode"]), row["locality"].strip(), row["state"].strip().upper()) for row in localities],
+        )
+    connection.execute("VACUUM")
+    connection.close()
+    # replaced in one step, so a running process never sees a half-built index
+    os.replace(building, path)
+    return len(localities)
+
+def is_stale(path, data_dir=REGION_DATA_DIR):
+    if not os.path.exists(path):
+        return True
+    built = os.path.getmtime(path)
+    return any(
+        os.path.getmtime(os.path.join(data_dir, name)) > built
+        for name in os.listdir(data_dir) if name.endswith(".csv")
+    )
+
+class RegionIndex:
+    """
+    Region facts (state, fire authority, fire season and where warnings are
+    published) by postcode or locality, from a prebuilt read-only SQLite file
+    that is memory-mapped rather than loaded. Lookups are cached, so the
+    postcode of a session is only looked up once.
+
+    Postcodes not in the locality list still resolve to their state from the
+    Australian postcode ranges.
+    """
+    def __init__(self, path, cache_size=4096):
+        self.connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        self.connection.execute("PRAGMA mmap_size = 67108864")
+        self.lock = threading.Lock()
+        self.states = {
+            row[0]: {"state": row[0], "name": row[1], "fire_authority": row[2], "fire_season": row[3], "warnings": row[4]}
+            for row in self.connection.execute("SELECT * FROM states")
+        }
+        self.by_postcode = functools.lru_cache(maxsize=cache_size)(self.find_postcode)
+        self.by_locality = functools.lru_cache(maxsize=cache_size)(self.find_locality)
+
+    @classmethod
+    def open(cls, path=REGION_DB, data_dir=REGION_DATA_DIR):
+        """
+        The index at `path`, built first if it is missing or older than any CSV file in `data_dir`.
+        """
+        if is_stale(path, data_dir):
+            build(path, data_dir)
+        return cls(path)
+
+    def query(self, sql, parameters):
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def facts(self, postcode, locality, state):
+        facts = {"postcode": f"{postcode:04d}" if postcode is not None else None, "locality": locality}
+        facts.update(self.states.get(state) or {"state": state})
+        return {key: value for key, value in facts.items() if value}
+
+    def find_postcode(self, postcode):
+        rows = self.query("SELECT locality, state FROM localities WHERE postcode = ?", (postcode,))
+        if rows:
+            return self.facts(postcode, ", ".join(locality for locality, _ in rows), rows[0][1])
+        state = postcode_state(postcode)
+        return self.facts(postcode, None, state) if state else None
+
+    def find_locality(self, name):
+        rows = self.query("SELECT postcode, locality, state FROM localities WHERE locality = ?", (name.strip(),))
+        if not rows or len({state for _, _, state in rows}) > 1:
+            # unknown, or a name used in more than one state
+            return None
+        postcode = rows[0][0] if len(rows) == 1 else None
+        return self.facts(postcode, rows[0][1], rows[0][2])
+
+    def resolve(self, motivation=None, answers=None):
+        """
+        The facts for the last postcode or locality given in the answers, or else in the motivation.
+        """
+        found = None
+        for question, answer in (answers or {}).items():
+            found = self.match(answer, POSTCODE_QUESTION.search(question), LOCATION_QUESTION.search(question)) or found
+        return found or self.match(motivation, False, False)
+
+    def match(self, text, postcode_question, location_question):
+        text = str(text or "")
+        postcodes = (POSTCODE if postcode_question else LABELLED_POSTCODE).findall(text)
+        for postcode in reversed(postcodes):
+            facts = self.by_postcode(int(postcode))
+            if facts:
+                return facts
+
+        places = PLACE.findall(text)
+        if location_question:
+            # a short answer may be just the place, e.g. "olinda" or "Roleystone, WA"
+            places += [part for part in re.split(r"[,;]", text) if len(part.split()) <= 4]
+        for place in reversed(places):
+            words = place.split()
+            # the longest run of words that is a known locality, e.g. "Mount Macedon" before "Macedon"
+            for length in range(len(words), 0, -1):
+                for start in range(len(words) - length + 1):
+                    facts = self.by_locality(" ".join(words[start:start + length]))
+                    if facts:
+                        return facts
+        return None
+
+def describe(facts):
+    labels = [
+        ("postcode", "postcode"),
+        ("locality", "locality"),
+        ("name", "state"),
+        ("fire_authority", "fire authority"),
+        ("fire_season", "fire season"),
+        ("warnings", "warnings and updates"),
+    ]
+    return "\n".join(f"{label}: {facts[key]}" for key, label in labels if facts.get(key))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the region index used in the risk assessment, or look up a postcode or locality")
+    parser.add_argument("--db", default=os.getenv("REGION_DB") or REGION_DB, help="SQLite file for the index")
+    parser.add_argument("--data", default=REGION_DATA_DIR, help="folder with states.csv and postcodes.csv")
+    parser.add_argument("--postcodes", help="CSV of postcode, locality and state to use instead of the folder's postcodes.csv")
+    parser.add_argument("--lookup", help="postcode or locality to look up in the index")
+    args = parser.parse_args()
+
+    if args.lookup:
+        index = RegionIndex.open(args.db, args.data)
+        lookup = args.lookup.strip()
+        facts = index.by_postcode(int(lookup)) if lookup.isdigit() else index.by_locality(lookup)
+        print(describe(facts) if facts else f"{lookup} is not in the index")
+    else:
+        count = build(args.db, args.data, args.postcodes)
+        print(f"Indexed {count} localities in {args.db}")
@@ -0,0 +1,108 @@
+import re
+from context_utils import check_quit
+
+STOP_WORDS = {
+    "a", "an", "and", "any", "are", "at", "be", "can", "do", "does", "for", "have", "how", "i", "if",
+    "in", "is", "it", "many", "of", "on", "or", "the", "there", "to", "what", "when", "where", "which",
+    "who", "will", "with", "you", "your",
+}
+
+def get_responder(config):
+    """
+    The responder for the current graph thread, set in config["configurable"]["responder"].
+    Defaults to asking on the console.
+    """
+    configurable = (config or {}).get("configurable", {})
+    return configurable.get("responder") or console_responder
+
+def ask_all(responder, questions):
+    """
+    The responder's answers to a list of questions, as question -> answer. Responders that can
+    take all the questions at once (e.g. InterruptResponder) do, others are asked one at a time.
+    """
+    if hasattr(responder, "ask_all"):
+        return responder.ask_all(questions)
+    return {question: responder.ask(question) for question in questions}
+
+def words(text):
+    return {word for word in re.findall(r"[a-z0-9]+", str(text).lower()) if word not in STOP_WORDS}
+
+class ConsoleResponder:
+    """
+    Asks the user on the console.
+    """
+    def ask(self, question):
+        user_input = input(f"\n{question}\nYour answer: ")
+        check_quit(user_input)
+        return user_input
+
+    def choose(self, choice, options):
+        while True:
+            user_input = input(f"\n{choice}\nYour choice: {'/'.join(options)}: ")
+            check_quit(user_input)
+            for option in options:
+                if user_input.lower() == option.lower():
+                    return option
+            print(f"\nInvalid choice. Please select from: {'/'.join(options)}")
+
+console_responder = ConsoleResponder()
+
+class InterruptResponder:
+    """
+    Pauses the graph with a LangGraph interrupt instead of prompting, so the
+    answers can come from outside the process (see service.py). The graph is
+    resumed with Command(resume=...): the answers as question -> answer, or
+    the option chosen. An invalid choice is asked for again.
+    """
+    def ask_all(self, questions):
+        from langgraph.types import interrupt
+        answers = interrupt({"type": "questions", "questions": list(questions)}) or {}
+        return {question: str(answers.get(question) or "unknown") for question in questions}
+
+    def ask(self, question):
+        return self.ask_all([question])[question]
+
+    def choose(self, choice, options):
+        from langgraph.types import interrupt
+        while True:
+            user_input = interrupt({"type": "choice", "choice": choice, "options": list(options)})
+            for option in options:
+                if str(user_input).lower() == option.lower():
+                    return option
+
+interrupt_responder = InterruptResponder()
+
+class ProfileResponder:
+    """
+    Answers questions from a property profile instead of prompting.
+
+    Each question is answered with the profile field whose name (and value)
+    best overlaps the words in the question, or "unknown" when nothing matches.
+    Choices are answered with the preselected strategy where it is one of the
+    options, otherwise with the first option (e.g. "yes" to continue).
+    """
+    def __init__(self, profile, strategy):
+        self.profile = {key: value for key, value in profile.items() if value not in (None, "")}
+        self.strategy = strategy
+        self.fields = [(words(key.replace("_", " ")), words(value), value) for key, value in self.profile.items()]
+        self.unanswered = 0
+
+    def ask(self, question):
+        question_words = words(question)
+        best_score, best_value = 0, None
+        for key_words, value_words, value in self.fields:
+            # a match on the field name counts for more than a match on its value
+            score = 2 * len(question_words & key_words) + len(question_words & value_words)
+            if score > best_score:
+                best_score, best_value = score, value
+
+        if best_value is None:
+            self.unanswered += 1
+            return "unknown"
+        return str(best_value)
+
+    def choose(self, choice, options):
+        for option in options:
+            if option.lower() == str(self.strategy).lower():
+                return option
+        return options[0]
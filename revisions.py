@@ -0,0 +1,126 @@
+import time
+import nodes
+from StateTypes import GraphState
+
+# the sections computed (directly or not) from each section of the state
+SECTION_DEPENDENTS = {
+    "risk_assessment": ["defence_assessment", "leave_plan", "stay_plan", "final_plan"],
+    "defence_assessment": ["leave_plan", "stay_plan", "final_plan"],
+    "leave_plan": ["final_plan"],
+    "stay_plan": ["final_plan"],
+}
+
+# the node whose questions fill each section's answers, for each graph layout; a revised
+# section is written as if by this node, so the graph goes on with the node that uses the answers
+ANSWER_NODES = {
+    "sequential": {
+        "risk_assessment": nodes.ASK_RISK_QUESTIONS_NODE,
+        "defence_assessment": nodes.ASK_DEFENCE_QUESTIONS_NODE,
+        "leave_plan": nodes.ASK_LEAVE_PLAN_QUESTIONS_NODE,
+        "stay_plan": nodes.ASK_STAY_PLAN_QUESTIONS_NODE,
+    },
+    "parallel": {
+        "risk_assessment": nodes.ASK_ASSESSMENT_QUESTIONS_NODE,
+        "defence_assessment": nodes.ASK_ASSESSMENT_QUESTIONS_NODE,
+        "leave_plan": nodes.ASK_LEAVE_PLAN_QUESTIONS_NODE,
+        "stay_plan": nodes.ASK_STAY_PLAN_QUESTIONS_NODE,
+    },
+}
+
+# levels that are reset when an assessment's answers change, so the assessment is made again
+REASSESSED_LEVELS = {"risk_assessment": "risk_level", "defence_assessment": "capability_level"}
+
+class RevisionError(Exception):
+    pass
+
+def get_section(values, section):
+    # as the section's model, whether the checkpoint holds the model or a dict
+    value = values.get(section)
+    return getattr(GraphState.model_validate({section: value}), section) if isinstance(value, dict) else value
+
+def section_answers(values):
+    """
+    The answers given so far, as section -> {question: answer}: those kept in the
+    state's answers, with any still only in the sections (e.g. in sessions saved
+    before the state kept them).
+    """
+    answers = {}
+    for section in SECTION_DEPENDENTS:
+        value = get_section(values, section)
+        questions = getattr(value, "questions", None)
+        if questions and questions.answers:
+            answers[section] = dict(questions.answers)
+    for section, given in (values.get("answers") or {}).items():
+        answers[section] = {**answers.get(section, {}), **given}
+    return answers
+
+class PlanReviser:
+    """
+    Corrects an answer of a finished session without starting again. The
+    answer is patched into the latest checkpoint with update_state, as if
+    given by the node that asked it, so when the session is resumed only the
+    nodes downstream of that section run again: a changed leave plan answer
+    re-runs create_leave_plan_node and show_plan_node, and show_plan_node
+    reuses the polished sections whose content has not changed.
+
+    Answers are read from the state's answers, which keep every answer given
+    even after the model leaves it out of a section, and each revision is
+    recorded in the state's revisions, so neither depends on the checkpointer
+    keeping earlier checkpoints.
+    """
+    def __init__(self, graph_module):
+        self.graph_module = graph_module
+
+    def revise(self, config, question, answer, section=None):
+        graph = self.graph_module.get_graph()
+        snapshot = graph.get_state(config)
+        if not snapshot.values:
+            raise RevisionError("No saved session to revise")
+        if snapshot.next:
+            raise RevisionError("Only a finished session can be revised")
+
+        values = snapshot.values
+        section, earlier_answers = self.find_answers(values, question, section)
+        if section not in SECTION_DEPENDENTS or not values.get(section):
+            raise RevisionError(f"The session has no {section}")
+
+        revised = get_section(values, section).model_copy(deep=True)
+        # answers the model left out of its last version of the section are put back
+        answers = {**earlier_answers, **revised.questions.answers}
+        previous = answers.get(question)
+        revised.questions.answers = {**answers, question: answer}
+        if section in REASSESSED_LEVELS:
+            setattr(revised, REASSESSED_LEVELS[section], "unclear")
+
+        revision = {"section": section, "question": question, "previous": previous, "answer": answer, "revised_at": time.time()}
+        as_node = ANSWER_NODES[self.graph_module.graph_layout][section]
+        graph.update_state(config, {section: revised, "answers": {section: {question: answer}}, "revisions": [revision]}, as_node=as_node)
+        return {
+            "section": section,
+            "question": question,
+            "previous": previous,
+            "answer": answer,
+            "affected": [section] + [dependent for dependent in SECTION_DEPENDENTS[section] if values.get(dependent)],
+            "rerun": list(graph.get_state(config).next),
+        }
+
+    def find_answers(self, values, question, section=None):
+        """
+        The section the question was asked for, and that section's answers.
+        """
+        answers = section_answers(values)
+        # the last section to have asked it, as it is the one most affected by the answer
+        sections = [name for name in SECTION_DEPENDENTS if question in answers.get(name, {}) and name == (section or name)]
+        if sections:
+            return sections[-1], answers[sections[-1]]
+        if section:
+            # a new answer for the section
+            return section, answers.get(section, {})
+        raise RevisionError(f"No answer has been given to {question!r}")
+
+    def history(self, config):
+        """
+        The revisions made to the session, newest first.
+        """
+        values = self.graph_module.get_graph().get_state(config).values or {}
+        return list(reversed(values.get("revisions") or []))
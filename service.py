@@ -0,0 +1,369 @@
+import os
+import json
+import time
+import uuid
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# events kept per session for clients that connect late or reconnect
+MAX_EVENTS = 2000
+KEEPALIVE_SECONDS = 15
+
+class ServiceError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+class Session:
+    """
+    A planning session hosted by the service: its status, the question or
+    choice it is waiting on, and the events published to its SSE clients.
+    """
+    def __init__(self, session_id):
+        self.id = session_id
+        self.condition = threading.Condition()
+        self.events = []
+        self.next_event_id = 0
+        self.status = "starting"
+        self.pending = None
+        self.used = time.monotonic()
+
+    def publish(self, event, data):
+        with self.condition:
+            self.events.append((self.next_event_id, event, data))
+            self.next_event_id += 1
+            del self.events[:-MAX_EVENTS]
+            self.condition.notify_all()
+
+    def events_after(self, last_id, timeout):
+        """
+        The events after last_id, waiting up to timeout seconds for one to be published.
+        """
+        with self.condition:
+            if self.next_event_id - 1 <= last_id:
+                self.condition.wait(timeout)
+            return [event for event in self.events if event[0] > last_id]
+
+    def describe(self):
+        return {"session_id": self.id, "status": self.status, "pending": self.pending}
+
+class SessionService:
+    """
+    Hosts many planning sessions on the one compiled graph. Questions and
+    choices interrupt the graph (see InterruptResponder) rather than waiting
+    for input, so a session waiting on its user holds no thread: its state is
+    in the checkpointer until the answers are posted and the graph resumed on
+    one of `workers` threads.
+    """
+    def __init__(self, graph_module, workers=16, ttl=None):
+        self.graph_module = graph_module
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="session")
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.sessions = {}
+
+    def config(self, session):
+        from responders import interrupt_responder
+        return self.graph_module.with_callbacks({
+            "configurable": {
+                "thread_id": session.id,
+                "responder": interrupt_responder,
+                "plan_sink": lambda text: session.publish("plan", {"text": text}),
+                "plan_reset": lambda text: session.publish("plan_reset", {"text": text}),
+            },
+        })
+
+    def start(self, motivation):
+        session = Session(f"session_{uuid.uuid4().hex}")
+        with self.lock:
+            self.evict()
+            self.sessions[session.id] = session
+        self.run(session, self.graph_module.initial_state(motivation))
+        return session
+
+    def get(self, session_id):
+        """
+        The session, reattached from the checkpointer if it was started before a restart.
+        """
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if not session:
+                snapshot = self.graph_module.get_graph().get_state({"configurable": {"thread_id": session_id}})
+                if not snapshot.values:
+                    raise ServiceError(404, f"No session {session_id}")
+                session = Session(session_id)
+                self.settle(session, snapshot)
+                self.sessions[session_id] = session
+            session.used = time.monotonic()
+            return session
+
+    def run(self, session, inputs):
+        with session.condition:
+            if session.status == "running":
+                raise ServiceError(409, "The session is still running")
+            session.status = "running"
+            session.pending = None
+        session.publish("status", session.describe())
+        self.executor.submit(self.advance, session, inputs)
+
+    def advance(self, session, inputs):
+        """
+        Runs the session's graph until it is interrupted for input or ends, publishing each node as it finishes.
+        """
+        graph = self.graph_module.get_graph()
+        config = self.config(session)
+        self.graph_module.record_inputs(inputs, config)
+        try:
+            with self.graph_module.running(config):
+                while True:
+                    for update in graph.stream(inputs, config, stream_mode="updates"):
+                        for node in update:
+                            if not node.startswith("__"):
+                                session.publish("node", {"node": node})
+                    snapshot = graph.get_state(config)
+                    if self.settle(session, snapshot):
+                        break
+                    inputs = None
+        except Exception as error:
+            with session.condition:
+                session.status = "error"
+            self.graph_module.end_speculation(session.id)
+            session.publish("error", {"error": repr(error)})
+            return
+
+        if session.pending:
+            session.publish(session.pending["type"], session.pending)
+        elif session.status == "done":
+            self.graph_module.end_speculation(session.id)
+            session.publish("done", {"plan": self.plan(snapshot)})
+        session.publish("status", session.describe())
+
+    def settle(self, session, snapshot):
+        """
+        Sets the session's status from the graph state, returning False when the graph should carry on.
+        """
+        interrupts = [interrupt.value for task in snapshot.tasks for interrupt in task.interrupts]
+        with session.condition:
+            if interrupts:
+                session.status, session.pending = "waiting", interrupts[0]
+            elif not snapshot.next:
+                session.status, session.pending = "done", None
+            else:
+                return False
+        return True
+
+    def plan(self, snapshot):
+        final_plan = snapshot.values.get("final_plan")
+        content = final_plan.get("content") if isinstance(final_plan, dict) else getattr(final_plan, "content", None)
+        return "\n".join(content or [])
+
+    def resume(self, session_id, kind, value):
+        from langgraph.types import Command
+        session = self.get(session_id)
+        with session.condition:
+            pending = session.pending
+        if session.status != "waiting" or not pending or pending["type"] != kind:
+            raise ServiceError(409, f"The session is not waiting for {kind}")
+        if not self.graph_module.get_graph().get_state(self.config(session)).values:
+            # idle for longer than the checkpointer keeps sessions, so there is nothing left to resume
+            with self.lock:
+                self.sessions.pop(session_id, None)
+            raise ServiceError(404, f"Session {session_id} has expired")
+        if kind == "choice" and str(value).lower() not in [option.lower() for option in pending["options"]]:
+            raise ServiceError(400, f"Choose one of: {'/'.join(pending['options'])}")
+        self.run(session, Command(resume=value))
+        return session
+
+    def answer(self, session_id, answers):
+        if not isinstance(answers, dict):
+            raise ServiceError(400, "answers should map each question to its answer")
+        return self.resume(session_id, "questions", answers)
+
+    def choose(self, session_id, choice):
+        return self.resume(session_id, "choice", choice)
+
+    def revise(self, session_id, question, answer, section=None):
+        """
+        Corrects an answer of a finished session and runs only what depends on it again.
+        """
+        from revisions import PlanReviser, RevisionError
+        if not question or answer is None:
+            raise ServiceError(400, "A revision needs the question and its new answer")
+        session = self.get(session_id)
+        with session.condition:
+            if session.status != "done":
+                raise ServiceError(409, "Only a finished session can be revised")
+            # so a second revision cannot patch the state at the same time
+            session.status = "revising"
+        try:
+            revision = PlanReviser(self.graph_module).revise(self.config(session), question, str(answer), section)
+        except RevisionError as error:
+            with session.condition:
+                session.status = "done"
+            raise ServiceError(400, str(error))
+        session.publish("revision", revision)
+        self.run(session, None)
+        return revision
+
+    def delete(self, session_id):
+        with self.lock:
+            self.sessions.pop(session_id, None)
+        self.graph_module.end_speculation(session_id)
+        self.graph_module.get_checkpointer().delete_thread(session_id)
+
+    def evict(self):
+        # sessions idle for longer than the TTL, abandoned while waiting for an answer or finished,
+        # with their checkpoints, whichever checkpointer holds them
+        if not self.ttl:
+            return
+        idle_since = time.monotonic() - self.ttl
+        for session_id, session in list(self.sessions.items()):
+            if session.used < idle_since and session.status != "running":
+                del self.sessions[session_id]
+                self.graph_module.end_speculation(session_id)
+                self.graph_module.get_checkpointer().delete_thread(session_id)
+
+    def stats(self):
+        with self.lock:
+            statuses = {}
+            for session in self.sessions.values():
+                statuses[session.status] = statuses.get(session.status, 0) + 1
+        return {"sessions": statuses}
+
+def make_handler(service):
+
+    class ServiceHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def send_json(self, status, body):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def read_json(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            try:
+                body = json.loads(self.rfile.read(length) or b"{}")
+            except ValueError:
+                raise ServiceError(400, "The body should be JSON")
+            if not isinstance(body, dict):
+                raise ServiceError(400, "The body should be a JSON object")
+            return body
+
+        def route(self, method):
+            url = urlparse(self.path)
+            parts = [part for part in url.path.split("/") if part]
+            try:
+                if method == "GET" and parts == ["metrics"]:
+                    data = service.graph_module.get_telemetry().prometheus().encode("utf-8")
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4")
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                elif method == "GET" and parts == ["sessions"]:
+                    self.send_json(200, service.stats())
+                elif method == "POST" and parts == ["sessions"]:
+                    body = self.read_json()
+                    session = service.start(str(body.get("motivation") or "I want to create a bushfire plan."))
+                    self.send_json(201, {**session.describe(), "events": f"/sessions/{session.id}/events"})
+                elif len(parts) == 2 and parts[0] == "sessions" and method == "GET":
+                    self.send_json(200, service.get(parts[1]).describe())
+                elif len(parts) == 2 and parts[0] == "sessions" and method == "DELETE":
+                    service.delete(parts[1])
+                    self.send_json(200, {"session_id": parts[1], "status": "deleted"})
+                elif len(parts) == 3 and parts[0] == "sessions" and method == "POST" and parts[2] == "answers":
+                    self.send_json(202, service.answer(parts[1], self.read_json().get("answers")).describe())
+                elif len(parts) == 3 and parts[0] == "sessions" and method == "POST" and parts[2] == "choice":
+                    self.send_json(202, service.choose(parts[1], self.read_json().get("choice")).describe())
+                elif len(parts) == 3 and parts[0] == "sessions" and method == "POST" and parts[2] == "revisions":
+                    body = self.read_json()
+                    self.send_json(202, service.revise(parts[1], body.get("question"), body.get("answer"), body.get("section")))
+                elif len(parts) == 3 and parts[0] == "sessions" and method == "GET" and parts[2] == "events":
+                    after = self.headers.get("Last-Event-ID") or parse_qs(url.query).get("after", ["-1"])[0]
+                    try:
+                        after = int(after)
+                    except ValueError:
+                        raise ServiceError(400, "The last event id should be a number")
+                    self.stream_events(service.get(parts[1]), after)
+                else:
+                    raise ServiceError(404, f"No route for {method} {url.path}")
+            except ServiceError as error:
+                self.send_json(error.status, {"error": str(error)})
+
+        def stream_events(self, session, last_id):
+            """
+            Server-sent events for the session, from after last_id until the session is done or fails.
+            """
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+            try:
+                while True:
+                    events = session.events_after(last_id, KEEPALIVE_SECONDS)
+                    if not events:
+                        self.wfile.write(b": keepalive\n\n")
+                    for event_id, event, data in events:
+                        self.wfile.write(f"id: {event_id}\nevent: {event}\ndata: {json.dumps(data)}\n\n".encode("utf-8"))
+                        last_id = event_id
+                    self.wfile.flush()
+                    if session.status in ("done", "error") and session.next_event_id - 1 <= last_id:
+                        return
+            except (BrokenPipeError, ConnectionResetError):
+                return
+
+        def do_GET(self):
+            self.route("GET")
+
+        def do_POST(self):
+            self.route("POST")
+
+        def do_DELETE(self):
+            self.route("DELETE")
+
+        def log_message(self, *args):
+            pass
+
+    return ServiceHandler
+
+class ServiceServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # the default backlog of 5 resets connections when many clients connect at once
+    request_queue_size = 256
+
+def serve(service, host="", port=8080):
+    return ServiceServer((host, port), make_handler(service))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bushfire Plan Generator as a local HTTP service")
+    parser.add_argument("--host", default=os.getenv("SERVICE_HOST", "127.0.0.1"), help="address to listen on")
+    parser.add_argument("--port", type=int, default=int(os.getenv("SERVICE_PORT", "8080")), help="port to listen on")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("SERVICE_WORKERS", "16")), help="sessions advanced at once; waiting sessions do not use a worker")
+    parser.add_argument("--checkpointer", choices=["memory", "sqlite"], default=os.getenv("CHECKPOINTER", "memory"), help="where sessions are saved")
+    parser.add_argument("--checkpoint-db", help="SQLite file for the sqlite checkpointer (default: checkpoints.db)")
+    parser.add_argument("--layout", choices=["sequential", "parallel"], help="assess risk then defence, or both at once (default: GRAPH_LAYOUT)")
+    args = parser.parse_args()
+
+    import main as graph_module
+
+    if args.layout and args.layout != graph_module.graph_layout:
+        graph_module.use_layout(args.layout)
+    if args.checkpointer != "memory":
+        graph_module.use_checkpointer(args.checkpointer, args.checkpoint_db)
+
+    service = SessionService(graph_module, workers=args.workers, ttl=graph_module.optional_number("SESSION_TTL"))
+    server = serve(service, args.host, args.port)
+    print(f"Serving on http://{args.host or 'localhost'}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,160 @@
+import asyncio
+import contextvars
+import hashlib
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from langchain_core.callbacks import BaseCallbackHandler
+from context_utils import build_context
+
+executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="speculation")
+
+# every Speculator, so a thread's speculations can be discarded when it ends
+speculators = weakref.WeakSet()
+
+def get_thread_id(config):
+    return (config or {}).get("configurable", {}).get("thread_id")
+
+def with_handler(callbacks, handler):
+    """
+    The callbacks inherited from a config (a list or a callback manager) with the handler added.
+    """
+    if callbacks is None:
+        return [handler]
+    if isinstance(callbacks, list):
+        return [*callbacks, handler]
+    callbacks = callbacks.copy()
+    callbacks.add_handler(handler, inherit=True)
+    return callbacks
+
+def speculation_config(config, node, handler):
+    """
+    The config of a speculative call: the caller's, so telemetry and budget callbacks still see it,
+    with the token counter added, attributed to the node it speculates for and tagged speculative.
+    """
+    from langchain_core.runnables.config import ensure_config, patch_config
+    config = ensure_config(config)
+    return patch_config(
+        {**config, "metadata": {**config.get("metadata", {}), "langgraph_node": node, "speculative": True}},
+        callbacks=with_handler(config.get("callbacks"), handler),
+    )
+
+def context_key(thread_id, full_context):
+    return (thread_id, hashlib.sha256(full_context.encode("utf-8")).hexdigest())
+
+class TokenCounter(BaseCallbackHandler):
+    """
+    Counts the tokens used by the LLM calls it is attached to.
+    """
+    def __init__(self):
+        self.total_tokens = 0
+
+    def on_llm_end(self, response, **kwargs):
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                if usage:
+                    self.total_tokens += usage.get("total_tokens", 0)
+
+class Speculator:
+    """
+    Runs a node's LLM chain in the background on the context the node expects
+    to see next, e.g. while the user is making a choice.
+
+    A speculative result is only adopted when the node is later called with
+    exactly the same context, so it is always the response the node would have
+    asked for. Results that are never adopted are counted as wasted, and calls
+    discarded before they start are cancelled.
+    """
+    def __init__(self, chain, guidance=None, node=None):
+        self.chain = chain
+        # the node's NodeGuidance, when its prompt takes guidance passages
+        self.guidance = guidance
+        # the graph node the calls are made for, so they are attributed to it rather than the caller
+        self.node = node
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.stats = {"started": 0, "adopted": 0, "wasted": 0, "cancelled": 0, "wasted_tokens": 0}
+        speculators.add(self)
+
+    def start(self, policy, config, state):
+        thread_id = get_thread_id(config)
+        full_context = build_context(state)
+        key = context_key(thread_id, full_context)
+        inputs = {"full_context": full_context}
+        if self.guidance:
+            inputs["guidance"] = self.guidance(state)
+        with self.lock:
+            if key in self.pending:
+                return
+            handler = TokenCounter()
+            future = executor.submit(
+                contextvars.copy_context().run,
+                policy.invoke, self.chain, inputs, speculation_config(config, self.node, handler),
+            )
+            self.pending[key] = (future, handler)
+            self.stats["started"] += 1
+
+    def take(self, thread_id, full_context):
+        """
+        The speculative call for this context, if there is one. Any other
+        speculation for the thread is discarded.
+        """
+        key = context_key(thread_id, full_context)
+        with self.lock:
+            entry = self.pending.pop(key, None)
+            if entry:
+                self.stats["adopted"] += 1
+        self.discard(thread_id)
+        return entry[0] if entry else None
+
+    def discard(self, thread_id):
+        with self.lock:
+            keys = [key for key in self.pending if key[0] == thread_id]
+            entries = [self.pending.pop(key) for key in keys]
+            self.stats["wasted"] += len(entries)
+
+        for future, handler in entries:
+            if future.cancel():
+                with self.lock:
+                    self.stats["cancelled"] += 1
+            else:
+                future.add_done_callback(lambda _, handler=handler: self.count_waste(handler))
+
+    def count_waste(self, handler):
+        with self.lock:
+            self.stats["wasted_tokens"] += handler.total_tokens
+
+    def invoke(self, policy, config, inputs):
+        future = self.take(get_thread_id(config), inputs["full_context"])
+        if future:
+            try:
+                return future.result()
+            except Exception as error:
+                print(f"Speculative call failed ({error!r}), calling again...")
+        return policy.invoke(self.chain, inputs, config)
+
+    async def ainvoke(self, policy, config, inputs):
+        future = self.take(get_thread_id(config), inputs["full_context"])
+        if future:
+            try:
+                return await asyncio.wrap_future(future)
+            except Exception as error:
+                print(f"Speculative call failed ({error!r}), calling again...")
+        return await policy.ainvoke(self.chain, inputs, config)
+
+def discard_thread(thread_id):
+    """
+    Discards every speculation for a thread that has ended, e.g. finished, failed or deleted.
+    """
+    for speculator in list(speculators):
+        speculator.discard(thread_id)
+
+def speculation_report(speculators):
+    totals = {"started": 0, "adopted": 0, "wasted": 0, "cancelled": 0, "wasted_tokens": 0}
+    for speculator in speculators:
+        with speculator.lock:
+            for key, count in speculator.stats.items():
+                totals[key] += count
+    totals["hit_rate"] = round(totals["adopted"] / totals["started"], 2) if totals["started"] else None
+    return totals
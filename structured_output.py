@@ -0,0 +1,148 @@
+import re
+import json
+from pydantic import ValidationError
+from langchain_core.exceptions import OutputParserException
+from langchain_core.messages import HumanMessage
+from langchain_core.runnables import RunnableLambda
+from telemetry import telemetry
+
+RETRY_PROMPT = """Your previous answer could not be used: {error}
+
+Previous answer:
+{answer}
+
+Call {name} again with a corrected answer."""
+
+PYTHON_LITERALS = {"None": "null", "True": "true", "False": "false"}
+
+def repair_json(text):
+    """
+    Cheap fixes for the usual ways model JSON goes wrong: code fences or prose
+    around the object, trailing commas, Python literals, and output cut off
+    part way through (unterminated strings and unclosed brackets).
+    """
+    text = text.strip()
+    fence = re.search(r"```(?:json)?\s*(.*?)(?:```|$)", text, re.DOTALL)
+    if fence:
+        text = fence.group(1).strip()
+
+    start = text.find("{")
+    if start < 0:
+        return text
+    end = text.rfind("}")
+    text = text[start:end + 1] if end > start else text[start:]
+
+    # Python literals, outside of strings
+    text = re.sub(
+        r'"(?:[^"\\]|\\.)*"|\b(None|True|False)\b',
+        lambda match: PYTHON_LITERALS[match.group(1)] if match.group(1) else match.group(0),
+        text,
+    )
+
+    # close whatever is still open at the end
+    closers = []
+    in_string = escaped = False
+    for char in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "{[":
+            closers.append("}" if char == "{" else "]")
+        elif char in "}]" and closers:
+            closers.pop()
+    if in_string:
+        text += '"'
+    text = re.sub(r"[,:]\s*$", "", text)
+    if closers and closers[-1] == "}":
+        # a key left without its value
+        text = re.sub(r'([{,])\s*"(?:[^"\\]|\\.)*"\s*$', r"\1", text)
+        text = re.sub(r",\s*$", "", text)
+    text += "".join(reversed(closers))
+
+    return re.sub(r",\s*([}\]])", r"\1", text)
+
+def response_data(message):
+    """
+    The structured answer in a model response: the tool call's arguments, or
+    failing that the (repaired) JSON in the call's raw arguments or the content.
+    Returns the data and whether it had to be repaired.
+    """
+    if message.tool_calls:
+        return message.tool_calls[0]["args"], False
+
+    invalid_calls = getattr(message, "invalid_tool_calls", None)
+    text = (invalid_calls[0].get("args") or "") if invalid_calls else message.content
+    if not isinstance(text, str):
+        text = "".join(part.get("text", "") if isinstance(part, dict) else str(part) for part in text)
+
+    try:
+        return json.loads(text), False
+    except ValueError:
+        pass
+    try:
+        return json.loads(repair_json(text)), True
+    except ValueError as error:
+        raise OutputParserException(f"Invalid JSON: {error}", llm_output=text)
+
+def response_text(message):
+    if message.tool_calls:
+        return json.dumps(message.tool_calls[0]["args"])
+    invalid_calls = getattr(message, "invalid_tool_calls", None)
+    return (invalid_calls[0].get("args") if invalid_calls else None) or str(message.content)
+
+class StructuredOutput:
+    """
+    Calls the model in function calling mode, with the schema sent as the only
+    tool rather than as format instructions in the prompt, and validates the
+    arguments locally. Malformed JSON is repaired, and a response that still
+    does not validate is retried once with the validation error.
+    """
+    def __init__(self, llm, schema):
+        self.schema = schema
+        self.name = schema.__name__
+        self.llm = llm.bind_tools([schema], tool_choice=self.name)
+        self.parser = RunnableLambda(self.parse, name="StructuredOutputParser")
+
+    def parse(self, message):
+        data, repaired = response_data(message)
+        try:
+            parsed = self.schema.model_validate(data)
+        except ValidationError as error:
+            raise OutputParserException(str(error), llm_output=response_text(message))
+        if repaired:
+            telemetry.increment("structured_output_total", schema=self.name, outcome="repaired")
+        return parsed
+
+    def retry_messages(self, prompt_value, message, error):
+        telemetry.increment("structured_output_total", schema=self.name, outcome="retried")
+        feedback = RETRY_PROMPT.format(error=error, answer=response_text(message), name=self.name)
+        return prompt_value.to_messages() + [HumanMessage(content=feedback)]
+
+    def invoke(self, prompt_value, config=None):
+        message = self.llm.invoke(prompt_value, config)
+        try:
+            return self.parser.invoke(message, config)
+        except OutputParserException as error:
+            message = self.llm.invoke(self.retry_messages(prompt_value, message, error), config)
+            return self.parser.invoke(message, config)
+
+    async def ainvoke(self, prompt_value, config=None):
+        message = await self.llm.ainvoke(prompt_value, config)
+        try:
+            return await self.parser.ainvoke(message, config)
+        except OutputParserException as error:
+            message = await self.llm.ainvoke(self.retry_messages(prompt_value, message, error), config)
+            return await self.parser.ainvoke(message, config)
+
+def structured_chain(prompt, llm, schema):
+    """
+    prompt | llm | parser, for a pydantic schema, using StructuredOutput.
+    """
+    structured = StructuredOutput(llm, schema)
+    return prompt | RunnableLambda(structured.invoke, afunc=structured.ainvoke, name=f"{structured.name}Output")
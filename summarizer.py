@@ -0,0 +1,168 @@
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import PromptTemplate
+from call_policy import CallPolicy
+
+SUMMARY_CACHE_SIZE = 128
+
+summary_prompt = PromptTemplate(
+    template="""
+You are keeping notes of a bushfire planning interview so it can continue
+without the full history. Update the summary below with the new questions and
+answers.
+
+Keep every fact about the property, the household, their circumstances and any
+decisions made. Keep each answer with what it was asked about. Leave out
+anything repeated. Use at most {max_words} words.
+
+Summary so far:
+{summary}
+
+New questions and answers:
+{answers}
+""",
+    input_variables=["summary", "answers", "max_words"],
+)
+
+def estimate_tokens(text):
+    """
+    A rough token count (about four characters per token), good enough for budgeting.
+    """
+    return len(str(text or "")) // 4
+
+def answer_text(section, question, answer):
+    return f"{section}: {question}\nAnswer: {answer}"
+
+class HistorySummarizer:
+    """
+    Keeps the questions and answers given to the models within a token budget.
+    When the answers not yet summarised (and the summary so far) are over
+    budget, all but the most recent `keep_recent` are folded into
+    state.conversation_summary and listed in state.summarized_answers, and the
+    context builders leave them out of the sections they render.
+
+    Every answer stays in the state (state.answers and each section's
+    questions.answers), only the prompts are compacted, and only the answers
+    are summarised, never the nodes' own instructions. The update replaces the
+    summary and the list as a whole, so it is safe to apply twice when
+    parallel nodes compact the same history, and they share one summary.
+    """
+    def __init__(self, llm, budget, keep_recent=4, policy=None):
+        self.chain = summary_prompt | llm | StrOutputParser()
+        self.budget = budget
+        self.keep_recent = keep_recent
+        self.policy = policy or CallPolicy()
+        self.lock = threading.Lock()
+        self.summaries = OrderedDict()
+        self.key_locks = {}
+        self.tasks = {}
+        self.stats = {"compactions": 0, "answers_summarized": 0, "tokens_removed": 0}
+
+    def pending_answers(self, state):
+        """
+        The answers not yet summarised, oldest first, as (section, question, answer).
+        """
+        summarized = state.summarized_answers or {}
+        return [
+            (section, question, answer)
+            for section, answers in (state.answers or {}).items()
+            for question, answer in answers.items()
+            if question not in summarized.get(section, [])
+        ]
+
+    def older_answers(self, state):
+        pending = self.pending_answers(state)
+        tokens = estimate_tokens(state.conversation_summary) + sum(estimate_tokens(answer_text(*item)) for item in pending)
+        if tokens <= self.budget:
+            return []
+        return pending[:len(pending) - self.keep_recent] if self.keep_recent else pending
+
+    def text(self, older):
+        return "\n\n".join(answer_text(*item) for item in older)
+
+    def key(self, state, older):
+        return (state.conversation_summary, hashlib.sha256(self.text(older).encode("utf-8")).hexdigest())
+
+    def inputs(self, state, older):
+        return {
+            "summary": state.conversation_summary or "(none yet)",
+            "answers": self.text(older),
+            "max_words": max(50, self.budget * 3 // 8),
+        }
+
+    def remember(self, key, summary, older):
+        with self.lock:
+            if key in self.summaries:
+                return
+            self.summaries[key] = summary
+            while len(self.summaries) > SUMMARY_CACHE_SIZE:
+                self.summaries.popitem(last=False)
+            self.stats["compactions"] += 1
+            self.stats["answers_summarized"] += len(older)
+            self.stats["tokens_removed"] += sum(estimate_tokens(answer_text(*item)) for item in older)
+
+    def updates(self, state, older, summary):
+        summarized = {section: list(questions) for section, questions in (state.summarized_answers or {}).items()}
+        for section, question, answer in older:
+            summarized.setdefault(section, []).append(question)
+        return {"conversation_summary": summary, "summarized_answers": summarized}
+
+    def compact(self, state, config=None):
+        """
+        The state updates that compact the history, or {} when it is within budget.
+        """
+        older = self.older_answers(state)
+        if not older:
+            return {}
+
+        key = self.key(state, older)
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            summary = self.summaries.get(key)
+            if summary is None:
+                print("\nSummarising the conversation so far...")
+                summary = self.policy.invoke(self.chain, self.inputs(state, older), config)
+                self.remember(key, summary, older)
+        with self.lock:
+            self.key_locks.pop(key, None)
+
+        return self.updates(state, older, summary)
+
+    async def acompact(self, state, config=None):
+        """
+        Async version of compact.
+        """
+        older = self.older_answers(state)
+        if not older:
+            return {}
+
+        key = self.key(state, older)
+        with self.lock:
+            summary = self.summaries.get(key)
+            task = self.tasks.get(key)
+            if summary is None and task is None:
+                print("\nSummarising the conversation so far...")
+                task = asyncio.ensure_future(self.policy.ainvoke(self.chain, self.inputs(state, older), config))
+                self.tasks[key] = task
+
+        if summary is None:
+            try:
+                summary = await task
+            finally:
+                with self.lock:
+                    self.tasks.pop(key, None)
+            self.remember(key, summary, older)
+
+        return self.updates(state, older, summary)
+
+    def apply(self, state, updates):
+        """
+        The state as the node should see it once the updates are applied.
+        """
+        if not updates:
+            return state
+        return state.model_copy(update=updates)
@@ -0,0 +1,234 @@
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from langchain_core.callbacks import BaseCallbackHandler
+
+MAX_SAMPLES = 10000
+QUANTILES = [0.5, 0.95, 0.99]
+METRIC_PREFIX = "bushfire_"
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def quantile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+class Telemetry:
+    """
+    Collects per-node timings, token counts and route counts, and exports
+    them as JSON or in the Prometheus text format.
+
+    Timings keep up to MAX_SAMPLES samples per series (reservoir sampled) so
+    percentiles stay cheap however long the process runs. With `prices`,
+    model -> (input, output) price per 1K tokens, the cost of each LLM call is
+    counted too.
+    """
+    def __init__(self, prices=None):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.counters = {}
+        self.prices = prices or {}
+        self.handler = TelemetryHandler(self)
+
+    def observe(self, name, value, **labels):
+        with self.lock:
+            series = self.samples.setdefault(name, {}).setdefault(label_key(labels), {"count": 0, "sum": 0.0, "values": []})
+            series["count"] += 1
+            series["sum"] += value
+            if len(series["values"]) < MAX_SAMPLES:
+                series["values"].append(value)
+            else:
+                index = random.randrange(series["count"])
+                if index < MAX_SAMPLES:
+                    series["values"][index] = value
+
+    def increment(self, name, amount=1, **labels):
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            key = label_key(labels)
+            series[key] = series.get(key, 0) + amount
+
+    def route(self, source, path):
+        """
+        Wraps a conditional edge's path function to count the route taken from source.
+        """
+        def counted_path(state):
+            target = path(state)
+            for route in (target if isinstance(target, list) else [target]):
+                self.increment("route_total", source=source, route=str(route))
+            return target
+        return counted_path
+
+    def summary(self):
+        with self.lock:
+            timings = {
+                name: [
+                    {
+                        "labels": dict(key),
+                        "count": series["count"],
+                        "sum": round(series["sum"], 6),
+                        **{f"p{int(q * 100)}": round(quantile(sorted(series["values"]), q), 6) for q in QUANTILES},
+                        "max": round(max(series["values"]), 6),
+                    }
+                    for key, series in by_labels.items()
+                ]
+                for name, by_labels in self.samples.items()
+            }
+            counters = {
+                name: [{"labels": dict(key), "value": value} for key, value in by_labels.items()]
+                for name, by_labels in self.counters.items()
+            }
+        return {"timings": timings, "counters": counters}
+
+    def model_routes(self):
+        """
+        The LLM calls made for each node and model: latency, tokens, cost and errors.
+        """
+        summary = self.summary()
+        routes = {}
+        for series in summary["timings"].get("llm_seconds", []):
+            route = routes.setdefault(label_key(series["labels"]), {**series["labels"]})
+            route.update({
+                "calls": series["count"],
+                "mean_seconds": round(series["sum"] / series["count"], 3),
+                "p95_seconds": round(series["p95"], 3),
+            })
+        for name, field in [("prompt_tokens_total", "prompt_tokens"), ("completion_tokens_total", "completion_tokens"), ("llm_cost_total", "cost"), ("errors_total", "errors")]:
+            for series in summary["counters"].get(name, []):
+                labels = {key: value for key, value in series["labels"].items() if key != "kind"}
+                if name == "errors_total" and series["labels"].get("kind") != "llm_seconds":
+                    continue
+                route = routes.setdefault(label_key(labels), {**labels})
+                route[field] = round(route.get(field, 0) + series["value"], 6)
+        return sorted(routes.values(), key=lambda route: (route.get("node", ""), route.get("model", "")))
+
+    def prometheus(self):
+        lines = []
+        summary = self.summary()
+        for name, series_list in sorted(summary["timings"].items()):
+            metric = METRIC_PREFIX + name
+            lines.append(f"# TYPE {metric} summary")
+            for series in series_list:
+                for q in QUANTILES:
+                    lines.append(f"{metric}{format_labels(series['labels'], quantile=q)} {series[f'p{int(q * 100)}']}")
+                lines.append(f"{metric}_sum{format_labels(series['labels'])} {series['sum']}")
+                lines.append(f"{metric}_count{format_labels(series['labels'])} {series['count']}")
+        for name, series_list in sorted(summary["counters"].items()):
+            metric = METRIC_PREFIX + name
+            lines.append(f"# TYPE {metric} counter")
+            for series in series_list:
+                lines.append(f"{metric}{format_labels(series['labels'])} {series['value']}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, json_path=None, prometheus_path=None):
+        if json_path:
+            with open(json_path, "w") as f:
+                json.dump(self.summary(), f, indent=2)
+        if prometheus_path:
+            with open(prometheus_path, "w") as f:
+                f.write(self.prometheus())
+
+    def serve(self, port):
+        """
+        Serves the metrics in the Prometheus text format at http://localhost:<port>/metrics.
+        """
+        telemetry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = telemetry.prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("", port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True, name="metrics").start()
+        return server
+
+def format_labels(labels, **extra):
+    labels = {**labels, **extra}
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in sorted(labels.items())) + "}"
+
+class TelemetryHandler(BaseCallbackHandler):
+    """
+    Callback handler, attached when the graph is invoked, that times each node
+    run, each LLM call within it and the output parsing, and counts tokens.
+    Runs are attributed to the graph node through LangGraph's langgraph_node metadata.
+    """
+    def __init__(self, telemetry):
+        self.telemetry = telemetry
+        self.lock = threading.Lock()
+        self.runs = {}
+
+    def start(self, run_id, kind, labels):
+        with self.lock:
+            self.runs[run_id] = (kind, labels, time.perf_counter())
+
+    def end(self, run_id):
+        with self.lock:
+            run = self.runs.pop(run_id, None)
+        if run:
+            kind, labels, started = run
+            self.telemetry.observe(kind, time.perf_counter() - started, **labels)
+        return run
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, metadata=None, name=None, **kwargs):
+        node = (metadata or {}).get("langgraph_node")
+        if not node or node.startswith("__"):
+            return
+        with self.lock:
+            parent = self.runs.get(parent_run_id)
+        if name == node and not (parent and parent[0] == "node_seconds"):
+            self.start(run_id, "node_seconds", {"node": node})
+        elif name and name.endswith("Parser"):
+            self.start(run_id, "parse_seconds", {"node": node})
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self.end(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        run = self.end(run_id)
+        if run:
+            self.telemetry.increment("errors_total", kind=run[0], **run[1])
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, invocation_params=None, **kwargs):
+        metadata = metadata or {}
+        invocation_params = invocation_params or {}
+        model = (metadata.get("ls_model_name") or invocation_params.get("model")
+                 or invocation_params.get("model_name") or invocation_params.get("_type", "unknown"))
+        self.start(run_id, "llm_seconds", {"node": metadata.get("langgraph_node", "none"), "model": str(model)})
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        run = self.end(run_id)
+        if not run:
+            return
+        labels = run[1]
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                if usage:
+                    self.telemetry.increment("prompt_tokens_total", usage.get("input_tokens", 0), **labels)
+                    self.telemetry.increment("completion_tokens_total", usage.get("output_tokens", 0), **labels)
+                    price = self.telemetry.prices.get(labels["model"])
+                    if price:
+                        cost = (usage.get("input_tokens", 0) * price[0] + usage.get("output_tokens", 0) * price[1]) / 1000
+                        self.telemetry.increment("llm_cost_total", cost, **labels)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        run = self.end(run_id)
+        if run:
+            self.telemetry.increment("errors_total", kind=run[0], **run[1])
+
+telemetry = Telemetry()